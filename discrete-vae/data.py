@@ -15,6 +15,10 @@ BINARIZED_MNIST_DIR = \
     '/Users/tuananhle/Documents/research/datasets/binarized-mnist'
 BINARIZED_MNIST_DIR_CC = \
     '/home/tuananh/projects/def-fwood/tuananh/datasets/binarized-mnist'
+OMNIGLOT_URL = \
+    'https://github.com/yburda/iwae/raw/master/datasets/OMNIGLOT/chardata.mat'
+OMNIGLOT_PATH = os.path.join(os.path.dirname(BINARIZED_MNIST_DIR),
+                             'omniglot', 'chardata.mat')
 
 
 def download_binarized_mnist(dir=BINARIZED_MNIST_DIR,
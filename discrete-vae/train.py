@@ -1,5 +1,6 @@
 import torch
 import losses
+import estimators
 import util
 import itertools
 
@@ -30,17 +31,17 @@ def train_wake_sleep(generative_model, inference_network, data_loader,
     iteration = 0
     while iteration < num_iterations:
         for obs in iter(data_loader):
-            # wake theta
             optimizer_phi.zero_grad()
             optimizer_theta.zero_grad()
+
+            # wake theta; the loss doesn't reach phi (see
+            # losses.get_wake_theta_loss) so phi's gradients stay zero
             wake_theta_loss, elbo = losses.get_wake_theta_loss(
                 generative_model, inference_network, obs, num_particles)
             wake_theta_loss.backward()
             optimizer_theta.step()
 
-            # sleep phi
-            optimizer_phi.zero_grad()
-            optimizer_theta.zero_grad()
+            # sleep phi; samples of the updated generative model
             sleep_phi_loss = losses.get_sleep_loss(
                 generative_model, inference_network,
                 num_samples=obs.shape[0] * num_particles)
@@ -144,23 +145,17 @@ def train_wake_wake(generative_model, inference_network, data_loader,
     iteration = 0
     while iteration < num_iterations:
         for obs in iter(data_loader):
-            log_weight, log_q = losses.get_log_weight_and_log_q(
+            log_p, log_q = losses.get_log_p_and_log_q(
                 generative_model, inference_network, obs, num_particles)
 
-            # wake theta
+            # wake theta and wake phi; the losses depend on disjoint parameters
+            # so a single backward pass gives the gradients of both
             optimizer_phi.zero_grad()
             optimizer_theta.zero_grad()
-            wake_theta_loss, elbo = losses.get_wake_theta_loss_from_log_weight(
-                log_weight)
-            wake_theta_loss.backward(retain_graph=True)
+            wake_theta_loss, wake_phi_loss, elbo = estimators.get_wake_losses(
+                log_p, log_q)
+            (wake_theta_loss + wake_phi_loss).backward()
             optimizer_theta.step()
-
-            # wake phi
-            optimizer_phi.zero_grad()
-            optimizer_theta.zero_grad()
-            wake_phi_loss = losses.get_wake_phi_loss_from_log_weight_and_log_q(
-                log_weight, log_q)
-            wake_phi_loss.backward()
             optimizer_phi.step()
 
             if callback is not None:
@@ -434,24 +429,19 @@ def train_thermo_wake(generative_model, inference_network, data_loader,
     iteration = 0
     while iteration < num_iterations:
         for obs in iter(data_loader):
-            log_weight, log_p, log_q = losses.get_log_weight_log_p_log_q(
+            log_p, log_q = losses.get_log_p_and_log_q(
                 generative_model, inference_network, obs, num_particles)
 
-            # wake theta
+            # thermo theta and wake phi; log_q is detached in the thermo
+            # loss so the losses depend on disjoint parameters and a single
+            # backward pass gives the gradients of both
             optimizer_phi.zero_grad()
             optimizer_theta.zero_grad()
-            thermo_loss, elbo = \
-                losses.get_thermo_loss_from_log_weight_log_p_log_q(
-                    log_weight, log_p, log_q, partition, num_particles)
-            thermo_loss.backward(retain_graph=True)
+            thermo_loss, elbo = estimators.get_thermo_loss(
+                log_p, log_q.detach(), partition)
+            wake_phi_loss, _ = estimators.get_wake_phi_loss(log_p, log_q)
+            (thermo_loss + wake_phi_loss).backward()
             optimizer_theta.step()
-
-            # wake phi
-            optimizer_phi.zero_grad()
-            optimizer_theta.zero_grad()
-            wake_phi_loss = losses.get_wake_phi_loss_from_log_weight_and_log_q(
-                log_weight, log_q)
-            wake_phi_loss.backward()
             optimizer_phi.step()
 
             if callback is not None:
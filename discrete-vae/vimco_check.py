@@ -0,0 +1,36 @@
+import torch
+import util
+import losses
+
+# compares the loss and gradients of losses.get_vimco_loss (the
+# O(batch_size * num_particles) control variates of estimators) on a
+# discrete-vae model against the loop in losses.get_vimco_loss_slow, for
+# small K and K in the thousands; the control variates on their own (including
+# -inf log weights) are checked by vimco_check.py at the root of the
+# repository
+
+util.set_seed(1)
+device = torch.device('cpu')
+generative_model, inference_network = util.init_models(
+    None, 'linear_1', device)
+batch_size = 3
+obs = (torch.rand(batch_size, 784) < 0.5).float()
+parameters = list(generative_model.parameters()) + \
+    list(inference_network.parameters())
+
+for num_particles in [2, 5, 2000]:
+    grads, values = [], []
+    for get_loss in [losses.get_vimco_loss_slow, losses.get_vimco_loss]:
+        util.set_seed(num_particles)
+        loss, elbo = get_loss(generative_model, inference_network, obs,
+                              num_particles)
+        values.append(torch.stack([loss, elbo]).detach())
+        grads.append(torch.autograd.grad(loss, parameters))
+    # the loss sums num_particles terms of size |log q| in float32, hence the
+    # looser rtol than in the root vimco_check.py
+    values_ok = torch.allclose(values[0], values[1], rtol=1e-4, atol=1e-5)
+    grads_ok = all(torch.allclose(x, y, rtol=1e-4, atol=1e-4)
+                   for x, y in zip(*grads))
+    util.print_with_time('K = {}: loss and elbo ok: {}, grads ok: {}'.format(
+        num_particles, values_ok, grads_ok))
+    assert values_ok and grads_ok
@@ -0,0 +1,283 @@
+"""Gradient estimators shared by the gmm, pcfg and discrete-vae experiments.
+
+Every loss takes log_p and log_q, tensors of shape
+[batch_size, num_particles] of log p(z_k, x) and log q(z_k | x) of
+num_particles samples z_k ~ q(z | x) per obs, and returns (loss, elbo) where
+loss is the scalar that we call .backward() on and step the optimizer and
+elbo is the importance weighted evidence lower bound averaged over the batch.
+Samplers and models stay in the experiments; install this module with
+`pip install -e .` from the root of the repository.
+"""
+
+import torch
+import numpy as np
+
+
+def get_log_evidence(log_weight):
+    """Args:
+        log_weight: tensor of shape [batch_size, num_particles]
+
+    Returns: tensor of shape [batch_size] of log (1 / K sum_k w_k)
+    """
+
+    _, num_particles = log_weight.shape
+    return torch.logsumexp(log_weight, dim=1) - np.log(num_particles)
+
+
+def get_normalized_weight(log_weight, log_sum_weight=None):
+    """Self-normalized importance weights along the particle dimension.
+
+    Args:
+        log_weight: tensor of shape [batch_size, num_particles]
+        log_sum_weight: tensor of shape [batch_size] of
+            torch.logsumexp(log_weight, dim=1) or None to compute it here
+
+    Returns: tensor of shape [batch_size, num_particles]
+    """
+
+    if log_sum_weight is None:
+        log_sum_weight = torch.logsumexp(log_weight, dim=1)
+    return torch.exp(log_weight - log_sum_weight.unsqueeze(-1))
+
+
+def get_sleep_loss(log_q, log_weight=None):
+    """The one loss without an elbo since it is evaluated on samples from the
+        generative model rather than from q.
+
+    Args:
+        log_q: tensor of shape [num_samples] of log q(z | x) of
+            (z, x) ~ p(z, x)
+        log_weight: tensor of shape [num_samples] or None; if given, the
+            samples are self-normalized importance weighted by it (e.g. when
+            they were drawn from an older generative model)
+
+    Returns: scalar
+    """
+
+    if log_weight is None:
+        return -torch.mean(log_q)
+    normalized_weight = torch.exp(
+        log_weight - torch.logsumexp(log_weight, dim=0)).detach()
+    return -torch.sum(normalized_weight * log_q)
+
+
+def get_wake_theta_loss(log_p, log_q):
+    """Importance weighted autoencoder objective.
+
+    Returns:
+        loss: scalar
+        elbo: scalar
+    """
+
+    elbo = torch.mean(get_log_evidence(log_p - log_q))
+    return -elbo, elbo
+
+
+def get_wake_phi_loss(log_p, log_q):
+    """Wake update of q: the self-normalized estimate of
+        KL(p(z | x) || q(z | x)) up to a constant.
+
+    Returns:
+        loss: scalar
+        elbo: scalar; detached
+    """
+
+    log_weight = (log_p - log_q).detach()
+    _, num_particles = log_weight.shape
+    log_sum_weight = torch.logsumexp(log_weight, dim=1)
+    normalized_weight = get_normalized_weight(log_weight, log_sum_weight)
+    loss = torch.mean(-torch.sum(normalized_weight * log_q, dim=1))
+    return loss, torch.mean(log_sum_weight) - np.log(num_particles)
+
+
+def get_wake_losses(log_p, log_q):
+    """get_wake_theta_loss and get_wake_phi_loss sharing one logsumexp. The
+        theta loss is computed from log_q.detach() so that, with the
+        generative model and q having disjoint parameters, one backward pass of
+        wake_theta_loss + wake_phi_loss gives both their gradients.
+
+    Returns:
+        wake_theta_loss: scalar
+        wake_phi_loss: scalar
+        elbo: scalar
+    """
+
+    log_weight = log_p - log_q.detach()
+    _, num_particles = log_weight.shape
+    log_sum_weight = torch.logsumexp(log_weight, dim=1)
+    normalized_weight = get_normalized_weight(log_weight.detach(),
+                                              log_sum_weight.detach())
+    elbo = torch.mean(log_sum_weight) - np.log(num_particles)
+    wake_phi_loss = torch.mean(-torch.sum(normalized_weight * log_q, dim=1))
+    return -elbo, wake_phi_loss, elbo
+
+
+def get_reinforce_loss(log_p, log_q):
+    """Importance weighted autoencoder objective with the score function
+        gradient wrt q.
+
+    Returns:
+        loss: scalar
+        elbo: scalar
+    """
+
+    log_evidence = get_log_evidence(log_p - log_q)
+
+    # this is term 1 in equation (2) of https://arxiv.org/pdf/1805.10469.pdf
+    reinforce_correction = log_evidence.detach() * torch.sum(log_q, dim=1)
+
+    elbo = torch.mean(log_evidence)
+    loss = -elbo - torch.mean(reinforce_correction)
+    return loss, elbo
+
+
+def get_vimco_control_variate(log_weight):
+    """Leave-one-out control variates of VIMCO computed for all particles at
+        once, in O(batch_size * num_particles) time and memory.
+
+    The sum of the weights other than the kth is the sum of all weights minus
+    the kth one. To avoid cancellation, both are shifted by the maximum
+    weight, which stays in the sum for every k except the argmax; the sum
+    without the argmax is a separate (masked) logsumexp. Log weights of -inf
+    give the same results as leaving them out one by one.
+
+    Args:
+        log_weight: tensor of shape [batch_size, num_particles] where
+            num_particles > 1
+
+    Returns: detached tensor of shape [batch_size, num_particles] whose
+        [b, k] element is the Upsilon_{-k} term below equation 3 of
+        https://arxiv.org/pdf/1602.06725.pdf: log of the mean of the weights
+        where w_{b, k} is replaced by the geometric mean of the others
+    """
+    log_weight = log_weight.detach()
+    _, num_particles = log_weight.shape
+    minus_inf = torch.full_like(log_weight, -float('inf'))
+
+    # log_weight_[b, k] = 1 / (K - 1) \sum_{\ell \neq k} \log w_{b, \ell}
+    # shape [batch_size, num_particles]
+    is_minus_inf = log_weight == -float('inf')
+    finite_log_weight = log_weight.masked_fill(is_minus_inf, 0)
+    log_weight_ = (torch.sum(finite_log_weight, dim=1, keepdim=True) -
+                   finite_log_weight) / (num_particles - 1)
+    num_minus_inf_except = \
+        torch.sum(is_minus_inf, dim=1, keepdim=True) - is_minus_inf.long()
+    log_weight_ = torch.where(num_minus_inf_except > 0, minus_inf,
+                              log_weight_)
+
+    # shape [batch_size, 1]
+    max_log_weight, argmax = torch.max(log_weight, dim=1, keepdim=True)
+    is_argmax = torch.zeros_like(is_minus_inf).scatter_(1, argmax, True)
+    shift = torch.where(torch.isfinite(max_log_weight), max_log_weight,
+                        torch.zeros_like(max_log_weight))
+
+    # log \sum_{\ell \neq argmax} w_{b, \ell}; shape [batch_size, 1]
+    log_sum_except_max = torch.logsumexp(
+        torch.where(is_argmax, minus_inf, log_weight), dim=1, keepdim=True)
+
+    # log \sum_{\ell \neq k} w_{b, \ell} for k other than the argmax where
+    # the (shifted) maximum weight contributes exp(0) = 1
+    log_sum_except = shift + torch.log(
+        torch.exp(max_log_weight - shift) + torch.clamp(
+            torch.exp(log_sum_except_max - shift) -
+            torch.exp(log_weight - shift), min=0))
+    log_sum_except = torch.where(
+        is_argmax, log_sum_except_max.expand_as(log_weight), log_sum_except)
+
+    return torch.logsumexp(torch.stack([log_sum_except, log_weight_]),
+                           dim=0) - np.log(num_particles)
+
+
+def get_vimco_loss(log_p, log_q):
+    """Importance weighted autoencoder objective with the VIMCO gradient wrt
+        q (https://arxiv.org/pdf/1602.06725.pdf).
+
+    Returns:
+        loss: scalar
+        elbo: scalar
+    """
+
+    log_weight = log_p - log_q
+    log_evidence = get_log_evidence(log_weight)
+
+    # this is the B term in VIMCO gradient in
+    # https://arxiv.org/pdf/1805.10469.pdf
+    # shape [batch_size, num_particles]
+    control_variate = get_vimco_control_variate(log_weight)
+    reinforce_correction = torch.sum(
+        (log_evidence.detach().unsqueeze(-1) - control_variate) * log_q,
+        dim=1)
+
+    elbo = torch.mean(log_evidence)
+    loss = -elbo - torch.mean(reinforce_correction)
+    return loss, elbo
+
+
+def get_thermo_loss(log_p, log_q, partition, integration='left',
+                    mode='covariance'):
+    """Thermodynamic variational objective
+        (https://arxiv.org/pdf/1907.00031.pdf).
+
+    Args:
+        log_p: tensor of shape [batch_size, num_particles]
+        log_q: tensor of shape [batch_size, num_particles]
+        partition: partition of [0, 1];
+            tensor of shape [num_partitions + 1] where partition[0] is zero and
+            partition[-1] is one;
+            see https://en.wikipedia.org/wiki/Partition_of_an_interval
+        integration: left, right or trapz
+        mode: covariance or baselined_reinforce
+
+    Returns:
+        loss: scalar
+        elbo: scalar
+    """
+    _, num_particles = log_p.shape
+    log_weight = log_p - log_q
+    heated_log_weight = log_weight.unsqueeze(-1) * partition
+    heated_normalized_weight = torch.exp(
+        heated_log_weight -
+        torch.logsumexp(heated_log_weight, dim=1, keepdim=True))
+    thermo_logp = partition * log_p.unsqueeze(-1) + \
+        (1 - partition) * log_q.unsqueeze(-1)
+
+    wf = heated_normalized_weight * log_weight.unsqueeze(-1)
+    w_detached = heated_normalized_weight.detach()
+    if num_particles == 1:
+        correction = 1
+    else:
+        correction = num_particles / (num_particles - 1)
+
+    if mode == 'covariance':
+        thing_to_add = correction * torch.sum(
+            w_detached *
+            (log_weight.unsqueeze(-1) -
+             torch.sum(wf, dim=1, keepdim=True)).detach() *
+            (thermo_logp -
+             torch.sum(thermo_logp * w_detached, dim=1, keepdim=True)),
+            dim=1)
+    elif mode == 'baselined_reinforce':
+        thing_to_add = correction * torch.sum(
+            w_detached *
+            (log_weight.unsqueeze(-1) -
+             torch.sum(wf, dim=1, keepdim=True)).detach() *
+            thermo_logp,
+            dim=1)
+
+    multiplier = torch.zeros_like(partition)
+    if integration == 'trapz':
+        multiplier[0] = 0.5 * (partition[1] - partition[0])
+        multiplier[1:-1] = 0.5 * (partition[2:] - partition[0:-2])
+        multiplier[-1] = 0.5 * (partition[-1] - partition[-2])
+    elif integration == 'left':
+        multiplier[:-1] = partition[1:] - partition[:-1]
+    elif integration == 'right':
+        multiplier[1:] = partition[1:] - partition[:-1]
+
+    loss = -torch.mean(torch.sum(
+        multiplier * (thing_to_add + torch.sum(
+            w_detached * log_weight.unsqueeze(-1), dim=1)),
+        dim=1))
+
+    elbo = torch.mean(get_log_evidence(log_weight))
+    return loss, elbo
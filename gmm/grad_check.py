@@ -3,6 +3,7 @@ import util
 import numpy as np
 import argparse
 import losses
+import estimators
 
 
 args = argparse.Namespace()
@@ -36,13 +37,12 @@ def get_grads_correct(seed):
     theta_grads_correct = []
     phi_grads_correct = []
 
-    log_weight, log_q = losses.get_log_weight_and_log_q(
+    log_p, log_q = losses.get_log_p_and_log_q(
         generative_model, inference_network, obs, num_particles)
 
     optimizer_phi.zero_grad()
     optimizer_theta.zero_grad()
-    wake_theta_loss, elbo = losses.get_wake_theta_loss_from_log_weight(
-        log_weight)
+    wake_theta_loss, elbo = estimators.get_wake_theta_loss(log_p, log_q)
     wake_theta_loss.backward(retain_graph=True)
     theta_grads_correct = [parameter.grad.clone() for parameter in
                            generative_model.parameters()]
@@ -51,8 +51,7 @@ def get_grads_correct(seed):
 
     optimizer_phi.zero_grad()
     optimizer_theta.zero_grad()
-    wake_phi_loss = losses.get_wake_phi_loss_from_log_weight_and_log_q(
-        log_weight, log_q)
+    wake_phi_loss, _ = estimators.get_wake_phi_loss(log_p, log_q)
     wake_phi_loss.backward()
     phi_grads_correct = [parameter.grad.clone() for parameter in
                          inference_network.parameters()]
@@ -67,19 +66,17 @@ def get_grads_in_one(seed):
     theta_grads_in_one = []
     phi_grads_in_one = []
 
-    log_weight, log_q = losses.get_log_weight_and_log_q(
+    log_p, log_q = losses.get_log_p_and_log_q(
         generative_model, inference_network, obs, num_particles)
 
     optimizer_phi.zero_grad()
     optimizer_theta.zero_grad()
-    wake_theta_loss, elbo = losses.get_wake_theta_loss_from_log_weight(
-        log_weight)
+    wake_theta_loss, elbo = estimators.get_wake_theta_loss(log_p, log_q)
     wake_theta_loss.backward(retain_graph=True)
 
     optimizer_phi.zero_grad()
     # optimizer_theta.zero_grad()
-    wake_phi_loss = losses.get_wake_phi_loss_from_log_weight_and_log_q(
-        log_weight, log_q)
+    wake_phi_loss, _ = estimators.get_wake_phi_loss(log_p, log_q)
     wake_phi_loss.backward()
 
     # only get the grads in the end!
@@ -100,19 +97,17 @@ def get_grads_in_one_no_zeroing(seed):
     theta_grads_in_one = []
     phi_grads_in_one = []
 
-    log_weight, log_q = losses.get_log_weight_and_log_q(
+    log_p, log_q = losses.get_log_p_and_log_q(
         generative_model, inference_network, obs, num_particles)
 
     optimizer_phi.zero_grad()
     optimizer_theta.zero_grad()
-    wake_theta_loss, elbo = losses.get_wake_theta_loss_from_log_weight(
-        log_weight)
+    wake_theta_loss, elbo = estimators.get_wake_theta_loss(log_p, log_q)
     wake_theta_loss.backward(retain_graph=True)
 
     # optimizer_phi.zero_grad() -> don't zero phi grads
     # optimizer_theta.zero_grad()
-    wake_phi_loss = losses.get_wake_phi_loss_from_log_weight_and_log_q(
-        log_weight, log_q)
+    wake_phi_loss, _ = estimators.get_wake_phi_loss(log_p, log_q)
     wake_phi_loss.backward()
 
     # only get the grads in the end!
@@ -127,52 +122,25 @@ def get_grads_in_one_no_zeroing(seed):
     return theta_grads_in_one, phi_grads_in_one
 
 
-def get_log_weight_and_log_q_weird_detach(generative_model, inference_network, obs,
-                             num_particles=1, reparam=False):
-    """Compute log weight and log prob of inference network.
-
-    Args:
-        generative_model: models.GenerativeModel object
-        inference_network: models.InferenceNetwork object
-        obs: tensor of shape [batch_size]
-        num_particles: int
-        reparam: reparameterize sampling from q (only applicable if z is
-            Concrete)
-
-    Returns:
-        log_weight: tensor of shape [batch_size, num_particles]
-        log_q: tensor of shape [batch_size, num_particles]
-    """
-
-    latent_dist = inference_network.get_latent_dist(obs)
-    latent = inference_network.sample_from_latent_dist(
-        latent_dist, num_particles, reparam=reparam)
-    log_p = generative_model.get_log_prob(latent, obs).transpose(0, 1)
-    log_q = inference_network.get_log_prob_from_latent_dist(
-        latent_dist, latent).transpose(0, 1)
-    log_weight = log_p - log_q.detach()
-    return log_weight, log_q
-
-
 def get_grads_weird_detach(seed):
     util.set_seed(seed)
 
     theta_grads_in_one = []
     phi_grads_in_one = []
 
-    log_weight, log_q = get_log_weight_and_log_q_weird_detach(
+    log_p, log_q = losses.get_log_p_and_log_q(
         generative_model, inference_network, obs, num_particles)
 
     optimizer_phi.zero_grad()
     optimizer_theta.zero_grad()
-    wake_theta_loss, elbo = losses.get_wake_theta_loss_from_log_weight(
-        log_weight)
+    # detach log_q in the log weight of the wake theta loss
+    wake_theta_loss, elbo = estimators.get_wake_theta_loss(log_p,
+                                                           log_q.detach())
     wake_theta_loss.backward(retain_graph=True)
 
     # optimizer_phi.zero_grad() -> don't zero phi grads
     # optimizer_theta.zero_grad()
-    wake_phi_loss = losses.get_wake_phi_loss_from_log_weight_and_log_q(
-        log_weight, log_q)
+    wake_phi_loss, _ = estimators.get_wake_phi_loss(log_p, log_q)
     wake_phi_loss.backward()
 
     # only get the grads in the end!
@@ -193,13 +161,12 @@ def get_grads_correct_sleep(seed):
     theta_grads_correct = []
     phi_grads_correct = []
 
-    log_weight, log_q = losses.get_log_weight_and_log_q(
+    log_p, log_q = losses.get_log_p_and_log_q(
         generative_model, inference_network, obs, num_particles)
 
     optimizer_phi.zero_grad()
     optimizer_theta.zero_grad()
-    wake_theta_loss, elbo = losses.get_wake_theta_loss_from_log_weight(
-        log_weight)
+    wake_theta_loss, elbo = estimators.get_wake_theta_loss(log_p, log_q)
     wake_theta_loss.backward(retain_graph=True)
     theta_grads_correct = [parameter.grad.clone() for parameter in
                            generative_model.parameters()]
@@ -208,8 +175,7 @@ def get_grads_correct_sleep(seed):
 
     optimizer_phi.zero_grad()
     optimizer_theta.zero_grad()
-    wake_phi_loss = losses.get_wake_phi_loss_from_log_weight_and_log_q(
-        log_weight, log_q)
+    wake_phi_loss, _ = estimators.get_wake_phi_loss(log_p, log_q)
     wake_phi_loss.backward()
     wake_phi_grads_correct = [parameter.grad.clone() for parameter in
                               inference_network.parameters()]
@@ -238,18 +204,18 @@ def get_grads_weird_detach_sleep(seed):
     theta_grads_in_one = []
     phi_grads_in_one = []
 
-    log_weight, log_q = get_log_weight_and_log_q_weird_detach(
+    log_p, log_q = losses.get_log_p_and_log_q(
         generative_model, inference_network, obs, num_particles)
 
     optimizer_phi.zero_grad()
     optimizer_theta.zero_grad()
-    wake_theta_loss, elbo = losses.get_wake_theta_loss_from_log_weight(
-        log_weight)
+    # detach log_q in the log weight of the wake theta loss
+    wake_theta_loss, elbo = estimators.get_wake_theta_loss(log_p,
+                                                           log_q.detach())
 
     # optimizer_phi.zero_grad() -> don't zero phi grads
     # optimizer_theta.zero_grad()
-    wake_phi_loss = losses.get_wake_phi_loss_from_log_weight_and_log_q(
-        log_weight, log_q)
+    wake_phi_loss, _ = estimators.get_wake_phi_loss(log_p, log_q)
 
     sleep_phi_loss = losses.get_sleep_loss(
         generative_model, inference_network, num_samples=num_particles)
@@ -4,8 +4,20 @@ import torch.nn.functional as F
 
 
 class GenerativeModel(nn.Module):
+    """Args:
+        init_mixture_logits: array of shape [num_mixtures]
+        softmax_multiplier: float
+        device: torch.device
+        index_latents: if True, latents are int64 mixture indices of shape
+            [dim1, ..., dimN] instead of one-hot tensors of shape
+            [dim1, ..., dimN, num_mixtures] so that log probabilities are
+            gathers and sampling and scoring take O(dim1 * ... * dimN) instead
+            of O(dim1 * ... * dimN * num_mixtures); get_log_prob accepts
+            either
+    """
+
     def __init__(self, init_mixture_logits, softmax_multiplier=0.5,
-                 device=torch.device('cpu')):
+                 device=torch.device('cpu'), index_latents=False):
         super(GenerativeModel, self).__init__()
         self.num_mixtures = len(init_mixture_logits)
         self.mixture_logits = nn.Parameter(torch.tensor(
@@ -15,38 +27,60 @@ class GenerativeModel(nn.Module):
         self.scale = torch.tensor(5, device=device, dtype=torch.float)
         self.logit_multiplier = 0.5
         self.device = device
+        self.index_latents = index_latents
 
     def get_latent_params(self):
         return F.softmax(self.mixture_logits * self.logit_multiplier, dim=0)
 
+    def get_latent_log_params(self):
+        """Returns: tensor of shape [num_mixtures] of log mixture probabilities
+        """
+        return F.log_softmax(self.mixture_logits * self.logit_multiplier,
+                             dim=0)
+
     def get_latent_dist(self):
         """Returns: distribution with batch shape [] and event shape
-            [num_mixtures].
+            [num_mixtures] (or [] if index_latents).
         """
-        return torch.distributions.OneHotCategorical(
-            logits=self.mixture_logits * self.logit_multiplier)
+        if self.index_latents:
+            return torch.distributions.Categorical(
+                logits=self.mixture_logits * self.logit_multiplier)
+        else:
+            return torch.distributions.OneHotCategorical(
+                logits=self.mixture_logits * self.logit_multiplier)
 
     def get_obs_dist(self, latent):
         """Args:
-            latent: tensor of shape [dim0, ..., dimN, num_mixtures]
+            latent: tensor of shape [dim0, ..., dimN, num_mixtures] or int64
+                tensor of shape [dim0, ..., dimN] of mixture indices
 
         Returns: distribution with batch shape [dim0, ..., dimN] and
             event shape []
         """
-        return torch.distributions.Normal(
-            loc=torch.sum(self.locs * latent, dim=-1), scale=self.scale)
+        if latent.dtype == torch.long:
+            loc = self.locs[latent]
+        else:
+            loc = torch.sum(self.locs * latent, dim=-1)
+        return torch.distributions.Normal(loc=loc, scale=self.scale)
 
     def get_log_prob(self, latent, obs):
         """Log of joint probability.
 
         Args:
             latent: tensor of shape [dim1, ..., dimN, batch_size, num_mixtures]
+                or int64 tensor of shape [dim1, ..., dimN, batch_size] of
+                mixture indices
             obs: tensor of shape [batch_size]
 
         Returns: tensor of shape [dim1, ..., dimN, batch_size]
         """
 
-        latent_log_prob = self.get_latent_dist().log_prob(latent)
+        if latent.dtype == torch.long:
+            latent_log_prob = self.get_latent_log_params()[latent]
+        else:
+            latent_log_prob = torch.distributions.OneHotCategorical(
+                logits=self.mixture_logits * self.logit_multiplier
+            ).log_prob(latent)
         obs_log_prob = self.get_obs_dist(latent).log_prob(obs)
         return latent_log_prob + obs_log_prob
 
@@ -55,7 +89,8 @@ class GenerativeModel(nn.Module):
             num_samples: int
 
         Returns:
-            latent: tensor of shape [num_samples, num_mixtures]
+            latent: tensor of shape [num_samples, num_mixtures] or int64
+                tensor of shape [num_samples] if index_latents
             obs: tensor of shape [num_samples]
         """
 
@@ -76,21 +111,24 @@ class GenerativeModel(nn.Module):
 
         return self.sample_latent_and_obs(num_samples)[1]
 
+    def get_log_joint_table(self, obs):
+        """Closed-form log p(z, x) of every obs with every mixture component.
+
+        Args:
+            obs: tensor of shape [batch_size]
+
+        Returns: tensor of shape [batch_size, num_mixtures]
+        """
+        return self.get_latent_log_params() + torch.distributions.Normal(
+            loc=self.locs, scale=self.scale).log_prob(obs.unsqueeze(-1))
+
     def get_log_evidence(self, obs):
         """Args:
             obs: tensor of shape [batch_size]
 
         Returns: tensor of shape [batch_size]
         """
-        batch_size = len(obs)
-        return torch.logsumexp(
-            torch.log(
-                self.get_latent_params().unsqueeze(0).expand(batch_size, -1)
-            ) + torch.distributions.Normal(
-                loc=self.locs.unsqueeze(0).expand(batch_size, -1),
-                scale=self.scale
-            ).log_prob(obs.unsqueeze(-1).expand(-1, self.num_mixtures)),
-            dim=1)
+        return torch.logsumexp(self.get_log_joint_table(obs), dim=1)
 
     def get_posterior_probs(self, obs):
         """Args:
@@ -98,20 +136,24 @@ class GenerativeModel(nn.Module):
 
         Returns: tensor of shape [batch_size, num_mixtures]
         """
-        batch_size = len(obs)
-        latent = torch.eye(
-            self.num_mixtures, dtype=torch.float, device=self.device
-        ).unsqueeze(1).expand(self.num_mixtures, batch_size, self.num_mixtures)
-        log_evidence = self.get_log_evidence(obs)
-        log_joint = self.get_log_prob(latent, obs)
-        log_posterior = log_joint - log_evidence
-        return torch.exp(log_posterior).t()
+        return F.softmax(self.get_log_joint_table(obs), dim=1)
 
 
 class InferenceNetwork(nn.Module):
+    """Args:
+        num_mixtures: int
+        relaxed_one_hot: if True, q is a Concrete distribution
+        temperature: float; temperature of the Concrete distribution
+        device: torch.device
+        index_latents: if True, latents are int64 mixture indices (see
+            GenerativeModel); can't be used with relaxed_one_hot
+    """
+
     def __init__(self, num_mixtures, relaxed_one_hot=False, temperature=None,
-                 device=torch.device('cpu')):
+                 device=torch.device('cpu'), index_latents=False):
         super(InferenceNetwork, self).__init__()
+        if relaxed_one_hot and index_latents:
+            raise ValueError('Relaxed one-hot latents can\'t be indices')
         self.num_mixtures = num_mixtures
         self.mlp = nn.Sequential(
             nn.Linear(1, 16),
@@ -121,6 +163,7 @@ class InferenceNetwork(nn.Module):
             nn.Linear(16, self.num_mixtures),
             nn.Softmax(dim=1))
         self.relaxed_one_hot = relaxed_one_hot
+        self.index_latents = index_latents
         if temperature is not None:
             self.temperature = torch.tensor(temperature, device=device,
                                             dtype=torch.float)
@@ -143,12 +186,14 @@ class InferenceNetwork(nn.Module):
             obs: tensor of shape [batch_size]
 
         Returns: distribution with batch shape [batch_size] and event shape
-            [num_mixtures]
+            [num_mixtures] (or [] if index_latents)
         """
         probs = self.get_latent_params(obs)
         if self.relaxed_one_hot:
             return torch.distributions.RelaxedOneHotCategorical(
                 self.temperature, probs=probs)
+        elif self.index_latents:
+            return torch.distributions.Categorical(probs=probs)
         else:
             return torch.distributions.OneHotCategorical(probs=probs)
 
@@ -163,7 +208,9 @@ class InferenceNetwork(nn.Module):
                 Concrete)
 
         Returns:
-            latent: tensor of shape [num_samples, batch_size, num_mixtures]
+            latent: tensor of shape [num_samples, batch_size, num_mixtures] or
+                int64 tensor of shape [num_samples, batch_size] if
+                index_latents
         """
         if reparam:
             return latent_dist.rsample((num_samples,))
@@ -175,8 +222,10 @@ class InferenceNetwork(nn.Module):
 
         Args:
             latent_dist: distribution with batch shape [batch_size] and event
-                shape [num_mixtures]
+                shape [num_mixtures] (or [] if index_latents)
             latent: tensor of shape [dim1, ..., dimN, batch_size, num_mixtures]
+                or int64 tensor of shape [dim1, ..., dimN, batch_size] if
+                index_latents
 
         Returns: tensor of shape [dim1, ..., dimN, batch_size]
         """
@@ -188,6 +237,8 @@ class InferenceNetwork(nn.Module):
 
         Args:
             latent: tensor of shape [dim1, ..., dimN, batch_size, num_mixtures]
+                or int64 tensor of shape [dim1, ..., dimN, batch_size] if
+                index_latents
             obs: tensor of shape [batch_size]
 
         Returns: tensor of shape [dim1, ..., dimN, batch_size]
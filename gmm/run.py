@@ -12,7 +12,6 @@ def run(args):
         args.device = torch.device('cuda')
     else:
         args.device = torch.device('cpu')
-    args.num_mixtures = 20
     if args.init_near:
         args.init_mixture_logits = np.ones(args.num_mixtures)
     else:
@@ -25,6 +24,8 @@ def run(args):
     else:
         args.relaxed_one_hot = False
         args.temperature = None
+    if args.index_latents and args.train_mode in ['concrete', 'relax']:
+        raise ValueError('{} needs one-hot latents'.format(args.train_mode))
     temp = np.arange(args.num_mixtures) + 5
     true_p_mixture_probs = temp / np.sum(temp)
     args.true_mixture_logits = \
@@ -126,6 +127,11 @@ if __name__ == '__main__':
                         help=' ')
     parser.add_argument('--num-particles', type=int, default=2,
                         help=' ')
+    parser.add_argument('--num-mixtures', type=int, default=20,
+                        help=' ')
+    parser.add_argument('--index-latents', action='store_true',
+                        help='represent latents as int64 mixture indices '
+                             'instead of one-hot vectors')
     parser.add_argument('--init-near', action='store_true',
                         help='initialize model so that data distribution is '
                              'close to the true data distribution')
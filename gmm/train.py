@@ -1,5 +1,6 @@
 import torch
 import losses
+import estimators
 import util
 import itertools
 
@@ -15,17 +16,17 @@ def train_wake_sleep(generative_model, inference_network,
         # generate synthetic data
         obs = true_generative_model.sample_obs(batch_size)
 
-        # wake theta
         optimizer_phi.zero_grad()
         optimizer_theta.zero_grad()
+
+        # wake theta; the loss doesn't reach phi (see
+        # losses.get_wake_theta_loss) so phi's gradients stay zero
         wake_theta_loss, elbo = losses.get_wake_theta_loss(
             generative_model, inference_network, obs, num_particles)
         wake_theta_loss.backward()
         optimizer_theta.step()
 
-        # sleep phi
-        optimizer_phi.zero_grad()
-        optimizer_theta.zero_grad()
+        # sleep phi; samples of the updated generative model
         sleep_phi_loss = losses.get_sleep_loss(
             generative_model, inference_network, num_samples)
         sleep_phi_loss.backward()
@@ -56,6 +57,7 @@ class TrainWakeSleepCallback():
         self.elbo_history = []
         self.p_error_history = []
         self.q_error_history = []
+        self.q_kl_history = []
         self.grad_std_history = []
 
     def __call__(self, iteration, wake_theta_loss, sleep_phi_loss, elbo,
@@ -79,8 +81,10 @@ class TrainWakeSleepCallback():
         if iteration % self.eval_interval == 0:
             self.p_error_history.append(util.get_p_error(
                 self.true_generative_model, generative_model))
-            self.q_error_history.append(util.get_q_error(
-                self.true_generative_model, inference_network, self.test_obs))
+            q_error, q_kl = util.get_q_error(
+                self.true_generative_model, inference_network, self.test_obs)
+            self.q_error_history.append(q_error)
+            self.q_kl_history.append(q_kl)
             stats = util.OnlineMeanStd()
             for _ in range(10):
                 inference_network.zero_grad()
@@ -91,9 +95,9 @@ class TrainWakeSleepCallback():
             self.grad_std_history.append(stats.avg_of_means_stds()[1])
             util.print_with_time(
                 'Iteration {} p_error = {:.3f}, q_error_to_true = '
-                '{:.3f}'.format(
+                '{:.3f}, q_kl_to_true = {:.3f}'.format(
                     iteration, self.p_error_history[-1],
-                    self.q_error_history[-1]))
+                    self.q_error_history[-1], self.q_kl_history[-1]))
 
 
 def train_wake_wake(generative_model, inference_network,
@@ -106,23 +110,17 @@ def train_wake_wake(generative_model, inference_network,
         # generate synthetic data
         obs = true_generative_model.sample_obs(batch_size)
 
-        log_weight, log_q = losses.get_log_weight_and_log_q(
+        log_p, log_q = losses.get_log_p_and_log_q(
             generative_model, inference_network, obs, num_particles)
 
-        # wake theta
+        # wake theta and wake phi; the losses depend on disjoint parameters
+        # so a single backward pass gives the gradients of both
         optimizer_phi.zero_grad()
         optimizer_theta.zero_grad()
-        wake_theta_loss, elbo = losses.get_wake_theta_loss_from_log_weight(
-            log_weight)
-        wake_theta_loss.backward(retain_graph=True)
+        wake_theta_loss, wake_phi_loss, elbo = estimators.get_wake_losses(
+            log_p, log_q)
+        (wake_theta_loss + wake_phi_loss).backward()
         optimizer_theta.step()
-
-        # wake phi
-        optimizer_phi.zero_grad()
-        optimizer_theta.zero_grad()
-        wake_phi_loss = losses.get_wake_phi_loss_from_log_weight_and_log_q(
-            log_weight, log_q)
-        wake_phi_loss.backward()
         optimizer_phi.step()
 
         if callback is not None:
@@ -143,15 +141,15 @@ def train_defensive_wake_wake(delta, generative_model, inference_network,
         # generate synthetic data
         obs = true_generative_model.sample_obs(batch_size)
 
-        log_weight, log_q = losses.get_log_weight_and_log_q(
+        log_p, log_q = losses.get_log_p_and_log_q(
             generative_model, inference_network, obs, num_particles)
 
         # wake theta
         optimizer_phi.zero_grad()
         optimizer_theta.zero_grad()
-        wake_theta_loss, elbo = losses.get_wake_theta_loss_from_log_weight(
-            log_weight)
-        wake_theta_loss.backward(retain_graph=True)
+        wake_theta_loss, elbo = estimators.get_wake_theta_loss(
+            log_p, log_q.detach())
+        wake_theta_loss.backward()
         optimizer_theta.step()
 
         # wake phi
@@ -187,6 +185,7 @@ class TrainWakeWakeCallback():
         self.elbo_history = []
         self.p_error_history = []
         self.q_error_history = []
+        self.q_kl_history = []
         self.grad_std_history = []
 
     def __call__(self, iteration, wake_theta_loss, wake_phi_loss, elbo,
@@ -210,8 +209,10 @@ class TrainWakeWakeCallback():
         if iteration % self.eval_interval == 0:
             self.p_error_history.append(util.get_p_error(
                 self.true_generative_model, generative_model))
-            self.q_error_history.append(util.get_q_error(
-                self.true_generative_model, inference_network, self.test_obs))
+            q_error, q_kl = util.get_q_error(
+                self.true_generative_model, inference_network, self.test_obs)
+            self.q_error_history.append(q_error)
+            self.q_kl_history.append(q_kl)
             stats = util.OnlineMeanStd()
             for _ in range(10):
                 inference_network.zero_grad()
@@ -223,9 +224,9 @@ class TrainWakeWakeCallback():
             self.grad_std_history.append(stats.avg_of_means_stds()[1])
             util.print_with_time(
                 'Iteration {} p_error = {:.3f}, q_error_to_true = '
-                '{:.3f}'.format(
+                '{:.3f}, q_kl_to_true = {:.3f}'.format(
                     iteration, self.p_error_history[-1],
-                    self.q_error_history[-1]))
+                    self.q_error_history[-1], self.q_kl_history[-1]))
 
 
 class TrainDefensiveWakeWakeCallback():
@@ -246,6 +247,7 @@ class TrainDefensiveWakeWakeCallback():
         self.elbo_history = []
         self.p_error_history = []
         self.q_error_history = []
+        self.q_kl_history = []
         self.grad_std_history = []
 
     def __call__(self, iteration, wake_theta_loss, wake_phi_loss, elbo,
@@ -269,8 +271,10 @@ class TrainDefensiveWakeWakeCallback():
         if iteration % self.eval_interval == 0:
             self.p_error_history.append(util.get_p_error(
                 self.true_generative_model, generative_model))
-            self.q_error_history.append(util.get_q_error(
-                self.true_generative_model, inference_network, self.test_obs))
+            q_error, q_kl = util.get_q_error(
+                self.true_generative_model, inference_network, self.test_obs)
+            self.q_error_history.append(q_error)
+            self.q_kl_history.append(q_kl)
             stats = util.OnlineMeanStd()
             for _ in range(10):
                 inference_network.zero_grad()
@@ -282,9 +286,9 @@ class TrainDefensiveWakeWakeCallback():
             self.grad_std_history.append(stats.avg_of_means_stds()[1])
             util.print_with_time(
                 'Iteration {} p_error = {:.3f}, q_error_to_true = '
-                '{:.3f}'.format(
+                '{:.3f}, q_kl_to_true = {:.3f}'.format(
                     iteration, self.p_error_history[-1],
-                    self.q_error_history[-1]))
+                    self.q_error_history[-1], self.q_kl_history[-1]))
 
 
 def train_iwae(algorithm, generative_model, inference_network,
@@ -342,6 +346,7 @@ class TrainIwaeCallback():
         self.elbo_history = []
         self.p_error_history = []
         self.q_error_history = []
+        self.q_kl_history = []
         self.grad_std_history = []
 
     def __call__(self, iteration, loss, elbo, generative_model,
@@ -362,8 +367,10 @@ class TrainIwaeCallback():
         if iteration % self.eval_interval == 0:
             self.p_error_history.append(util.get_p_error(
                 self.true_generative_model, generative_model))
-            self.q_error_history.append(util.get_q_error(
-                self.true_generative_model, inference_network, self.test_obs))
+            q_error, q_kl = util.get_q_error(
+                self.true_generative_model, inference_network, self.test_obs)
+            self.q_error_history.append(q_error)
+            self.q_kl_history.append(q_kl)
             stats = util.OnlineMeanStd()
             for _ in range(10):
                 inference_network.zero_grad()
@@ -380,9 +387,9 @@ class TrainIwaeCallback():
             self.grad_std_history.append(stats.avg_of_means_stds()[1])
             util.print_with_time(
                 'Iteration {} p_error = {:.3f}, q_error_to_true = '
-                '{:.3f}'.format(
+                '{:.3f}, q_kl_to_true = {:.3f}'.format(
                     iteration, self.p_error_history[-1],
-                    self.q_error_history[-1]))
+                    self.q_error_history[-1], self.q_kl_history[-1]))
 
 
 class TrainConcreteCallback():
@@ -401,6 +408,7 @@ class TrainConcreteCallback():
         self.elbo_history = []
         self.p_error_history = []
         self.q_error_history = []
+        self.q_kl_history = []
         self.grad_std_history = []
         self.num_iterations = num_iterations
         self.init_temperature = 3
@@ -430,8 +438,10 @@ class TrainConcreteCallback():
         if iteration % self.eval_interval == 0:
             self.p_error_history.append(util.get_p_error(
                 self.true_generative_model, generative_model))
-            self.q_error_history.append(util.get_q_error(
-                self.true_generative_model, inference_network, self.test_obs))
+            q_error, q_kl = util.get_q_error(
+                self.true_generative_model, inference_network, self.test_obs)
+            self.q_error_history.append(q_error)
+            self.q_kl_history.append(q_kl)
             stats = util.OnlineMeanStd()
             for _ in range(10):
                 inference_network.zero_grad()
@@ -443,9 +453,9 @@ class TrainConcreteCallback():
             self.grad_std_history.append(stats.avg_of_means_stds()[1])
             util.print_with_time(
                 'Iteration {} p_error = {:.3f}, q_error_to_true = '
-                '{:.3f}'.format(
+                '{:.3f}, q_kl_to_true = {:.3f}'.format(
                     iteration, self.p_error_history[-1],
-                    self.q_error_history[-1]))
+                    self.q_error_history[-1], self.q_kl_history[-1]))
 
 
 def train_relax(generative_model, inference_network, control_variate,
@@ -508,6 +518,7 @@ class TrainRelaxCallback():
         self.elbo_history = []
         self.p_error_history = []
         self.q_error_history = []
+        self.q_kl_history = []
         self.grad_std_history = []
 
     def __call__(self, iteration, loss, elbo, generative_model,
@@ -530,8 +541,10 @@ class TrainRelaxCallback():
         if iteration % self.eval_interval == 0:
             self.p_error_history.append(util.get_p_error(
                 self.true_generative_model, generative_model))
-            self.q_error_history.append(util.get_q_error(
-                self.true_generative_model, inference_network, self.test_obs))
+            q_error, q_kl = util.get_q_error(
+                self.true_generative_model, inference_network, self.test_obs)
+            self.q_error_history.append(q_error)
+            self.q_kl_history.append(q_kl)
             stats = util.OnlineMeanStd()
             for _ in range(10):
                 inference_network.zero_grad()
@@ -543,6 +556,6 @@ class TrainRelaxCallback():
             self.grad_std_history.append(stats.avg_of_means_stds()[1])
             util.print_with_time(
                 'Iteration {} p_error = {:.3f}, q_error_to_true = '
-                '{:.3f}'.format(
+                '{:.3f}, q_kl_to_true = {:.3f}'.format(
                     iteration, self.p_error_history[-1],
-                    self.q_error_history[-1]))
+                    self.q_error_history[-1], self.q_kl_history[-1]))
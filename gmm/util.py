@@ -140,13 +140,15 @@ def load_models(model_folder='.', iteration=None):
     if os.path.exists(generative_model_path):
         args = load_object(get_args_path(model_folder))
 
+        # args saved before index latents existed don't have index_latents
+        index_latents = getattr(args, 'index_latents', False)
         generative_model = models.GenerativeModel(
             args.init_mixture_logits,
-            softmax_multiplier=args.softmax_multiplier, device=args.device
-        ).to(device=args.device)
+            softmax_multiplier=args.softmax_multiplier, device=args.device,
+            index_latents=index_latents).to(device=args.device)
         inference_network = models.InferenceNetwork(
             args.num_mixtures, args.relaxed_one_hot, args.temperature,
-            args.device).to(device=args.device)
+            args.device, index_latents).to(device=args.device)
         generative_model.load_state_dict(torch.load(generative_model_path))
         print_with_time('Loaded from {}'.format(generative_model_path))
         inference_network.load_state_dict(torch.load(inference_network_path))
@@ -184,15 +186,18 @@ def load_control_variate(model_folder='.', iteration=None):
 def init_models(args):
     """Returns: generative_model, inference_network, true_generative_model"""
 
+    index_latents = getattr(args, 'index_latents', False)
     generative_model = models.GenerativeModel(
         args.init_mixture_logits, softmax_multiplier=args.softmax_multiplier,
-        device=args.device).to(device=args.device)
+        device=args.device, index_latents=index_latents
+    ).to(device=args.device)
     inference_network = models.InferenceNetwork(
         args.num_mixtures, args.relaxed_one_hot, args.temperature,
-        args.device).to(device=args.device)
+        args.device, index_latents).to(device=args.device)
     true_generative_model = models.GenerativeModel(
         args.true_mixture_logits, softmax_multiplier=args.softmax_multiplier,
-        device=args.device).to(device=args.device)
+        device=args.device, index_latents=index_latents
+    ).to(device=args.device)
 
     return generative_model, inference_network, true_generative_model
 
@@ -253,10 +258,63 @@ def get_p_error(true_generative_model, generative_model):
                       true_generative_model.get_latent_params()).item()
 
 
-def get_q_error(true_generative_model, inference_network, obs):
-    p_probs = true_generative_model.get_posterior_probs(obs)
-    q_probs = inference_network.get_latent_params(obs)
-    return torch.mean(torch.norm(p_probs - q_probs, p=2, dim=1)).item()
+def get_exact_posterior(generative_model, obs, inference_network=None,
+                        chunk_size=None):
+    """Exact log evidence, posterior and KL(p(z | x) || q(z | x)) from the
+    [batch_size, num_mixtures] table of log joints, chunk_size obs at a time.
+    q is evaluated once per chunk too.
+
+    Args:
+        generative_model: models.GenerativeModel object
+        obs: tensor of shape [batch_size]
+        inference_network: models.InferenceNetwork object or None
+        chunk_size: int or None to do the whole batch at once
+
+    Returns:
+        log_evidence: tensor of shape [batch_size]
+        posterior_probs: tensor of shape [batch_size, num_mixtures]
+        q_probs: tensor of shape [batch_size, num_mixtures] or None if
+            inference_network is None
+        kl: tensor of shape [batch_size] or None if inference_network is None
+    """
+    if chunk_size is None:
+        chunk_size = len(obs)
+    log_evidences, posterior_probss, q_probss, kls = [], [], [], []
+    for obs_chunk in torch.split(obs, chunk_size):
+        log_joint = generative_model.get_log_joint_table(obs_chunk)
+        log_evidence = torch.logsumexp(log_joint, dim=1)
+        log_posterior = log_joint - log_evidence.unsqueeze(-1)
+        posterior_probs = torch.exp(log_posterior)
+        log_evidences.append(log_evidence)
+        posterior_probss.append(posterior_probs)
+        if inference_network is not None:
+            q_probs = inference_network.get_latent_params(obs_chunk)
+            log_q = torch.log(q_probs)
+            q_probss.append(q_probs)
+            # 0 * log 0 = 0 where the posterior probability underflows
+            kls.append(torch.sum(torch.where(
+                posterior_probs > 0, posterior_probs * (log_posterior - log_q),
+                torch.zeros_like(posterior_probs)), dim=1))
+
+    if inference_network is None:
+        q_probs, kl = None, None
+    else:
+        q_probs, kl = torch.cat(q_probss), torch.cat(kls)
+    return torch.cat(log_evidences), torch.cat(posterior_probss), q_probs, kl
+
+
+def get_q_error(true_generative_model, inference_network, obs,
+                chunk_size=None):
+    """Returns:
+        q_error: mean over obs of the L2 distance between the probabilities of
+            the true posterior and q
+        q_kl: mean over obs of KL(true posterior || q)
+    """
+    with torch.no_grad():
+        _, p_probs, q_probs, kl = get_exact_posterior(
+            true_generative_model, obs, inference_network, chunk_size)
+    return (torch.mean(torch.norm(p_probs - q_probs, p=2, dim=1)).item(),
+            torch.mean(kl).item())
 
 
 class OnlineMeanStd():
@@ -3,6 +3,7 @@ import torch
 import util
 import numpy as np
 import losses
+import estimators
 import matplotlib.pyplot as plt
 import seaborn as sns
 import argparse
@@ -32,16 +33,12 @@ def get_mean_stds(generative_model, inference_network, num_mc_samples, obs,
         avg_log_Q = torch.mean(log_Q)
         reinforce_one = torch.mean(log_evidence.detach() * log_Q)
         reinforce = reinforce_one + avg_log_evidence
-        vimco_one = 0
-        for i in range(num_particles):
-            log_weight_ = log_weight[:, util.range_except(num_particles, i)]
-            control_variate = torch.logsumexp(
-                torch.cat([log_weight_, torch.mean(log_weight_, dim=1,
-                                                   keepdim=True)], dim=1),
-                dim=1)
-            vimco_one = vimco_one + (log_evidence.detach() -
-                                     control_variate.detach()) * log_q[:, i]
-        vimco_one = torch.mean(vimco_one)
+        # not divided by num_particles, unlike in estimators.get_vimco_loss
+        control_variate = estimators.get_vimco_control_variate(
+            log_weight) + np.log(num_particles)
+        vimco_one = torch.mean(torch.sum(
+            (log_evidence.detach().unsqueeze(-1) - control_variate) * log_q,
+            dim=1))
         vimco = vimco_one + avg_log_evidence
         normalized_weight = util.exponentiate_and_normalize(log_weight, dim=1)
         wake_phi_loss = torch.mean(
@@ -0,0 +1,420 @@
+import torch
+import itertools
+import util
+
+
+def get_production_log_probs(generative_model):
+    """Returns: dict whose keys are non-terminals and values are log
+        probabilities of their productions (tensors of shape
+        [num_productions])"""
+
+    return {non_terminal: torch.log_softmax(logits, dim=0)
+            for non_terminal, logits in
+            generative_model.production_logits.items()}
+
+
+def logsumexp(values, dim=0):
+    """torch.logsumexp whose gradient is zero instead of nan where all values
+    are -inf (spans that a symbol can't derive)."""
+
+    all_minus_inf = torch.all(values == -float('inf'), dim=dim)
+    safe_values = torch.where(
+        all_minus_inf.unsqueeze(dim).expand_as(values),
+        torch.zeros_like(values), values)
+    result = torch.logsumexp(safe_values, dim=dim)
+    return torch.where(all_minus_inf, torch.full_like(result, -float('inf')),
+                       result)
+
+
+def get_unary_order(compiled_grammar):
+    """Orders non-terminals so that B comes before A for every unary
+    production A -> B.
+
+    Returns: list of non-terminals
+    """
+
+    unary_children = {
+        non_terminal: set(
+            production[0] for production in
+            compiled_grammar.productions[non_terminal]
+            if len(production) == 1 and
+            not compiled_grammar.is_terminal(production[0]))
+        for non_terminal in compiled_grammar.non_terminals}
+    order = []
+    while len(order) < len(unary_children):
+        ready = [non_terminal for non_terminal, children in
+                 unary_children.items()
+                 if non_terminal not in order and children <= set(order)]
+        if len(ready) == 0:
+            raise ValueError('Grammar has a cycle of unary productions')
+        order.extend(sorted(ready))
+    return order
+
+
+class InsideChart():
+    """Inside chart of a sentence under a PCFG whose p(sentence | tree) is 1
+    if the leaves of tree match the sentence and 0 otherwise (the non-ABC
+    likelihood in GenerativeModel.get_log_prob).
+
+    Entries are stored per span length and are vectorized over span starts:
+    inside[symbol][length] is a tensor of shape [len(sentence) - length + 1]
+    whose ith element is log p(symbol =>* sentence[i:i + length]). Every
+    production A -> s_1 ... s_m with m > 1 also gets prefix charts,
+    prefixes[(A, r)][k][length], of the log probability of s_1 ... s_k
+    deriving a span, which are what posterior sampling splits spans with.
+
+    Args:
+        compiled_grammar: util.CompiledGrammar object
+        production_log_probs: dict from get_production_log_probs
+        sentence: list of strings
+    """
+
+    def __init__(self, compiled_grammar, production_log_probs, sentence):
+        self.compiled_grammar = compiled_grammar
+        self.production_log_probs = production_log_probs
+        self.sentence = sentence
+        self.num_words = len(sentence)
+        self.inside = {symbol: [None] for symbol in compiled_grammar.symbols}
+        # production_scores[non_terminal][length] is a tensor of shape
+        # [num_productions, num_words - length + 1] of log p(production) +
+        # log inside of its right hand side
+        self.production_scores = {non_terminal: [None] for non_terminal in
+                                  compiled_grammar.non_terminals}
+        self.prefixes = {
+            (non_terminal, production_idx): [None, None] + [
+                [None] for _ in range(len(production) - 1)]
+            for non_terminal in compiled_grammar.non_terminals
+            for production_idx, production in enumerate(
+                compiled_grammar.productions[non_terminal])
+            if len(production) > 1}
+        self.unary_order = get_unary_order(compiled_grammar)
+
+        for length in range(1, self.num_words + 1):
+            self._fill(length)
+
+    def _num_starts(self, length):
+        return self.num_words - length + 1
+
+    def _get_prefix(self, non_terminal, production_idx, k, length):
+        """Log probability of the first k symbols of a production deriving
+        spans of the given length; tensor of shape [num_starts]"""
+
+        if k == 1:
+            production = self.compiled_grammar.productions[non_terminal][
+                production_idx]
+            return self.inside[production[0]][length]
+        else:
+            return self.prefixes[(non_terminal, production_idx)][k][length]
+
+    def _get_split_scores(self, non_terminal, production_idx, k, length):
+        """Scores of splitting spans of the given length between the first
+        k - 1 symbols and the kth symbol of a production.
+
+        Returns: tensor of shape [length - 1, num_starts] whose [d - 1, i]
+            element is log p(s_1 ... s_{k - 1} =>* sentence[i:i + d]) +
+            log p(s_k =>* sentence[i + d:i + length])
+        """
+
+        symbol = self.compiled_grammar.productions[non_terminal][
+            production_idx][k - 1]
+        num_starts = self._num_starts(length)
+        return torch.stack([
+            self._get_prefix(non_terminal, production_idx, k - 1, d)[
+                :num_starts] +
+            self.inside[symbol][length - d][d:d + num_starts]
+            for d in range(1, length)])
+
+    def _fill(self, length):
+        num_starts = self._num_starts(length)
+        minus_inf = torch.full((num_starts,), -float('inf'))
+
+        # terminals
+        for terminal in self.compiled_grammar.terminals:
+            if length == 1:
+                self.inside[terminal].append(torch.tensor(
+                    [0. if word == terminal else -float('inf')
+                     for word in self.sentence]))
+            else:
+                self.inside[terminal].append(minus_inf)
+
+        # prefixes of productions with more than one symbol only involve
+        # shorter spans
+        for (non_terminal, production_idx), prefixes in \
+                self.prefixes.items():
+            for k in range(2, len(prefixes)):
+                if length < k:
+                    prefixes[k].append(minus_inf)
+                else:
+                    prefixes[k].append(logsumexp(
+                        self._get_split_scores(non_terminal, production_idx,
+                                               k, length), dim=0))
+
+        # non-terminals; unary productions A -> B need B's inside of the same
+        # length, hence the order
+        for non_terminal in self.unary_order:
+            productions = self.compiled_grammar.productions[non_terminal]
+            log_probs = self.production_log_probs[non_terminal]
+            scores = torch.stack([
+                log_probs[production_idx] + self._get_prefix(
+                    non_terminal, production_idx, len(production), length)
+                for production_idx, production in enumerate(productions)])
+            self.production_scores[non_terminal].append(scores)
+            self.inside[non_terminal].append(logsumexp(scores, dim=0))
+
+    def get_log_evidence(self):
+        """Returns: log p(sentence); scalar tensor"""
+
+        return self.inside[self.compiled_grammar.start_symbol][
+            self.num_words][0]
+
+    def _sample_split(self, non_terminal, production_idx, start, length):
+        """Samples how the symbols of a production split a span.
+
+        Returns: list of (symbol, start, length) tuples
+        """
+
+        production = self.compiled_grammar.productions[non_terminal][
+            production_idx]
+        spans = []
+        for k in range(len(production), 1, -1):
+            split_scores = self._get_split_scores(
+                non_terminal, production_idx, k, length)[:, start]
+            d = int(torch.distributions.Categorical(
+                logits=split_scores.detach()).sample()) + 1
+            spans.append((production[k - 1], start + d, length - d))
+            length = d
+        spans.append((production[0], start, length))
+        return spans[::-1]
+
+    def sample_tree(self, symbol=None, start=0, length=None):
+        """Samples a tree from the posterior p(tree | sentence).
+
+        Returns: list of lists or string
+        """
+
+        if symbol is None:
+            symbol = self.compiled_grammar.start_symbol
+            length = self.num_words
+        if self.compiled_grammar.is_terminal(symbol):
+            return symbol
+        production_idx = int(torch.distributions.Categorical(
+            logits=self.production_scores[symbol][length][:, start].detach()
+        ).sample())
+        return [symbol] + [
+            self.sample_tree(child_symbol, child_start, child_length)
+            for child_symbol, child_start, child_length in
+            self._sample_split(symbol, production_idx, start, length)]
+
+
+    def _get_splits(self, non_terminal, production_idx, start, length,
+                    k=None):
+        """All ways in which the first k symbols of a production (all of them
+        if k is None) can split a span.
+
+        Returns: list of lists of (symbol, start, length) tuples
+        """
+
+        production = self.compiled_grammar.productions[non_terminal][
+            production_idx]
+        if k is None:
+            k = len(production)
+        if k == 1:
+            return [[(production[0], start, length)]]
+        split_scores = self._get_split_scores(
+            non_terminal, production_idx, k, length)[:, start]
+        splits = []
+        for d in range(1, length):
+            if split_scores[d - 1] > -float('inf'):
+                for spans in self._get_splits(non_terminal, production_idx,
+                                              start, d, k - 1):
+                    splits.append(spans +
+                                  [(production[k - 1], start + d, length - d)])
+        return splits
+
+    def get_parses(self, symbol=None, start=0, length=None):
+        """Enumerates all trees whose leaves are the sentence (or the span of
+        the given symbol). Their number can grow exponentially with the
+        length of the sentence (see get_num_parses).
+
+        Returns: list of trees (list of lists or string)
+        """
+
+        if symbol is None:
+            symbol = self.compiled_grammar.start_symbol
+            length = self.num_words
+        if not self.inside[symbol][length][start] > -float('inf'):
+            return []
+        if self.compiled_grammar.is_terminal(symbol):
+            return [symbol]
+        parses = []
+        for production_idx, score in enumerate(
+                self.production_scores[symbol][length][:, start].tolist()):
+            if score == -float('inf'):
+                continue
+            for spans in self._get_splits(symbol, production_idx, start,
+                                          length):
+                parses.extend(
+                    [symbol] + list(children)
+                    for children in itertools.product(*[
+                        self.get_parses(child_symbol, child_start,
+                                        child_length)
+                        for child_symbol, child_start, child_length in
+                        spans]))
+        return parses
+
+
+def get_inside_chart(generative_model, sentence):
+    return InsideChart(generative_model.compiled_grammar,
+                       get_production_log_probs(generative_model), sentence)
+
+
+def get_log_evidence(generative_model, sentence):
+    """Exact log p(sentence) under the non-ABC likelihood; differentiable wrt
+    generative_model.production_logits.
+
+    Args:
+        generative_model: models.GenerativeModel object
+        sentence: list of strings
+
+    Returns: scalar tensor
+    """
+
+    return get_inside_chart(generative_model, sentence).get_log_evidence()
+
+
+def get_posterior_production_marginals(generative_model, sentence):
+    """Exact expected number of times each production is used under
+    p(tree | sentence). Uses the fact that the gradient of the log inside
+    probability wrt the production log probabilities is the outside pass.
+
+    Args:
+        generative_model: models.GenerativeModel object
+        sentence: list of strings
+
+    Returns: dict whose keys are non-terminals and values are tensors of
+        shape [num_productions]
+    """
+
+    production_log_probs = {
+        non_terminal: log_probs.detach().requires_grad_()
+        for non_terminal, log_probs in
+        get_production_log_probs(generative_model).items()}
+    non_terminals = list(production_log_probs.keys())
+    log_evidence = InsideChart(generative_model.compiled_grammar,
+                               production_log_probs,
+                               sentence).get_log_evidence()
+    marginals = torch.autograd.grad(
+        log_evidence, [production_log_probs[non_terminal]
+                       for non_terminal in non_terminals],
+        allow_unused=True)
+    return {non_terminal: torch.zeros_like(
+                production_log_probs[non_terminal]) if marginal is None
+            else marginal
+            for non_terminal, marginal in zip(non_terminals, marginals)}
+
+
+def get_num_parses(compiled_grammar, sentence):
+    """Number of parses of a sentence; the inside algorithm with all
+    production log probabilities set to zero.
+
+    Args:
+        compiled_grammar: util.CompiledGrammar object
+        sentence: list of strings
+
+    Returns: float
+    """
+
+    production_log_probs = {
+        non_terminal: torch.zeros(len(compiled_grammar.productions[
+            non_terminal]))
+        for non_terminal in compiled_grammar.non_terminals}
+    return torch.exp(InsideChart(compiled_grammar, production_log_probs,
+                                 sentence).get_log_evidence()).item()
+
+
+def get_test_sentences(generative_model, num_sentences=10,
+                       max_num_parses=100, max_num_attempts=1000, seed=0):
+    """Fixed set of sentences to evaluate get_q_error on. Sentences are
+    sampled from generative_model with their own seed (the global random
+    state is left untouched) and kept if they have at least one and at most
+    max_num_parses parses. If fewer than num_sentences of max_num_attempts
+    samples qualify, prints a warning and returns the ones that do.
+
+    Args:
+        generative_model: models.GenerativeModel object whose obs are
+            sentences
+        num_sentences: int
+        max_num_parses: int
+        max_num_attempts: int
+        seed: int
+
+    Returns: list of at most num_sentences sentences (lists of strings)
+    """
+
+    compiled_grammar = generative_model.compiled_grammar
+    sentences = []
+    with torch.random.fork_rng():
+        torch.manual_seed(seed)
+        for sentence in generative_model.sample_obss(max_num_attempts):
+            if len(sentences) == num_sentences:
+                break
+            if sentence not in sentences and all(
+                    compiled_grammar.is_terminal(word) for word in sentence) \
+                    and 1 <= get_num_parses(compiled_grammar, sentence) <= \
+                    max_num_parses:
+                sentences.append(sentence)
+    if len(sentences) < num_sentences:
+        util.print_with_time(
+            'Warning: only {} of {} test sentences have between 1 and {} '
+            'parses'.format(len(sentences), num_sentences, max_num_parses))
+    return sentences
+
+
+def get_kl(generative_model, inference_network, sentence):
+    """Exact KL(p(tree | sentence) || q(tree | sentence)) computed by
+    enumerating the parses of the sentence (InsideChart.get_parses), which
+    are the only trees with p(tree | sentence) > 0.
+
+    Args:
+        generative_model: models.GenerativeModel object
+        inference_network: models.InferenceNetwork object
+        sentence: list of strings
+
+    Returns: detached scalar tensor or None if the sentence has no parse
+    """
+
+    with torch.no_grad():
+        chart = get_inside_chart(generative_model, sentence)
+        log_evidence = chart.get_log_evidence()
+        if not torch.isfinite(log_evidence):
+            return None
+        trees = chart.get_parses()
+        log_posterior = generative_model.get_trees_log_prob(trees) - \
+            log_evidence
+        log_q = inference_network.score_trees(
+            trees, inference_network.get_obs_embeddings(
+                [sentence]).expand(len(trees), -1))
+        return torch.sum(torch.exp(log_posterior) * (log_posterior - log_q))
+
+
+def get_q_error(generative_model, inference_network, sentences):
+    """Average exact KL(p(tree | sentence) || q(tree | sentence)) over
+    sentences (e.g. from get_test_sentences). Unlike util.get_q_error, this
+    is deterministic and doesn't include the constant H(tree | sentence).
+    Sentences without a parse under generative_model are skipped with a
+    warning.
+
+    Returns: detached scalar tensor; nan if no sentence has a parse
+    """
+
+    kls = []
+    for sentence in sentences:
+        kl = get_kl(generative_model, inference_network, sentence)
+        if kl is None:
+            util.print_with_time('Warning: skipping sentence without a parse: '
+                                 '{}'.format(' '.join(sentence)))
+        else:
+            kls.append(kl)
+    if len(kls) == 0:
+        return torch.tensor(float('nan'))
+    return torch.mean(torch.stack(kls))
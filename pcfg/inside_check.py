@@ -0,0 +1,113 @@
+import itertools
+import os
+import torch
+import util
+import inside
+
+# compares inside.get_log_evidence, inside.get_posterior_production_marginals,
+# InsideChart.get_parses and inside.get_kl against brute force enumeration of
+# all parses of short sentences of the astronomers grammar. Runs on the CPU in
+# a few seconds: cd pcfg && python inside_check.py
+
+
+def get_splits(num_words, num_parts):
+    """All ways of splitting num_words words into num_parts non-empty
+    consecutive spans.
+
+    Returns: list of lists of (start, end) tuples
+    """
+
+    return [list(zip((0,) + ends, ends + (num_words,)))
+            for ends in itertools.combinations(range(1, num_words),
+                                               num_parts - 1)]
+
+
+def get_parses(grammar, symbol, words):
+    """Returns: list of all trees (list of lists or string) rooted at symbol
+        whose leaves are words"""
+
+    if symbol in grammar['terminals']:
+        return [symbol] if words == [symbol] else []
+    parses = []
+    for production in grammar['productions'][symbol]:
+        for split in get_splits(len(words), len(production)):
+            for children in itertools.product(*[
+                    get_parses(grammar, child_symbol, words[start:end])
+                    for child_symbol, (start, end) in zip(production, split)]):
+                parses.append([symbol] + list(children))
+    return parses
+
+
+def add_production_counts(grammar, tree, counts, weight):
+    if isinstance(tree, str):
+        return
+    symbol, children = tree[0], tree[1:]
+    production = [child if isinstance(child, str) else child[0]
+                  for child in children]
+    counts[symbol][grammar['productions'][symbol].index(production)] += weight
+    for child in children:
+        add_production_counts(grammar, child, counts, weight)
+
+
+util.set_seed(1)
+generative_model, inference_network, _ = util.init_models(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pcfgs',
+                 'astronomers_pcfg.json'))
+grammar = generative_model.grammar
+sentences = [['astronomers', 'saw', 'stars'],
+             ['astronomers', 'saw', 'stars', 'with', 'ears'],
+             ['astronomers', 'saw', 'stars', 'with', 'ears', 'with',
+              'telescopes'],
+             ['saw', 'saw', 'saw', 'with', 'saw', 'with', 'saw', 'with',
+              'saw'],
+             ['stars', 'astronomers'],
+             ['with']]
+
+for sentence in sentences:
+    parses = get_parses(grammar, grammar['start_symbol'], sentence)
+    if len(parses) == 0:
+        log_evidence = torch.tensor(-float('inf'))
+    else:
+        log_evidence = torch.logsumexp(
+            generative_model.get_trees_log_prob(parses), dim=0).detach()
+    log_evidence_inside = inside.get_log_evidence(generative_model,
+                                                  sentence).detach()
+    util.print_with_time(
+        '{} parses, log evidence = {:.4f}, inside = {:.4f}: {}'.format(
+            len(parses), log_evidence.item(), log_evidence_inside.item(),
+            ' '.join(sentence)))
+    if len(parses) == 0:
+        assert log_evidence_inside.item() == -float('inf')
+        assert inside.get_kl(generative_model, inference_network,
+                             sentence) is None
+        continue
+    assert torch.allclose(log_evidence, log_evidence_inside, atol=1e-4)
+    assert sorted(map(util.tree_to_string, parses)) == sorted(map(
+        util.tree_to_string,
+        inside.get_inside_chart(generative_model, sentence).get_parses()))
+
+    counts = {non_terminal: torch.zeros(len(productions))
+              for non_terminal, productions in grammar['productions'].items()}
+    for parse in parses:
+        add_production_counts(
+            grammar, parse, counts,
+            torch.exp(generative_model.get_tree_log_prob(parse).detach() -
+                      log_evidence))
+    marginals = inside.get_posterior_production_marginals(generative_model,
+                                                          sentence)
+    for non_terminal in grammar['non_terminals']:
+        assert torch.allclose(counts[non_terminal], marginals[non_terminal],
+                              atol=1e-4)
+
+    kl = 0
+    with torch.no_grad():
+        for parse in parses:
+            log_posterior = generative_model.get_tree_log_prob(parse) - \
+                log_evidence
+            log_q = inference_network.get_tree_log_prob(parse, obs=sentence)
+            kl += torch.exp(log_posterior) * (log_posterior - log_q)
+    kl_inside = inside.get_kl(generative_model, inference_network, sentence)
+    util.print_with_time('kl = {:.4f}, inside = {:.4f}'.format(
+        kl.item(), kl_inside.item()))
+    assert torch.allclose(kl, kl_inside, atol=1e-4)
+util.print_with_time('ok')
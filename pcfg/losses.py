@@ -1,18 +1,59 @@
 import torch
 import numpy as np
 import util
+import itertools
+import estimators
 
 
-def get_sleep_loss(generative_model, inference_network, num_samples=1):
-    """Returns:
+def get_sleep_loss(generative_model, inference_network, num_samples=1,
+                   replay_buffer=None):
+    """Args:
+        generative_model: models.GenerativeModel object
+        inference_network: models.InferenceNetwork object
+        num_samples: int
+        replay_buffer: util.SleepReplayBuffer or None; if given, it is
+            refilled and the samples are drawn from it and self-normalized
+            importance-weighted to the current prior instead of being sampled
+            afresh
+
+    Returns:
         loss: scalar that we call .backward() on and step the optimizer.
     """
-    log_q_sum = 0
-    for _ in range(num_samples):
-        tree, obs = generative_model.sample_tree_and_obs()
-        log_q = inference_network.get_tree_log_prob(tree, obs=obs)
-        log_q_sum = log_q_sum + log_q
-    return -log_q_sum / num_samples
+    if replay_buffer is not None:
+        replay_buffer.refill(generative_model)
+        trees, obss, grays, log_weights = replay_buffer.sample(
+            generative_model, num_samples)
+        if grays is None:
+            obs_embeddings = inference_network.get_obs_embeddings(obss)
+        else:
+            obs_embeddings = inference_network.get_gray_embeddings(grays)
+        return estimators.get_sleep_loss(
+            inference_network.score_trees(trees, obs_embeddings), log_weights)
+
+    trees, obss = generative_model.sample_trees_and_obss(num_samples)
+    return estimators.get_sleep_loss(inference_network.score_trees(
+        trees, inference_network.get_obs_embeddings(obss)))
+
+
+def get_log_p_and_log_q(generative_model, inference_network, obss,
+                        num_particles=1):
+    """Compute log joint of generative model and log prob of inference
+        network.
+
+    Args:
+        generative_model: models.GenerativeModel object
+        inference_network: models.InferenceNetwork object
+        obss: list of obs each of which is either a sentence (list of strings)
+            or ys (tensor of shape [100])
+        num_particles: int
+
+    Returns:
+        log_p: tensor of shape [num_obss, num_particles]
+        log_q: tensor of shape [num_obss, num_particles]
+    """
+    trees, log_q, _ = inference_network.sample_trees_and_log_probs(
+        obss, num_particles)
+    return get_log_p(generative_model, obss, trees), log_q
 
 
 def get_log_weight_and_log_q(generative_model, inference_network, obss,
@@ -30,30 +71,42 @@ def get_log_weight_and_log_q(generative_model, inference_network, obss,
         log_weight: tensor of shape [num_obss, num_particles]
         log_q: tensor of shape [num_obss, num_particles]
     """
-    log_weight = torch.zeros(len(obss), num_particles)
-    log_q = torch.zeros(len(obss), num_particles)
-    for obs_idx, obs in enumerate(obss):
-        for particle_idx in range(num_particles):
-            tree = inference_network.sample_tree(obs=obs)
-            log_q_ = inference_network.get_tree_log_prob(tree, obs=obs)
-            log_p_ = generative_model.get_log_prob(tree, obs)
-            log_weight[obs_idx, particle_idx] = log_p_ - log_q_
-            log_q[obs_idx, particle_idx] = log_q_
-    return log_weight, log_q
+    log_p, log_q = get_log_p_and_log_q(generative_model, inference_network,
+                                       obss, num_particles)
+    return log_p - log_q, log_q
 
 
-def get_wake_theta_loss_from_log_weight(log_weight):
-    """Args:
-        log_weight: tensor of shape [num_obs, num_particles]
+def get_log_p(generative_model, obss, trees):
+    """Joint log probabilities p(obs, tree) of the particles of each obs.
+    Particles are interned in a util.TreeInterner so that log p(tree) is
+    evaluated once per distinct tree in the batch and the likelihood once per
+    distinct tree of each obs; the results are scattered back to the
+    particles.
 
-    Returns:
-        loss: scalar that we call .backward() on and step the optimizer.
-        elbo: average elbo over data
+    Args:
+        generative_model: models.GenerativeModel object
+        obss: list of obs each of which is either a sentence (list of strings)
+            or ys (tensor of shape [100])
+        trees: list of lists of shape [num_obss, num_particles] of trees
+
+    Returns: tensor of shape [num_obss, num_particles]
     """
-    _, num_particles = log_weight.shape
-    log_evidence = torch.logsumexp(log_weight, dim=1) - np.log(num_particles)
-    elbo = torch.mean(log_evidence)
-    return -elbo, elbo
+
+    interner = util.TreeInterner()
+    tree_ids, inverse = interner.unique(
+        list(itertools.chain.from_iterable(trees)))
+    unique_trees = [interner.trees[tree_id] for tree_id in tree_ids]
+    unique_tree_log_p = generative_model.get_trees_log_prob(unique_trees)
+    inverse = inverse.view(len(obss), -1)
+
+    log_p = []
+    for obs_idx, obs in enumerate(obss):
+        obs_unique, obs_inverse = torch.unique(inverse[obs_idx],
+                                               return_inverse=True)
+        log_p.append(generative_model.get_log_probs(
+            [unique_trees[i] for i in obs_unique.tolist()], obs,
+            tree_log_probs=unique_tree_log_p[obs_unique])[obs_inverse])
+    return torch.stack(log_p)
 
 
 def get_wake_theta_loss(generative_model, inference_network, obss,
@@ -71,17 +124,11 @@ def get_wake_theta_loss(generative_model, inference_network, obss,
         loss: scalar that we call .backward() on and step the optimizer.
         elbo: average elbo over data
     """
-    log_weight, _ = get_log_weight_and_log_q(
-        generative_model, inference_network, obss, num_particles)
-    return get_wake_theta_loss_from_log_weight(log_weight)
-
-
-def get_wake_phi_loss_from_log_weight_and_log_q(log_weight, log_q):
-    """Returns:
-        loss: scalar that we call .backward() on and step the optimizer.
-    """
-    normalized_weight = util.exponentiate_and_normalize(log_weight, dim=1)
-    return torch.mean(-torch.sum(normalized_weight.detach() * log_q, dim=1))
+    log_p, log_q = get_log_p_and_log_q(generative_model, inference_network,
+                                       obss, num_particles)
+    # q is only the proposal here; detaching it leaves the gradients wrt the
+    # generative model unchanged and spares a backward pass through q
+    return estimators.get_wake_theta_loss(log_p, log_q.detach())
 
 
 def get_wake_phi_loss(generative_model, inference_network, obss,
@@ -97,9 +144,10 @@ def get_wake_phi_loss(generative_model, inference_network, obss,
     Returns:
         loss: scalar that we call .backward() on and step the optimizer.
     """
-    log_weight, log_q = get_log_weight_and_log_q(
-        generative_model, inference_network, obss, num_particles)
-    return get_wake_phi_loss_from_log_weight_and_log_q(log_weight, log_q)
+    log_p, log_q = get_log_p_and_log_q(generative_model, inference_network,
+                                       obss, num_particles)
+    wake_phi_loss, _ = estimators.get_wake_phi_loss(log_p, log_q)
+    return wake_phi_loss
 
 
 def get_reinforce_loss(generative_model, inference_network, obss,
@@ -116,16 +164,9 @@ def get_reinforce_loss(generative_model, inference_network, obss,
         loss: scalar that we call .backward() on and step the optimizer.
         elbo: average elbo over data
     """
-    log_weight, log_q = get_log_weight_and_log_q(
-        generative_model, inference_network, obss, num_particles)
-    log_evidence = torch.logsumexp(log_weight, dim=1) - np.log(num_particles)
-
-    # this is term 1 in equation (2) of https://arxiv.org/pdf/1805.10469.pdf
-    reinforce_correction = log_evidence.detach() * torch.sum(log_q, dim=1)
-
-    elbo = torch.mean(log_evidence)
-    loss = -elbo - torch.mean(reinforce_correction)
-    return loss, elbo
+    log_p, log_q = get_log_p_and_log_q(generative_model, inference_network,
+                                       obss, num_particles)
+    return estimators.get_reinforce_loss(log_p, log_q)
 
 
 def get_vimco_loss(generative_model, inference_network, obss,
@@ -142,25 +183,9 @@ def get_vimco_loss(generative_model, inference_network, obss,
         loss: scalar that we call .backward() on and step the optimizer.
         elbo: average elbo over data
     """
-    log_weight, log_q = get_log_weight_and_log_q(
-        generative_model, inference_network, obss, num_particles)
-    log_evidence = torch.logsumexp(log_weight, dim=1) - np.log(num_particles)
-    reinforce_correction = 0
-    for i in range(num_particles):
-        log_weight_ = log_weight[:, util.range_except(num_particles, i)]
-
-        # this is the B term in VIMCO gradient in
-        # https://arxiv.org/pdf/1805.10469.pdf
-        control_variate = torch.logsumexp(
-            torch.cat([log_weight_,
-                       torch.mean(log_weight_, dim=1, keepdim=True)], dim=1),
-            dim=1)
-        reinforce_correction = reinforce_correction + \
-            (log_evidence.detach() - control_variate.detach()) * log_q[:, i]
-
-    elbo = torch.mean(log_evidence)
-    loss = -elbo - torch.mean(reinforce_correction)
-    return loss, elbo
+    log_p, log_q = get_log_p_and_log_q(generative_model, inference_network,
+                                       obss, num_particles)
+    return estimators.get_vimco_loss(log_p, log_q)
 
 
 def get_relax_loss(generative_model, inference_network, control_variate, obss,
@@ -178,32 +203,16 @@ def get_relax_loss(generative_model, inference_network, control_variate, obss,
         loss: scalar that we call .backward() on and step the optimizer.
         elbo: average elbo over data
     """
-    log_weight = torch.zeros(len(obss), num_particles)
-    log_q = torch.zeros(len(obss), num_particles)
-    trees = util.empty_list_of_size(len(obss), num_particles)
-    trees_aux = util.empty_list_of_size(len(obss), num_particles)
-    trees_aux_tilde = util.empty_list_of_size(len(obss), num_particles)
-    trees_aux_tilde_detached = util.empty_list_of_size(
-        len(obss), num_particles)
-    c_obs_embeddings = util.empty_list_of_size(len(obss))
-    for obs_idx, obs in enumerate(obss):
-        c_obs_embeddings[obs_idx] = control_variate.get_obs_embedding(obs)
-        for particle_idx in range(num_particles):
-            trees[obs_idx][particle_idx], trees_aux[obs_idx][particle_idx], \
-                trees_aux_tilde[obs_idx][particle_idx] = \
-                inference_network.sample_tree_relax(obs=obs)
-            trees_aux_tilde_detached[obs_idx][particle_idx] = \
-                util.detach_tree_aux(trees_aux_tilde[obs_idx][particle_idx])
-            log_q_ = inference_network.get_tree_log_prob(
-                trees[obs_idx][particle_idx], obs=obs)
-            log_p_ = generative_model.get_log_prob(
-                trees[obs_idx][particle_idx], obs)
-            log_weight[obs_idx, particle_idx] = log_p_ - log_q_
-            log_q[obs_idx, particle_idx] = log_q_
-    c = control_variate(trees, trees_aux, c_obs_embeddings)
-    c_tilde = control_variate(trees, trees_aux_tilde, c_obs_embeddings)
-    c_tilde_detached_tree = control_variate(trees, trees_aux_tilde_detached,
-                                            c_obs_embeddings)
+    # each obs is embedded once and shared by all its particles
+    obs_embeddings = inference_network.get_obs_embeddings(obss)
+    c_obs_embeddings = control_variate.get_obs_embeddings(obss)
+    trees, log_q, forest, aux, aux_tilde = \
+        inference_network.sample_trees_relax(obss, num_particles,
+                                             obs_embeddings)
+    log_weight = get_log_p(generative_model, obss, trees) - log_q
+    c, c_tilde, c_tilde_detached_tree = control_variate.get_control_variates(
+        forest, torch.stack([aux, aux_tilde, aux_tilde.detach()]),
+        c_obs_embeddings, num_particles)
 
     log_evidence = torch.logsumexp(log_weight, dim=1) - np.log(num_particles)
     return -torch.mean(
@@ -3,14 +3,19 @@ import torch.nn as nn
 import util
 from torch.distributions import *
 import numpy as np
+import itertools
 
 
 class GenerativeModel(nn.Module):
-    def __init__(self, grammar, production_probs_init=None, max_depth=30):
+    def __init__(self, grammar, production_probs_init=None, max_depth=30,
+                 ys_cache_max_bytes=2**24, max_num_nodes=None):
         super(GenerativeModel, self).__init__()
         self.grammar = grammar
+        self.compiled_grammar = util.CompiledGrammar(grammar)
         if self.grammar['name'] == 'polynomial':
             self.xs = torch.linspace(-10, 10, 100)
+            # tree -> ys doesn't depend on the parameters
+            self.ys_cache = util.LRUCache(ys_cache_max_bytes)
         if production_probs_init is None:
             self.production_logits = nn.ParameterDict({
                 k: nn.Parameter(torch.randn((len(v),)))
@@ -20,6 +25,87 @@ class GenerativeModel(nn.Module):
                 k: nn.Parameter(torch.log(v))
                 for k, v in production_probs_init.items()})
         self.max_depth = max_depth
+        # budget of non-terminals per tree (see util.expand_frontier)
+        self.max_num_nodes = max_num_nodes
+        self.truncation_counts = util.init_truncation_counts()
+        # see get_sampling_table
+        self.sampling_table = None
+        self.sampling_table_logits = None
+
+    def get_sampling_table(self):
+        """Cumulative production probabilities of all non-terminals. The
+        table is cached and only recomputed when production_logits change.
+
+        Returns: tensor of shape [num_non_terminals, max_num_productions]
+            whose row i is the cumulative sum of the production probabilities
+            of compiled_grammar.non_terminals[i], padded with ones
+        """
+
+        with torch.no_grad():
+            logits = torch.cat([
+                self.production_logits[non_terminal]
+                for non_terminal in self.compiled_grammar.non_terminals])
+            if self.sampling_table is None or \
+                    not torch.equal(logits, self.sampling_table_logits):
+                self.sampling_table = torch.ones(
+                    (self.compiled_grammar.num_non_terminals,
+                     self.compiled_grammar.max_num_productions))
+                for i, non_terminal in enumerate(
+                        self.compiled_grammar.non_terminals):
+                    logits_ = self.production_logits[non_terminal]
+                    self.sampling_table[i, :len(logits_)] = torch.cumsum(
+                        torch.softmax(logits_, dim=0), dim=0)
+                self.sampling_table_logits = logits.clone()
+        return self.sampling_table
+
+    def sample_trees(self, num_trees, symbol=None, depth=0):
+        """Samples trees from prior. Instead of recursing, keeps a frontier of
+        the open non-terminals of all trees and expands it one depth level at
+        a time with one batch of uniform random numbers per level, looked up
+        in get_sampling_table.
+
+        Args:
+            num_trees: int
+            symbol: start symbol
+            depth: depth of symbol
+
+        Returns: list of num_trees trees (list of lists or string)
+        """
+
+        if symbol is None:
+            symbol = self.grammar['start_symbol']
+
+        if self.compiled_grammar.is_terminal(symbol) or depth > self.max_depth:
+            return [symbol for _ in range(num_trees)]
+
+        sampling_table = self.get_sampling_table()
+        trees = [[symbol] for _ in range(num_trees)]
+        nodes = list(trees)
+        tree_indices = list(range(num_trees))
+        num_nodes = [1 for _ in range(num_trees)]
+        truncated = {'max_depth': set(), 'max_num_nodes': set()}
+        while len(nodes) > 0:
+            non_terminal_indices = torch.tensor([
+                self.compiled_grammar.non_terminal_to_index[node[0]]
+                for node in nodes], dtype=torch.long)
+            u = torch.rand((len(nodes), 1))
+            # the last entry of a row may be just below 1 due to rounding
+            production_indices = torch.min(
+                torch.sum(u >= sampling_table[non_terminal_indices], dim=1),
+                self.compiled_grammar.num_productions[non_terminal_indices] -
+                1)
+
+            nodes, parent_indices, level_truncated = util.expand_frontier(
+                self.compiled_grammar, nodes, production_indices.tolist(),
+                tree_indices, depth, self.max_depth, num_nodes,
+                self.max_num_nodes)
+            tree_indices = [tree_indices[i] for i in parent_indices]
+            for reason, truncated_tree_indices in level_truncated.items():
+                truncated[reason] |= truncated_tree_indices
+            depth += 1
+        util.update_truncation_counts(self.truncation_counts, num_trees,
+                                      truncated)
+        return trees
 
     def sample_tree(self, symbol=None, depth=0):
         """Sample tree from prior.
@@ -28,37 +114,64 @@ class GenerativeModel(nn.Module):
         Returns: list of lists or string
         """
 
-        if symbol is None:
-            symbol = self.grammar['start_symbol']
+        return self.sample_trees(1, symbol, depth)[0]
 
-        if symbol in self.grammar['terminals']:
-            return symbol
-        elif depth > self.max_depth:
-            return symbol
-        else:
-            dist = Categorical(logits=self.production_logits[symbol])
-            production_index = dist.sample().detach()
-            production = self.grammar['productions'][symbol][production_index]
-            return [symbol] + \
-                [self.sample_tree(s, depth=depth + 1) for s in production]
+    def sample_trees_and_obss(self, num_samples):
+        """Samples (tree, obs) tuples from prior.
 
-    def sample_tree_and_obs(self):
-        """Samples a (tree, obs) tuple from prior."""
+        Returns:
+            trees: list of num_samples trees
+            obss: list of num_samples obs
+        """
 
-        tree = self.sample_tree()
+        trees = self.sample_trees(num_samples)
         if self.grammar['name'] == 'astronomers':
-            sentence = util.get_leaves(tree)
-            obs = sentence
+            obss = [util.get_leaves(tree) for tree in trees]
         elif self.grammar['name'] == 'polynomial':
-            ys = util.eval_polynomial(tree, self.xs)
-            obs = ys
-        return tree, obs
+            obss = list(self.get_yss(trees))
+        return trees, obss
+
+    def sample_tree_and_obs(self):
+        """Samples a (tree, obs) tuple from prior."""
+
+        trees, obss = self.sample_trees_and_obss(1)
+        return trees[0], obss[0]
+
+    def sample_obss(self, num_obss):
+        """Samples obss from prior."""
+
+        return self.sample_trees_and_obss(num_obss)[1]
 
     def sample_obs(self):
         """Samples obs from prior."""
 
         return self.sample_tree_and_obs()[1]
 
+    def get_production_log_probs(self):
+        """Log probabilities of all productions.
+
+        Returns: tensor of shape [num_total_productions] indexed by
+            CompiledGrammar global production ids
+        """
+
+        return torch.cat([
+            torch.log_softmax(self.production_logits[non_terminal], dim=0)
+            for non_terminal in self.compiled_grammar.non_terminals])
+
+    def get_trees_log_prob(self, trees):
+        """Log probabilities of many trees at once. log p(tree) is the dot
+        product of the tree's production-count vector with the production
+        log probabilities.
+
+        Args:
+            trees: list of N trees (list of lists or string or FlatTree)
+
+        Returns: tensor of shape [N]
+        """
+
+        return torch.mv(self.compiled_grammar.get_production_counts(trees),
+                        self.get_production_log_probs())
+
     def get_tree_log_prob(self, tree):
         """Log probability of tree.
 
@@ -68,19 +181,7 @@ class GenerativeModel(nn.Module):
         Returns: scalar tensor
         """
 
-        if isinstance(tree, list):
-            non_terminal = tree[0]
-            subtrees = tree[1:]
-            production = [util.get_root(subtree) for subtree in subtrees]
-            production_index = util.get_production_index(
-                non_terminal, production, self.grammar['productions'])
-            dist = Categorical(logits=self.production_logits[non_terminal])
-            log_prob = dist.log_prob(torch.tensor(production_index))
-            subtree_log_probs = [self.get_tree_log_prob(subtree)
-                                 for subtree in subtrees]
-            return log_prob + sum(subtree_log_probs)
-        else:
-            return torch.zeros(())
+        return self.get_trees_log_prob([tree])[0]
 
     def get_sentence_log_likelihood(self, sentence, tree):
         """Minus ABC distance instead of log p(sentence | tree). ABC distance
@@ -92,10 +193,24 @@ class GenerativeModel(nn.Module):
 
         Returns: scalar tensor"""
 
-        sentence_from_tree = util.get_leaves(tree)
-        levenshtein_distance = torch.tensor(
-            util.get_levenshtein_distance(sentence_from_tree, sentence,
-                                          self.grammar['terminals']),
+        return self.get_sentence_log_likelihoods(sentence, [tree])[0]
+
+    def get_sentence_log_likelihoods(self, sentence, trees):
+        """Batched version of get_sentence_log_likelihood. The observed
+        sentence is encoded once and the edit distances to the leaves of all
+        trees are computed in one call.
+
+        Args:
+            sentence: list of strings
+            trees: list of N trees (list of lists or string or FlatTree)
+
+        Returns: tensor of shape [N]"""
+
+        levenshtein_distances = torch.tensor(
+            util.get_levenshtein_distances(
+                [self.compiled_grammar.sentence_to_indices(
+                    util.get_leaves(tree)) for tree in trees],
+                self.compiled_grammar.sentence_to_indices(sentence)),
             dtype=torch.float)
         # if levenshtein_distance.item() == 0:
         #     return levenshtein_distance
@@ -103,7 +218,7 @@ class GenerativeModel(nn.Module):
         #     return torch.tensor(float('-inf'))
         # return -(torch.exp(levenshtein_distance) - 1)
         # return -levenshtein_distance
-        return -levenshtein_distance**2
+        return -levenshtein_distances**2
 
     def get_polynomial_log_likelihood(self, ys, tree):
         """Minus ABC distance instead of log p(ys | tree, xs) where xs is
@@ -116,22 +231,58 @@ class GenerativeModel(nn.Module):
         Returns: -log(1 + mse(ys, eval(tree))); scalar tensor
         """
 
-        return -torch.log(
-            1 + util.mse(ys, util.eval_polynomial(tree, self.xs)))
+        return self.get_polynomial_log_likelihoods(ys, [tree])[0]
+
+    def get_yss(self, trees):
+        """Polynomial trees evaluated at self.xs. Results are kept in
+        self.ys_cache and the trees that aren't cached are evaluated in one
+        pass by util.eval_polynomials.
+
+        Args:
+            trees: list of N trees (list of lists or string)
+
+        Returns: tensor of shape [N, 100]
+        """
+
+        def eval_trees(positions):
+            yss = util.eval_polynomials([trees[i] for i in positions],
+                                        self.xs)
+            return [ys.clone() for ys in yss]
+
+        return torch.stack(self.ys_cache.get_many(
+            [util.get_tree_key(tree) for tree in trees], eval_trees))
+
+    def get_polynomial_log_likelihoods(self, ys, trees):
+        """Batched version of get_polynomial_log_likelihood.
+
+        Args:
+            ys: torch.tensor of shape [100]
+            trees: list of N trees (list of lists or string)
+
+        Returns: tensor of shape [N]
+        """
+
+        return -torch.log(1 + torch.mean((ys - self.get_yss(trees))**2,
+                                         dim=1))
 
-    def get_log_prob(self, tree, obs):
+    def get_log_prob(self, tree, obs, tree_log_prob=None):
         """Joint log probability p(obs, tree).
 
         Args:
             tree: list of lists or string
             obs: sentence (list of strings) or ys (torch.tensor of shape [100])
+            tree_log_prob: scalar tensor; log p(tree) if it is already known
+                (e.g. from InferenceNetwork.sample_trees_and_log_probs)
 
         Returns: scalar tensor
         """
 
+        if tree_log_prob is None:
+            tree_log_prob = self.get_tree_log_prob(tree)
+
         if self.grammar['name'] == 'astronomers':
             sentence = obs
-            return self.get_tree_log_prob(tree) + \
+            return tree_log_prob + \
                 self.get_sentence_log_likelihood(sentence, tree)
 
             # The following is the non-ABC version for which p(sentence | tree)
@@ -143,18 +294,50 @@ class GenerativeModel(nn.Module):
             #     return torch.tensor(float('-inf'))
         elif self.grammar['name'] == 'polynomial':
             ys = obs
-            return self.get_tree_log_prob(tree) + \
+            return tree_log_prob + \
                 self.get_polynomial_log_likelihood(ys, tree)
 
+    def get_log_probs(self, trees, obs, tree_log_probs=None):
+        """Joint log probabilities p(obs, tree) of many trees and one obs.
+
+        Args:
+            trees: list of N trees (list of lists or string)
+            obs: sentence (list of strings) or ys (torch.tensor of shape [100])
+            tree_log_probs: tensor of shape [N]; log p(tree) if already known
+
+        Returns: tensor of shape [N]
+        """
+
+        if tree_log_probs is None:
+            tree_log_probs = self.get_trees_log_prob(trees)
+
+        if self.grammar['name'] == 'astronomers':
+            sentence = obs
+            return tree_log_probs + \
+                self.get_sentence_log_likelihoods(sentence, trees)
+        elif self.grammar['name'] == 'polynomial':
+            ys = obs
+            return tree_log_probs + \
+                self.get_polynomial_log_likelihoods(ys, trees)
+
 
 class InferenceNetwork(nn.Module):
     def __init__(self, grammar, obs_embedding_dim=100,
-                 inference_hidden_dim=100, max_depth=30):
+                 inference_hidden_dim=100, max_depth=30,
+                 gray_cache_max_bytes=2**28, max_num_nodes=None,
+                 max_levenshtein_distance=None):
         super(InferenceNetwork, self).__init__()
         self.grammar = grammar
+        self.compiled_grammar = util.CompiledGrammar(grammar)
         self.obs_embedding_dim = obs_embedding_dim
         self.inference_hidden_dim = inference_hidden_dim
         self.max_depth = max_depth
+        # budget of non-terminals per particle (see util.expand_frontier)
+        self.max_num_nodes = max_num_nodes
+        # particles of the astronomers grammar whose leaves are already
+        # farther than this from the sentence stop being expanded
+        self.max_levenshtein_distance = max_levenshtein_distance
+        self.truncation_counts = util.init_truncation_counts()
         self.sample_address_embedding_dim = len(grammar['non_terminals'])
         self.word_embedding_dim = len(self.grammar['terminals'])
 
@@ -165,6 +348,8 @@ class InferenceNetwork(nn.Module):
                 num_layers=1)
         elif grammar['name'] == 'polynomial':
             self.xs = torch.linspace(-10, 10, 100)
+            # ys -> image doesn't depend on the parameters
+            self.gray_cache = util.LRUCache(gray_cache_max_bytes)
             self.gray_embedder_cnn = nn.Sequential(
                 nn.Conv2d(1, 20, 3),
                 nn.ReLU(),
@@ -204,9 +389,17 @@ class InferenceNetwork(nn.Module):
         Returns: tensor of shape [obs_embedding_dim]
         """
 
-        output, _ = self.sentence_embedder_gru(util.sentence_to_one_hots(
-            sentence, self.grammar['terminals']).unsqueeze(1))
-        return output[-1][0]
+        return self.get_sentence_embeddings([sentence])[0]
+
+    def get_sentence_embeddings(self, sentences):
+        """Args:
+            sentences: list of sentences each of which is a list of strings
+
+        Returns: tensor of shape [num_sentences, obs_embedding_dim]
+        """
+
+        return util.get_gru_sentence_embeddings(
+            self.sentence_embedder_gru, sentences, self.compiled_grammar)
 
     def get_ys_embedding(self, ys):
         """Args:
@@ -215,10 +408,43 @@ class InferenceNetwork(nn.Module):
         Returns: tensor of shape [obs_embedding_dim]
         """
 
-        gray = util.xsys2gray(self.xs, ys)
+        return self.get_ys_embeddings(ys.unsqueeze(0))[0]
+
+    def get_grays(self, yss):
+        """Renders (cached in self.gray_cache) ys as images.
+
+        Args:
+            yss: tensor of shape [num_ys, 100]
+
+        Returns: tensor of shape [num_ys, 100, 100]
+        """
+
+        def render(positions):
+            grays = util.xsys2gray(self.xs, yss[positions])
+            return [gray.clone() for gray in grays]
+
+        return torch.stack(self.gray_cache.get_many(
+            [util.get_tensor_key(ys) for ys in yss], render))
+
+    def get_gray_embeddings(self, grays):
+        """Args:
+            grays: tensor of shape [num_grays, 100, 100]
+
+        Returns: tensor of shape [num_grays, obs_embedding_dim]
+        """
+
         input_to_mlp = self.gray_embedder_cnn(
-            gray.view(1, 1, 100, 100)).view(-1).squeeze(0)
-        return self.gray_embedder_mlp(input_to_mlp).squeeze(0)
+            grays.view(-1, 1, 100, 100)).view(len(grays), -1)
+        return self.gray_embedder_mlp(input_to_mlp)
+
+    def get_ys_embeddings(self, yss):
+        """Args:
+            yss: tensor of shape [num_ys, 100]
+
+        Returns: tensor of shape [num_ys, obs_embedding_dim]
+        """
+
+        return self.get_gray_embeddings(self.get_grays(yss))
 
     def get_obs_embedding(self, obs):
         """Args:
@@ -234,6 +460,24 @@ class InferenceNetwork(nn.Module):
             ys = obs
             return self.get_ys_embedding(ys)
 
+    def get_obs_embeddings(self, obss):
+        """Embeds each obs once so that the result can be shared by all
+            particles (sampling, scoring and relax) of a step.
+
+        Args:
+            obss: list of obs each of which is either a sentence (list of
+                strings) or ys (tensor of shape [100])
+
+        Returns: tensor of shape [num_obss, obs_embedding_dim]
+        """
+
+        if self.grammar['name'] == 'astronomers':
+            sentences = obss
+            return self.get_sentence_embeddings(sentences)
+        elif self.grammar['name'] == 'polynomial':
+            yss = torch.stack(obss)
+            return self.get_ys_embeddings(yss)
+
     def get_logits_from_inference_gru_output(self, inference_gru_output,
                                              non_terminal):
         """Args:
@@ -251,8 +495,7 @@ class InferenceNetwork(nn.Module):
 
         Returns: one hot vector of shape [sample_embedding_dim]
         """
-        return util.one_hot(torch.tensor([production_index]),
-                            self.sample_embedding_dim)[0]
+        return self.compiled_grammar.get_sample_embedding(production_index)
 
     def get_inference_gru_output(self, obs_embedding,
                                  previous_sample_embedding,
@@ -298,16 +541,17 @@ class InferenceNetwork(nn.Module):
 
         if isinstance(tree, list):
             non_terminal = tree[0]
-            sample_address_embedding = util.get_sample_address_embedding(
-                non_terminal, self.grammar['non_terminals'])
+            sample_address_embedding = \
+                self.compiled_grammar.get_sample_address_embedding(
+                    non_terminal)
             inference_gru_output = self.get_inference_gru_output(
                 obs_embedding, previous_sample_embedding,
                 sample_address_embedding, inference_hidden)
 
             subtrees = tree[1:]
             production = [util.get_root(subtree) for subtree in subtrees]
-            production_index = util.get_production_index(
-                non_terminal, production, self.grammar['productions'])
+            production_index = self.compiled_grammar.get_production_index(
+                non_terminal, production)
             sample_embedding = self.get_sample_embedding(production_index)
             logits = self.get_logits_from_inference_gru_output(
                 inference_gru_output, non_terminal)
@@ -321,127 +565,404 @@ class InferenceNetwork(nn.Module):
         else:
             return torch.zeros(())
 
-    def sample_tree(self, symbol=None, obs_embedding=None,
-                    previous_sample_embedding=None, inference_hidden=None,
-                    obs=None, depth=0):
-        """Samples a tree given a obs and a start symbol (can be terminal
-            or non-terminal).
+    def score_trees(self, trees, obs_embeddings):
+        """Teacher-forced, batched version of get_tree_log_prob. Since the
+            trees are given, the inputs of every node are known in advance,
+            so all nodes at the same depth (across all trees) go through
+            inference_gru in one call and through the proposal layer of their
+            non-terminal in one call per non-terminal.
 
         Args:
-            symbol: string
-            obs_embedding: tensor [obs_embedding_dim]
-            previous_sample_embedding: tensor [sample_embedding_dim]
-            inference_hidden: tensor [inference_hidden_dim]
-            obs: sentence (list of strings) or ys (torch.tensor of shape [100])
+            trees: list of N trees (list of lists or string)
+            obs_embeddings: tensor of shape [N, obs_embedding_dim]; the ith
+                row is the embedding of the obs of trees[i]
 
-        Returns: tree
+        Returns: tensor of shape [N] of log q(tree | obs)
         """
 
-        if symbol is None:
-            symbol = self.grammar['start_symbol']
+        log_q = torch.zeros(len(trees))
+        # frontier of non-terminal nodes; nodes[i] is a subtree of
+        # trees[tree_indices[i]]
+        nodes, tree_indices = [], []
+        for tree_idx, tree in enumerate(trees):
+            if isinstance(tree, list):
+                nodes.append(tree)
+                tree_indices.append(tree_idx)
+        tree_indices = torch.tensor(tree_indices, dtype=torch.long)
+        previous_sample_embeddings = torch.zeros(
+            (len(nodes), self.sample_embedding_dim))
+        inference_hiddens = torch.zeros(
+            (len(nodes), self.inference_hidden_dim))
+        while len(nodes) > 0:
+            symbols = [node[0] for node in nodes]
+            production_indices = torch.tensor([
+                self.compiled_grammar.get_production_index(
+                    symbol, [util.get_root(subtree) for subtree in node[1:]])
+                for node, symbol in zip(nodes, symbols)], dtype=torch.long)
+            sample_address_embeddings = \
+                self.compiled_grammar.sample_address_embeddings[
+                    torch.tensor([
+                        self.compiled_grammar.non_terminal_to_index[symbol]
+                        for symbol in symbols], dtype=torch.long)]
+            inference_gru_outputs = self.inference_gru(
+                torch.cat([obs_embeddings[tree_indices],
+                           previous_sample_embeddings,
+                           sample_address_embeddings], dim=1),
+                inference_hiddens)
+
+            for symbol, node_indices in util.group_indices(symbols).items():
+                node_indices = torch.tensor(node_indices)
+                log_probs = torch.log_softmax(self.proposal_layers[symbol](
+                    inference_gru_outputs[node_indices]), dim=1)
+                log_q = log_q.index_add(
+                    0, tree_indices[node_indices],
+                    log_probs.gather(
+                        1, production_indices[node_indices].unsqueeze(-1)
+                    ).squeeze(-1))
+            sample_embeddings = self.compiled_grammar.sample_embeddings[
+                production_indices]
+
+            child_nodes, parent_indices = [], []
+            for node_idx, node in enumerate(nodes):
+                for subtree in node[1:]:
+                    if isinstance(subtree, list):
+                        child_nodes.append(subtree)
+                        parent_indices.append(node_idx)
+            parent_indices = torch.tensor(parent_indices, dtype=torch.long)
+            nodes = child_nodes
+            tree_indices = tree_indices[parent_indices]
+            previous_sample_embeddings = sample_embeddings[parent_indices]
+            inference_hiddens = inference_gru_outputs[parent_indices]
+
+        return log_q
+
+    def expand_frontier(self, obss, num_particles, flat_trees, nodes,
+                        production_indices, tree_indices, depth, num_nodes,
+                        truncated):
+        """util.expand_frontier with the node budget of self.max_num_nodes
+            and, for the astronomers grammar, early termination of particles
+            whose leaf prefix is already more than max_levenshtein_distance
+            away from their sentence (see util.get_leaf_prefix). The open
+            nodes of terminated particles are left unexpanded.
 
-        if obs_embedding is None:
-            obs_embedding = self.get_obs_embedding(obs)
+        Args:
+            obss: list of obs
+            num_particles: int
+            flat_trees: list of num_obss * num_particles (partial) trees
+            nodes: list of open nodes
+            production_indices: list of ints; production of each node
+            tree_indices: list of ints; index in flat_trees of the tree of
+                each node
+            depth: int; depth of nodes
+            num_nodes: list of ints (see util.expand_frontier); updated in
+                place
+            truncated: dict where key is a truncation reason and value is a
+                set of indices of truncated trees; updated in place
 
-        if previous_sample_embedding is None:
-            previous_sample_embedding = torch.zeros(
-                (self.sample_embedding_dim,))
+        Returns:
+            child_nodes: list of open child nodes
+            parent_indices: long tensor of positions in nodes of the parents
+                of child_nodes
+        """
 
-        if inference_hidden is None:
-            inference_hidden = torch.zeros((self.inference_hidden_dim,))
+        child_nodes, parent_indices, level_truncated = util.expand_frontier(
+            self.compiled_grammar, nodes, production_indices, tree_indices,
+            depth, self.max_depth, num_nodes, self.max_num_nodes)
+        for reason, truncated_tree_indices in level_truncated.items():
+            truncated[reason] |= truncated_tree_indices
+
+        if self.max_levenshtein_distance is not None and \
+                self.grammar['name'] == 'astronomers' and \
+                len(child_nodes) > 0:
+            child_tree_indices = [tree_indices[parent_idx]
+                                  for parent_idx in parent_indices]
+            open_tree_indices = sorted(set(child_tree_indices))
+            hopeless = set()
+            for obs_idx, positions in util.group_indices(
+                    [tree_idx // num_particles
+                     for tree_idx in open_tree_indices]).items():
+                group_tree_indices = [open_tree_indices[position]
+                                      for position in positions]
+                bounds = util.get_levenshtein_distances(
+                    [self.compiled_grammar.sentence_to_indices(
+                        util.get_leaf_prefix(flat_trees[tree_idx]))
+                     for tree_idx in group_tree_indices],
+                    self.compiled_grammar.sentence_to_indices(obss[obs_idx]),
+                    prefix=True)
+                hopeless.update(
+                    tree_idx for tree_idx, bound in
+                    zip(group_tree_indices, bounds)
+                    if bound > self.max_levenshtein_distance)
+            if len(hopeless) > 0:
+                truncated['levenshtein'] |= hopeless
+                kept = []
+                for i, (child_node, parent_idx, tree_idx) in enumerate(
+                        zip(child_nodes, parent_indices, child_tree_indices)):
+                    if tree_idx in hopeless:
+                        parent = nodes[parent_idx]
+                        parent[next(j for j, s in enumerate(parent)
+                                    if s is child_node)] = child_node[0]
+                    else:
+                        kept.append(i)
+                child_nodes = [child_nodes[i] for i in kept]
+                parent_indices = [parent_indices[i] for i in kept]
+
+        return child_nodes, torch.tensor(parent_indices, dtype=torch.long)
+
+    def sample_trees(self, obss, num_particles=1, obs_embeddings=None):
+        """Samples num_particles trees for each obs. Instead of recursing
+            node by node, keeps a frontier of open non-terminals of all trees
+            and expands the whole frontier at once, one depth level per step.
 
-        if symbol in self.grammar['terminals']:
-            return symbol
-        elif depth > self.max_depth:
-            return symbol
-        else:
-            sample_address_embedding = util.get_sample_address_embedding(
-                symbol, self.grammar['non_terminals'])
-            inference_gru_output = self.get_inference_gru_output(
-                obs_embedding, previous_sample_embedding,
-                sample_address_embedding, inference_hidden)
-            logits = self.get_logits_from_inference_gru_output(
-                inference_gru_output, symbol)
-            dist = Categorical(logits=logits)
-            production_index = dist.sample().detach()
-            sample_embedding = self.get_sample_embedding(production_index)
-            production = self.grammar['productions'][symbol][production_index]
+        Args:
+            obss: list of obs each of which is either a sentence (list of
+                strings) or ys (tensor of shape [100])
+            num_particles: int
+            obs_embeddings: tensor of shape [num_obss, obs_embedding_dim]
+                from get_obs_embeddings(obss) or None to compute it here
 
-            return [symbol] + [
-                self.sample_tree(s, obs_embedding, sample_embedding,
-                                 inference_gru_output, depth=depth + 1)
-                for s in production]
+        Returns: list of lists of trees of shape [num_obss, num_particles]
+        """
 
-    def sample_tree_relax(self, symbol=None, obs_embedding=None,
-                          previous_sample_embedding=None,
-                          inference_hidden=None, obs=None, depth=0):
-        """Samples a tree given a obs and a start symbol (can be terminal
-            or non-terminal).
+        return self.sample_trees_and_log_probs(
+            obss, num_particles, obs_embeddings=obs_embeddings)[0]
+
+    def sample_trees_and_log_probs(self, obss, num_particles=1,
+                                   generative_model=None,
+                                   obs_embeddings=None):
+        """Samples num_particles trees for each obs (like sample_trees) and
+            scores them during the same traversal so that they don't have to
+            be re-walked by get_tree_log_prob.
 
         Args:
-            symbol: string
-            obs_embedding: tensor [obs_embedding_dim]
-            previous_sample_embedding: tensor [sample_embedding_dim]
-            inference_hidden: tensor [inference_hidden_dim]
-            obs: sentence (list of strings) or ys (torch.tensor of shape [100])
+            obss: list of obs each of which is either a sentence (list of
+                strings) or ys (tensor of shape [100])
+            num_particles: int
+            generative_model: models.GenerativeModel object or None
+            obs_embeddings: tensor of shape [num_obss, obs_embedding_dim]
+                from get_obs_embeddings(obss) or None to compute it here
 
         Returns:
-            tree: e.g.
-                ['S', ['NP', 'astronomers'],
-                      ['VP', ['V' 'saw'],
-                             ['NP' 'stars']]]
-                or 'stars'
-            tree_aux: e.g.
-                [[0.5], [[.9, 1., .2, .1, -.1, .1], None],
-                        [[-0.3 0.8], [[0.3], None]
-                                     [[.9, -.1, .2, .1, 1., .1], None]]]
-                or None
-            tree_aux_tilde: similar to tree_aux
+            trees: list of lists of trees of shape [num_obss, num_particles]
+            log_q: tensor of shape [num_obss, num_particles]; differentiable
+                wrt the inference network parameters
+            tree_log_p: tensor of shape [num_obss, num_particles] of log prior
+                probabilities of trees under generative_model or None if
+                generative_model is None
         """
 
-        if symbol is None:
-            symbol = self.grammar['start_symbol']
+        num_trees = len(obss) * num_particles
+        log_q = torch.zeros(num_trees)
+        tree_log_p = None if generative_model is None else \
+            torch.zeros(num_trees)
 
-        if obs_embedding is None:
-            obs_embedding = self.get_obs_embedding(obs)
+        start_symbol = self.grammar['start_symbol']
+        if start_symbol in self.grammar['terminals']:
+            trees = [[start_symbol for _ in range(num_particles)]
+                     for _ in obss]
+        else:
+            if obs_embeddings is None:
+                obs_embeddings = self.get_obs_embeddings(obss)
+            trees = [[[start_symbol] for _ in range(num_particles)]
+                     for _ in obss]
+
+            # frontier of open non-terminals; nodes[i] is the (initially
+            # childless) list of the i-th open non-terminal in the frontier
+            # and tree_indices[i] is the flat index of the tree it belongs to
+            flat_trees = list(itertools.chain.from_iterable(trees))
+            nodes = list(flat_trees)
+            tree_indices = torch.arange(num_trees)
+            num_nodes = [1 for _ in range(num_trees)]
+            truncated = {'max_depth': set(), 'max_num_nodes': set(),
+                         'levenshtein': set()}
+            previous_sample_embeddings = torch.zeros(
+                (len(nodes), self.sample_embedding_dim))
+            inference_hiddens = torch.zeros(
+                (len(nodes), self.inference_hidden_dim))
+            depth = 0
+            while len(nodes) > 0:
+                symbols = [node[0] for node in nodes]
+                sample_address_embeddings = \
+                    self.compiled_grammar.sample_address_embeddings[
+                        torch.tensor([
+                            self.compiled_grammar.non_terminal_to_index[symbol]
+                            for symbol in symbols], dtype=torch.long)]
+                inference_gru_outputs = self.inference_gru(
+                    torch.cat([obs_embeddings[tree_indices // num_particles],
+                               previous_sample_embeddings,
+                               sample_address_embeddings], dim=1),
+                    inference_hiddens)
+
+                production_indices = torch.zeros(len(nodes),
+                                                 dtype=torch.long)
+                for symbol, node_indices in \
+                        util.group_indices(symbols).items():
+                    node_indices = torch.tensor(node_indices)
+                    dist = Categorical(logits=self.proposal_layers[symbol](
+                        inference_gru_outputs[node_indices]))
+                    group_production_indices = dist.sample().detach()
+                    production_indices[node_indices] = \
+                        group_production_indices
+                    log_q = log_q.index_add(
+                        0, tree_indices[node_indices],
+                        dist.log_prob(group_production_indices))
+                    if generative_model is not None:
+                        tree_log_p = tree_log_p.index_add(
+                            0, tree_indices[node_indices],
+                            torch.log_softmax(
+                                generative_model.production_logits[symbol],
+                                dim=0)[group_production_indices])
+                sample_embeddings = self.compiled_grammar.sample_embeddings[
+                    production_indices]
+
+                nodes, parent_indices = self.expand_frontier(
+                    obss, num_particles, flat_trees, nodes,
+                    production_indices.tolist(), tree_indices.tolist(), depth,
+                    num_nodes, truncated)
+                tree_indices = tree_indices[parent_indices]
+                previous_sample_embeddings = sample_embeddings[parent_indices]
+                inference_hiddens = inference_gru_outputs[parent_indices]
+                depth += 1
+            util.update_truncation_counts(self.truncation_counts, num_trees,
+                                          truncated)
+
+        log_q = log_q.view(len(obss), num_particles)
+        if tree_log_p is not None:
+            tree_log_p = tree_log_p.view(len(obss), num_particles)
+        return trees, log_q, tree_log_p
+
+    def sample_trees_relax(self, obss, num_particles=1, obs_embeddings=None):
+        """Samples trees given obss with the REBAR noise of every production
+            choice (Appendix C in the REBAR paper). Like
+            sample_trees_and_log_probs, expands the frontier of open
+            non-terminals of all trees one depth level at a time; the logits
+            of a level are zero-padded to max_num_productions and the REBAR
+            noise of the whole level is drawn by one util.sample_relax_batch
+            call.
 
-        if previous_sample_embedding is None:
-            previous_sample_embedding = torch.zeros(
-                (self.sample_embedding_dim,))
+        Args:
+            obss: list of obs each of which is either a sentence (list of
+                strings) or ys (tensor of shape [100])
+            num_particles: int
+            obs_embeddings: tensor of shape [num_obss, obs_embedding_dim]
+                from get_obs_embeddings(obss) or None to compute it here
 
-        if inference_hidden is None:
-            inference_hidden = torch.zeros((self.inference_hidden_dim,))
+        Returns:
+            trees: list of lists of trees of shape [num_obss, num_particles]
+            log_q: tensor of shape [num_obss, num_particles]
+            forest: util.Forest object of the expanded nodes of trees in the
+                order in which they were expanded
+            aux: tensor of shape [len(forest), sample_embedding_dim] whose
+                rows are the zero-padded tree_aux entries of the nodes of
+                forest
+            aux_tilde: same as aux for tree_aux_tilde
+        """
 
-        if symbol in self.grammar['terminals']:
-            return symbol, None, None
-        elif depth > self.max_depth:
-            return symbol, None, None
+        num_trees = len(obss) * num_particles
+        log_q = torch.zeros(num_trees)
+        start_symbol = self.grammar['start_symbol']
+        if start_symbol in self.grammar['terminals']:
+            trees = [[start_symbol for _ in range(num_particles)]
+                     for _ in obss]
+            nodes = []
         else:
-            sample_address_embedding = util.get_sample_address_embedding(
-                symbol, self.grammar['non_terminals'])
-            inference_gru_output = self.get_inference_gru_output(
-                obs_embedding, previous_sample_embedding,
-                sample_address_embedding, inference_hidden)
-            logits = self.get_logits_from_inference_gru_output(
-                inference_gru_output, symbol)
-            oh_production_index, production_index_aux, \
-                production_index_aux_tilde = util.sample_relax(logits=logits)
-            production_index = torch.argmax(oh_production_index)
-            sample_embedding = self.get_sample_embedding(production_index)
-            production = self.grammar['productions'][symbol][production_index]
-
-            tree = [symbol]
-            tree_aux = [production_index_aux]
-            tree_aux_tilde = [production_index_aux_tilde]
-            for s in production:
-                subtree, subtree_aux, subtree_aux_tilde = \
-                    self.sample_tree_relax(
-                        s, obs_embedding, sample_embedding,
-                        inference_gru_output, depth=depth + 1)
-                tree.append(subtree)
-                tree_aux.append(subtree_aux)
-                tree_aux_tilde.append(subtree_aux_tilde)
-            return tree, tree_aux, tree_aux_tilde
+            if obs_embeddings is None:
+                obs_embeddings = self.get_obs_embeddings(obss)
+            trees = [[[start_symbol] for _ in range(num_particles)]
+                     for _ in obss]
+            nodes = list(itertools.chain.from_iterable(trees))
+        flat_trees = list(nodes)
+        num_nodes = [1 for _ in range(num_trees)]
+        truncated = {'max_depth': set(), 'max_num_nodes': set(),
+                     'levenshtein': set()}
+
+        # per level tensors of the expanded nodes
+        forest_tree_indices, forest_parents, forest_depths, \
+            forest_symbol_ids, auxs, aux_tildes = [], [], [], [], [], []
+        tree_indices = torch.arange(len(nodes))
+        parents = torch.full((len(nodes),), -1, dtype=torch.long)
+        previous_sample_embeddings = torch.zeros(
+            (len(nodes), self.sample_embedding_dim))
+        inference_hiddens = torch.zeros(
+            (len(nodes), self.inference_hidden_dim))
+        num_expanded = 0
+        depth = 0
+        while len(nodes) > 0:
+            symbols = [node[0] for node in nodes]
+            non_terminal_indices = torch.tensor([
+                self.compiled_grammar.non_terminal_to_index[symbol]
+                for symbol in symbols], dtype=torch.long)
+            inference_gru_outputs = self.inference_gru(
+                torch.cat([obs_embeddings[tree_indices // num_particles],
+                           previous_sample_embeddings,
+                           self.compiled_grammar.sample_address_embeddings[
+                               non_terminal_indices]], dim=1),
+                inference_hiddens)
+
+            # logits of all nodes padded to sample_embedding_dim
+            groups = util.group_indices(symbols)
+            logits = torch.cat([
+                nn.functional.pad(
+                    self.proposal_layers[symbol](
+                        inference_gru_outputs[node_indices]),
+                    (0, self.sample_embedding_dim -
+                     len(self.grammar['productions'][symbol])))
+                for symbol, node_indices in groups.items()])
+            order = torch.tensor(list(itertools.chain.from_iterable(
+                groups.values())), dtype=torch.long)
+            logits = torch.zeros_like(logits).index_copy(0, order, logits)
+            mask = torch.arange(self.sample_embedding_dim).unsqueeze(0) < \
+                self.compiled_grammar.num_productions[
+                    non_terminal_indices].unsqueeze(-1)
+
+            latent, aux, aux_tilde = util.sample_relax_batch(logits, mask)
+            production_indices = torch.argmax(latent, dim=1)
+            log_q = log_q.index_add(
+                0, tree_indices, torch.gather(
+                    torch.log_softmax(torch.where(
+                        mask, logits,
+                        torch.full_like(logits, -float('inf'))), dim=1),
+                    1, production_indices.unsqueeze(-1)).squeeze(-1))
+            sample_embeddings = self.compiled_grammar.sample_embeddings[
+                production_indices]
+
+            forest_tree_indices.append(tree_indices)
+            forest_parents.append(parents)
+            forest_depths.append(torch.full((len(nodes),), depth,
+                                            dtype=torch.long))
+            # non-terminal indices are also their symbol ids
+            forest_symbol_ids.append(non_terminal_indices)
+            auxs.append(aux)
+            aux_tildes.append(aux_tilde)
+
+            nodes, parent_indices = self.expand_frontier(
+                obss, num_particles, flat_trees, nodes,
+                production_indices.tolist(), tree_indices.tolist(), depth,
+                num_nodes, truncated)
+            tree_indices = tree_indices[parent_indices]
+            parents = parent_indices + num_expanded
+            num_expanded += len(symbols)
+            previous_sample_embeddings = sample_embeddings[parent_indices]
+            inference_hiddens = inference_gru_outputs[parent_indices]
+            depth += 1
+        if len(flat_trees) > 0:
+            util.update_truncation_counts(self.truncation_counts, num_trees,
+                                          truncated)
+
+        if num_expanded == 0:
+            forest = util.Forest(num_trees, *[torch.zeros(0, dtype=torch.long)
+                                              for _ in range(4)])
+            aux = torch.zeros((0, self.sample_embedding_dim))
+            aux_tilde = aux
+        else:
+            forest = util.Forest(num_trees, torch.cat(forest_tree_indices),
+                                 torch.cat(forest_parents),
+                                 torch.cat(forest_depths),
+                                 torch.cat(forest_symbol_ids))
+            aux = torch.cat(auxs)
+            aux_tilde = torch.cat(aux_tildes)
+        return trees, log_q.view(len(obss), num_particles), forest, aux, \
+            aux_tilde
 
 
 class ControlVariate(nn.Module):
@@ -449,6 +970,7 @@ class ControlVariate(nn.Module):
                  tree_obs_embedding_dim=100):
         super(ControlVariate, self).__init__()
         self.grammar = grammar
+        self.compiled_grammar = util.CompiledGrammar(grammar)
         self.obs_embedding_dim = obs_embedding_dim
         self.word_embedding_dim = len(self.grammar['terminals'])
         self.tree_obs_embedding_dim = tree_obs_embedding_dim
@@ -477,96 +999,132 @@ class ControlVariate(nn.Module):
         Returns: tensor of shape [obs_embedding_dim]
         """
 
-        output, _ = self.obs_embedder_gru(util.sentence_to_one_hots(
-            obs, self.grammar['terminals']).unsqueeze(1))
-        return output[-1][0]
+        return self.get_obs_embeddings([obs])[0]
 
-    def get_tree_obs_gru_output(self, obs_embedding, sample_embedding,
-                                sample_address_embedding, tree_obs_hidden):
+    def get_obs_embeddings(self, obss):
         """Args:
-            obs_embedding: tensor [obs_embedding_dim]
-            sample_embedding: tensor [sample_embedding_dim]
-            sample_address_embedding: tensor [sample_embedding_address_dim]
-            tree_obs_hidden: tensor [tree_obs_embedding_dim]
+            obss: list of obs each of which is a list of strings
 
-        Returns: tensor of shape [tree_obs_embedding_dim]
+        Returns: tensor of shape [num_obss, obs_embedding_dim]
         """
-        return self.tree_obs_embedder_gru(
-            torch.cat([obs_embedding,
-                       sample_embedding,
-                       sample_address_embedding]).unsqueeze(0),
-            tree_obs_hidden.unsqueeze(0)).squeeze(0)
 
-    def get_tree_obs_embedding(self, tree, tree_aux, obs_embedding):
-        """Args:
-            tree: e.g.
-                ['S', ['NP', 'astronomers'],
-                      ['VP', ['V' 'saw'],
-                             ['NP' 'stars']]]
-                or 'stars'
-            tree_aux: e.g.
-                [[0.5], [[.9, 1., .2, .1, -.1, .1], None],
-                        [[-0.3 0.8], [[0.3], None]
-                                     [[.9, -.1, .2, .1, 1., .1], None]]]
-                or None
-            obs_embedding: tensor of shape [obs_embedding_dim]
+        return util.get_gru_sentence_embeddings(
+            self.obs_embedder_gru, obss, self.compiled_grammar)
 
-        Returns: tensor of shape [tree_obs_embedding_dim]
-        """
+    def get_tree_obs_embeddings(self, forest, auxs, obs_embeddings):
+        """Embeds trees together with their obs: a node's embedding is
+            tree_obs_embedder_gru of (obs embedding, aux entry, sample address
+            embedding) with the sum of its children's embeddings as the hidden
+            state, and leaves embed to zero. All trees form one forest that
+            is encoded bottom-up, one depth level at a time, so that all nodes
+            of a level go through tree_obs_embedder_gru in one call. Several
+            aux variants of the same trees share the structure and are
+            stacked along the first dimension.
 
-        if isinstance(tree, list):
-            non_terminal = tree[0]
-            sample_address_embedding = util.get_sample_address_embedding(
-                non_terminal, self.grammar['non_terminals'])
-            sample_embedding = util.pad_zeros(tree_aux[0],
-                                              self.sample_embedding_dim)
-            subtrees = tree[1:]
-            subtrees_aux = tree_aux[1:]
-            tree_obs_hidden = 0
-            for subtree, subtree_aux in zip(subtrees, subtrees_aux):
-                tree_obs_hidden += self.get_tree_obs_embedding(
-                    subtree, subtree_aux, obs_embedding)
-            return self.get_tree_obs_gru_output(
-                obs_embedding, sample_embedding, sample_address_embedding,
-                tree_obs_hidden)
-        else:
-            return torch.zeros((self.tree_obs_embedding_dim,))
+        Args:
+            forest: util.Forest object of num_trees trees
+            auxs: tensor of shape [num_variants, len(forest),
+                sample_embedding_dim] whose rows are the (zero-padded) aux
+                entries of the nodes of forest
+            obs_embeddings: tensor of shape [num_trees, obs_embedding_dim];
+                the ith row is the embedding of the obs of the ith tree
+
+        Returns: tensor of shape
+            [num_variants, num_trees, tree_obs_embedding_dim]
+        """
 
-    def control_variate_single(self, tree, tree_aux, obs_embedding):
+        num_variants = len(auxs)
+        tree_obs_hiddens = torch.zeros(
+            (num_variants, len(forest), self.tree_obs_embedding_dim))
+        tree_obs_embeddings = torch.zeros(
+            (num_variants, forest.num_trees, self.tree_obs_embedding_dim))
+        if len(forest) == 0:
+            return tree_obs_embeddings
+        for depth in range(int(forest.depths.max()), -1, -1):
+            node_indices = torch.nonzero(forest.depths == depth).view(-1)
+            num_nodes = len(node_indices)
+            sample_address_embeddings = \
+                self.compiled_grammar.sample_address_embeddings[
+                    forest.symbol_ids[node_indices]]
+            inputs = torch.cat([
+                obs_embeddings[forest.tree_indices[node_indices]].expand(
+                    num_variants, -1, -1),
+                auxs[:, node_indices],
+                sample_address_embeddings.expand(num_variants, -1, -1)],
+                dim=2)
+            outputs = self.tree_obs_embedder_gru(
+                inputs.view(num_variants * num_nodes, -1),
+                tree_obs_hiddens[:, node_indices].reshape(
+                    num_variants * num_nodes, -1)).view(
+                        num_variants, num_nodes, -1)
+            if depth > 0:
+                tree_obs_hiddens = tree_obs_hiddens.index_add(
+                    1, forest.parents[node_indices], outputs)
+            else:
+                tree_obs_embeddings = tree_obs_embeddings.index_copy(
+                    1, forest.tree_indices[node_indices], outputs)
+        return tree_obs_embeddings
+
+    def get_control_variates(self, forest, auxs, obs_embeddings,
+                             num_particles):
         """Args:
-            tree: e.g.
-                ['S', ['NP', 'astronomers'],
-                      ['VP', ['V' 'saw'],
-                             ['NP' 'stars']]]
-                or 'stars'
-            tree_aux: e.g.
-                [[0.5], [[.9, 1., .2, .1, -.1, .1], None],
-                        [[-0.3 0.8], [[0.3], None]
-                                     [[.9, -.1, .2, .1, 1., .1], None]]]
-                or None
-            obs_embedding: tensor of shape [obs_embedding_dim]
+            forest: util.Forest object of num_obs * num_particles trees
+                (particles of the same obs are consecutive)
+            auxs: tensor of shape [num_variants, len(forest),
+                sample_embedding_dim]
+            obs_embeddings: tensor of shape [num_obs, obs_embedding_dim]
+            num_particles: int
+
+        Returns: tensor of shape [num_variants, num_obs]
+        """
 
-        Returns: scalar tensor
+        tree_obs_embeddings = self.get_tree_obs_embeddings(
+            forest, auxs,
+            obs_embeddings.repeat_interleave(num_particles, dim=0))
+        c = self.tree_obs_mlp(tree_obs_embeddings).view(
+            len(auxs), -1, num_particles)
+        return torch.logsumexp(c, dim=2) - np.log(num_particles)
+
+    def control_variates(self, trees, trees_auxs, obs_embeddings):
+        """Evaluates the control variate on several aux variants of the same
+            trees (e.g. tree_aux, tree_aux_tilde and its detached copy) as
+            one stacked batch.
+
+        Args:
+            trees: list of lists of shape [num_obs, num_particles]
+            trees_auxs: list of num_variants lists of lists of shape
+                [num_obs, num_particles] where each element is either a
+                tree_aux or tree_aux_tilde
+            obs_embeddings: list of tensors of length num_obs where each tensor
+                is of shape [obs_embedding_dim] or tensor of shape
+                [num_obs, obs_embedding_dim] (see get_obs_embeddings)
+
+        Returns: tensor of shape [num_variants, num_obs]
         """
-        return self.tree_obs_mlp(self.get_tree_obs_embedding(
-            tree, tree_aux, obs_embedding).unsqueeze(0)).squeeze(0)
+
+        if isinstance(obs_embeddings, list):
+            obs_embeddings = torch.stack(obs_embeddings)
+        forest, is_expanded = util.Forest.from_flat_trees([
+            util.FlatTree.from_tree(tree, self.compiled_grammar)
+            for tree in itertools.chain.from_iterable(trees)])
+        auxs = torch.stack([
+            torch.cat([util.flatten_tree_aux(tree_aux,
+                                             self.sample_embedding_dim)
+                       for tree_aux in itertools.chain.from_iterable(
+                           trees_aux)])[is_expanded]
+            for trees_aux in trees_auxs])
+        return self.get_control_variates(forest, auxs, obs_embeddings,
+                                         len(trees[0]))
 
     def forward(self, trees, trees_aux, obs_embeddings):
         """Args:
             trees_aux: list of lists of shape [num_obs, num_particles] where
                 each element is either a tree_aux or tree_aux_tilde
             obs_embeddings: list of tensors of length num_obs where each tensor
-                is of shape [obs_embedding_dim]
+                is of shape [obs_embedding_dim] or tensor of shape
+                [num_obs, obs_embedding_dim] (see get_obs_embeddings)
 
         Returns: tensor of shape [num_obs]
         """
 
-        num_obs = len(obs_embeddings)
-        num_particles = len(trees_aux[0])
-        c = torch.zeros(num_obs, num_particles)
-        for obs_idx in range(num_obs):
-            for particle_idx in range(num_particles):
-                c[obs_idx, particle_idx] = self.control_variate_single(
-                    trees[obs_idx][particle_idx],
-                    trees_aux[obs_idx][particle_idx], obs_embeddings[obs_idx])
-        return torch.logsumexp(c, dim=1) - np.log(num_particles)
+        return self.control_variates(trees, [trees_aux], obs_embeddings)[0]
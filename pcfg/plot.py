@@ -90,14 +90,22 @@ def load_errors():
                         seed_idx, train_mode_idx,
                         num_particles_idx, :len(stats.p_error_history)
                     ] = stats.p_error_history
+                    # runs on sentence grammars record the exact q errors
+                    # (see util.log_errors)
+                    q_error_to_model_history = \
+                        stats.q_error_to_model_history or getattr(
+                            stats, 'q_kl_to_model_history', [])
+                    q_error_to_true_history = \
+                        stats.q_error_to_true_history or getattr(
+                            stats, 'q_kl_to_true_history', [])
                     q_error_model[
                         seed_idx, train_mode_idx,
-                        num_particles_idx, :len(stats.q_error_to_model_history)
-                    ] = stats.q_error_to_model_history
+                        num_particles_idx, :len(q_error_to_model_history)
+                    ] = q_error_to_model_history
                     q_error_true[
                         seed_idx, train_mode_idx,
-                        num_particles_idx, :len(stats.q_error_to_true_history)
-                    ] = stats.q_error_to_true_history
+                        num_particles_idx, :len(q_error_to_true_history)
+                    ] = q_error_to_true_history
     return p_error, q_error_model, q_error_true
 
 
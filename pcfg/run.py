@@ -15,10 +15,18 @@ def load_or_init_models(load_model_folder, pcfg_path):
 
     if load_model_folder == '':
         generative_model, inference_network, true_generative_model = \
-            util.init_models(args.pcfg_path)
+            util.init_models(args.pcfg_path, args.ys_cache_mb * 2**20,
+                             args.gray_cache_mb * 2**20, args.max_num_nodes,
+                             args.max_levenshtein_distance)
     else:
-        _, _, true_generative_model = util.init_models(args.pcfg_path)
-        generative_model, inference_network = util.load_models()
+        _, _, true_generative_model = util.init_models(
+            args.pcfg_path, args.ys_cache_mb * 2**20,
+            args.gray_cache_mb * 2**20)
+        generative_model, inference_network = util.load_models(
+            ys_cache_max_bytes=args.ys_cache_mb * 2**20,
+            gray_cache_max_bytes=args.gray_cache_mb * 2**20,
+            max_num_nodes=args.max_num_nodes,
+            max_levenshtein_distance=args.max_levenshtein_distance)
 
     return generative_model, inference_network, true_generative_model
 
@@ -53,10 +61,15 @@ def run(args):
             args.pcfg_path, model_folder, true_generative_model,
             args.logging_interval, args.checkpoint_interval,
             args.eval_interval)
+        if args.sleep_buffer_size > 0:
+            sleep_replay_buffer = util.SleepReplayBuffer(
+                args.sleep_buffer_size, args.sleep_refill_fraction)
+        else:
+            sleep_replay_buffer = None
         train.train_wake_sleep(generative_model, inference_network,
                                true_generative_model, args.batch_size,
                                args.num_iterations, args.num_particles,
-                               train_callback)
+                               train_callback, sleep_replay_buffer)
     elif args.train_mode == 'reinforce' or args.train_mode == 'vimco':
         train_callback = train.TrainIwaeCallback(
             args.pcfg_path, model_folder, true_generative_model,
@@ -106,6 +119,24 @@ if __name__ == '__main__':
     parser.add_argument('--seed', type=int, default=1, help=' ')
     parser.add_argument('--pcfg-path', default='./pcfgs/astronomers_pcfg.json',
                         help=' ')
+    parser.add_argument('--ys-cache-mb', type=int, default=16,
+                        help='memory limit of the tree -> ys cache of the '
+                        'polynomial generative models')
+    parser.add_argument('--gray-cache-mb', type=int, default=256,
+                        help='memory limit of the ys -> image cache of the '
+                        'polynomial inference network')
+    parser.add_argument('--sleep-buffer-size', type=int, default=0,
+                        help='number of prior samples kept for the sleep '
+                        'phase of ws; 0 samples afresh every step')
+    parser.add_argument('--sleep-refill-fraction', type=float, default=0.1,
+                        help='fraction of the sleep buffer resampled per step')
+    parser.add_argument('--max-num-nodes', type=int, default=None,
+                        help='budget of non-terminals per sampled tree; '
+                        'non-terminals beyond it are left unexpanded')
+    parser.add_argument('--max-levenshtein-distance', type=int, default=None,
+                        help='stop expanding particles of the astronomers '
+                        'grammar whose leaves are already farther than this '
+                        'from the sentence')
     parser.add_argument('--version', default='with relax')
     args = parser.parse_args()
     run(args)
@@ -1,16 +1,18 @@
 import torch
 import losses
+import estimators
 import util
 import itertools
 
 
 def train_sleep(generative_model, inference_network, num_samples,
-                num_iterations, callback=None):
+                num_iterations, callback=None, sleep_replay_buffer=None):
     optimizer = torch.optim.Adam(inference_network.parameters())
     for iteration in range(num_iterations):
         optimizer.zero_grad()
         sleep_loss = losses.get_sleep_loss(generative_model, inference_network,
-                                           num_samples=num_samples)
+                                           num_samples=num_samples,
+                                           replay_buffer=sleep_replay_buffer)
         sleep_loss.backward()
         optimizer.step()
         if callback is not None:
@@ -23,6 +25,8 @@ def train_sleep(generative_model, inference_network, num_samples,
 class TrainSleepCallback():
     def __init__(self, logging_interval=10, saving_interval=10):
         self.sleep_loss_history = []
+        self.cache_stats_history = []
+        self.truncation_counts_history = []
         self.logging_interval = logging_interval
 
     def __call__(self, iteration, sleep_loss, generative_model,
@@ -31,32 +35,37 @@ class TrainSleepCallback():
             util.print_with_time('Iteration {}: loss = {:.3f}'.format(
                 iteration, sleep_loss))
             self.sleep_loss_history.append(sleep_loss)
+            util.log_cache_stats_and_truncation_counts(
+                iteration, generative_model, inference_network,
+                self.cache_stats_history, self.truncation_counts_history)
 
 
 def train_wake_sleep(generative_model, inference_network,
                      true_generative_model, batch_size,
-                     num_iterations, num_particles, callback=None):
+                     num_iterations, num_particles, callback=None,
+                     sleep_replay_buffer=None):
     num_samples = batch_size * num_particles
     optimizer_phi = torch.optim.Adam(inference_network.parameters())
     optimizer_theta = torch.optim.Adam(generative_model.parameters())
 
     for iteration in range(num_iterations):
         # generate synthetic data
-        obss = [true_generative_model.sample_obs() for _ in range(batch_size)]
+        obss = true_generative_model.sample_obss(batch_size)
 
-        # wake theta
         optimizer_phi.zero_grad()
         optimizer_theta.zero_grad()
+
+        # wake theta; the loss doesn't reach phi (see
+        # losses.get_wake_theta_loss) so phi's gradients stay zero
         wake_theta_loss, elbo = losses.get_wake_theta_loss(
             generative_model, inference_network, obss, num_particles)
         wake_theta_loss.backward()
         optimizer_theta.step()
 
-        # sleep phi
-        optimizer_phi.zero_grad()
-        optimizer_theta.zero_grad()
+        # sleep phi; samples of the updated generative model
         sleep_phi_loss = losses.get_sleep_loss(
-            generative_model, inference_network, num_samples)
+            generative_model, inference_network, num_samples,
+            sleep_replay_buffer)
         sleep_phi_loss.backward()
         optimizer_phi.step()
 
@@ -78,13 +87,18 @@ class TrainWakeSleepCallback():
         self.logging_interval = logging_interval
         self.checkpoint_interval = checkpoint_interval
         self.eval_interval = eval_interval
+        self.test_sentences = util.get_test_sentences(true_generative_model)
 
         self.wake_theta_loss_history = []
         self.sleep_phi_loss_history = []
         self.elbo_history = []
+        self.cache_stats_history = []
+        self.truncation_counts_history = []
         self.p_error_history = []
         self.q_error_to_true_history = []
         self.q_error_to_model_history = []
+        self.q_kl_to_true_history = []
+        self.q_kl_to_model_history = []
 
     def __call__(self, iteration, wake_theta_loss, sleep_phi_loss, elbo,
                  generative_model, inference_network, optimizer_theta,
@@ -97,6 +111,9 @@ class TrainWakeSleepCallback():
             self.wake_theta_loss_history.append(wake_theta_loss)
             self.sleep_phi_loss_history.append(sleep_phi_loss)
             self.elbo_history.append(elbo)
+            util.log_cache_stats_and_truncation_counts(
+                iteration, generative_model, inference_network,
+                self.cache_stats_history, self.truncation_counts_history)
 
         if iteration % self.checkpoint_interval == 0:
             stats_filename = util.get_stats_filename(self.model_folder)
@@ -105,18 +122,8 @@ class TrainWakeSleepCallback():
                              self.pcfg_path, self.model_folder)
 
         if iteration % self.eval_interval == 0:
-            self.p_error_history.append(util.get_p_error(
-                self.true_generative_model, generative_model))
-            self.q_error_to_true_history.append(util.get_q_error(
-                self.true_generative_model, inference_network))
-            self.q_error_to_model_history.append(util.get_q_error(
-                generative_model, inference_network))
-            util.print_with_time(
-                'Iteration {} p_error = {:.3f}, q_error_to_true = {:.3f}, '
-                'q_error_to_model = {:.3f}'.format(
-                    iteration, self.p_error_history[-1],
-                    self.q_error_to_true_history[-1],
-                    self.q_error_to_model_history[-1]))
+            util.log_errors(iteration, self, generative_model,
+                            inference_network)
 
 
 def train_wake_wake(generative_model, inference_network,
@@ -127,25 +134,19 @@ def train_wake_wake(generative_model, inference_network,
 
     for iteration in range(num_iterations):
         # generate synthetic data
-        obss = [true_generative_model.sample_obs() for _ in range(batch_size)]
+        obss = true_generative_model.sample_obss(batch_size)
 
-        log_weight, log_q = losses.get_log_weight_and_log_q(
+        log_p, log_q = losses.get_log_p_and_log_q(
             generative_model, inference_network, obss, num_particles)
 
-        # wake theta
+        # wake theta and wake phi; the losses depend on disjoint parameters
+        # so a single backward pass gives the gradients of both
         optimizer_phi.zero_grad()
         optimizer_theta.zero_grad()
-        wake_theta_loss, elbo = losses.get_wake_theta_loss_from_log_weight(
-            log_weight)
-        wake_theta_loss.backward(retain_graph=True)
+        wake_theta_loss, wake_phi_loss, elbo = estimators.get_wake_losses(
+            log_p, log_q)
+        (wake_theta_loss + wake_phi_loss).backward()
         optimizer_theta.step()
-
-        # wake phi
-        optimizer_phi.zero_grad()
-        optimizer_theta.zero_grad()
-        wake_phi_loss = losses.get_wake_phi_loss_from_log_weight_and_log_q(
-            log_weight, log_q)
-        wake_phi_loss.backward()
         optimizer_phi.step()
 
         if callback is not None:
@@ -166,13 +167,18 @@ class TrainWakeWakeCallback():
         self.logging_interval = logging_interval
         self.checkpoint_interval = checkpoint_interval
         self.eval_interval = eval_interval
+        self.test_sentences = util.get_test_sentences(true_generative_model)
 
         self.wake_theta_loss_history = []
         self.wake_phi_loss_history = []
         self.elbo_history = []
+        self.cache_stats_history = []
+        self.truncation_counts_history = []
         self.p_error_history = []
         self.q_error_to_true_history = []
         self.q_error_to_model_history = []
+        self.q_kl_to_true_history = []
+        self.q_kl_to_model_history = []
 
     def __call__(self, iteration, wake_theta_loss, wake_phi_loss, elbo,
                  generative_model, inference_network, optimizer_theta,
@@ -185,6 +191,9 @@ class TrainWakeWakeCallback():
             self.wake_theta_loss_history.append(wake_theta_loss)
             self.wake_phi_loss_history.append(wake_phi_loss)
             self.elbo_history.append(elbo)
+            util.log_cache_stats_and_truncation_counts(
+                iteration, generative_model, inference_network,
+                self.cache_stats_history, self.truncation_counts_history)
 
         if iteration % self.checkpoint_interval == 0:
             stats_filename = util.get_stats_filename(self.model_folder)
@@ -193,18 +202,8 @@ class TrainWakeWakeCallback():
                              self.pcfg_path, self.model_folder)
 
         if iteration % self.eval_interval == 0:
-            self.p_error_history.append(util.get_p_error(
-                self.true_generative_model, generative_model))
-            self.q_error_to_true_history.append(util.get_q_error(
-                self.true_generative_model, inference_network))
-            self.q_error_to_model_history.append(util.get_q_error(
-                generative_model, inference_network))
-            util.print_with_time(
-                'Iteration {} p_error = {:.3f}, q_error_to_true = {:.3f}, '
-                'q_error_to_model = {:.3f}'.format(
-                    iteration, self.p_error_history[-1],
-                    self.q_error_to_true_history[-1],
-                    self.q_error_to_model_history[-1]))
+            util.log_errors(iteration, self, generative_model,
+                            inference_network)
 
 
 def train_iwae(algorithm, generative_model, inference_network,
@@ -222,7 +221,7 @@ def train_iwae(algorithm, generative_model, inference_network,
 
     for iteration in range(num_iterations):
         # generate synthetic data
-        obss = [true_generative_model.sample_obs() for _ in range(batch_size)]
+        obss = true_generative_model.sample_obss(batch_size)
 
         # wake theta
         optimizer.zero_grad()
@@ -252,12 +251,17 @@ class TrainIwaeCallback():
         self.logging_interval = logging_interval
         self.checkpoint_interval = checkpoint_interval
         self.eval_interval = eval_interval
+        self.test_sentences = util.get_test_sentences(true_generative_model)
 
         self.loss_history = []
         self.elbo_history = []
+        self.cache_stats_history = []
+        self.truncation_counts_history = []
         self.p_error_history = []
         self.q_error_to_true_history = []
         self.q_error_to_model_history = []
+        self.q_kl_to_true_history = []
+        self.q_kl_to_model_history = []
 
     def __call__(self, iteration, loss, elbo, generative_model,
                  inference_network, optimizer):
@@ -267,6 +271,9 @@ class TrainIwaeCallback():
                     iteration, loss, elbo))
             self.loss_history.append(loss)
             self.elbo_history.append(elbo)
+            util.log_cache_stats_and_truncation_counts(
+                iteration, generative_model, inference_network,
+                self.cache_stats_history, self.truncation_counts_history)
 
         if iteration % self.checkpoint_interval == 0:
             stats_filename = util.get_stats_filename(self.model_folder)
@@ -275,18 +282,8 @@ class TrainIwaeCallback():
                              self.pcfg_path, self.model_folder)
 
         if iteration % self.eval_interval == 0:
-            self.p_error_history.append(util.get_p_error(
-                self.true_generative_model, generative_model))
-            self.q_error_to_true_history.append(util.get_q_error(
-                self.true_generative_model, inference_network))
-            self.q_error_to_model_history.append(util.get_q_error(
-                generative_model, inference_network))
-            util.print_with_time(
-                'Iteration {} p_error = {:.3f}, q_error_to_true = {:.3f}, '
-                'q_error_to_model = {:.3f}'.format(
-                    iteration, self.p_error_history[-1],
-                    self.q_error_to_true_history[-1],
-                    self.q_error_to_model_history[-1]))
+            util.log_errors(iteration, self, generative_model,
+                            inference_network)
 
 
 def train_relax(generative_model, inference_network, control_variate,
@@ -302,7 +299,7 @@ def train_relax(generative_model, inference_network, control_variate,
 
     for iteration in range(num_iterations):
         # generate synthetic data
-        obss = [true_generative_model.sample_obs() for _ in range(batch_size)]
+        obss = true_generative_model.sample_obss(batch_size)
 
         # optimize theta and phi
         iwae_optimizer.zero_grad()
@@ -343,12 +340,17 @@ class TrainRelaxCallback():
         self.logging_interval = logging_interval
         self.checkpoint_interval = checkpoint_interval
         self.eval_interval = eval_interval
+        self.test_sentences = util.get_test_sentences(true_generative_model)
 
         self.loss_history = []
         self.elbo_history = []
+        self.cache_stats_history = []
+        self.truncation_counts_history = []
         self.p_error_history = []
         self.q_error_to_true_history = []
         self.q_error_to_model_history = []
+        self.q_kl_to_true_history = []
+        self.q_kl_to_model_history = []
 
     def __call__(self, iteration, loss, elbo, generative_model,
                  inference_network, control_variate):
@@ -358,6 +360,9 @@ class TrainRelaxCallback():
                     iteration, loss, elbo))
             self.loss_history.append(loss)
             self.elbo_history.append(elbo)
+            util.log_cache_stats_and_truncation_counts(
+                iteration, generative_model, inference_network,
+                self.cache_stats_history, self.truncation_counts_history)
 
         if iteration % self.checkpoint_interval == 0:
             stats_filename = util.get_stats_filename(self.model_folder)
@@ -367,15 +372,5 @@ class TrainRelaxCallback():
             util.save_control_variate(control_variate, self.model_folder)
 
         if iteration % self.eval_interval == 0:
-            self.p_error_history.append(util.get_p_error(
-                self.true_generative_model, generative_model))
-            self.q_error_to_true_history.append(util.get_q_error(
-                self.true_generative_model, inference_network))
-            self.q_error_to_model_history.append(util.get_q_error(
-                generative_model, inference_network))
-            util.print_with_time(
-                'Iteration {} p_error = {:.3f}, q_error_to_true = {:.3f}, '
-                'q_error_to_model = {:.3f}'.format(
-                    iteration, self.p_error_history[-1],
-                    self.q_error_to_true_history[-1],
-                    self.q_error_to_model_history[-1]))
+            util.log_errors(iteration, self, generative_model,
+                            inference_network)
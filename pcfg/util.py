@@ -1,11 +1,13 @@
 import torch
 import itertools
+import collections
 import json
 import os
 import models
 import string
 import Levenshtein
 import losses
+import inside
 import pickle
 import uuid
 import datetime
@@ -101,10 +103,12 @@ def get_sample_address_embedding(non_terminal, non_terminals):
 def get_root(tree):
     """Returns root of a tree.
 
-    Args: list of lists or string
+    Args: list of lists or string or FlatTree
     Returns: string
     """
-    if isinstance(tree, list):
+    if isinstance(tree, FlatTree):
+        return tree.get_root()
+    elif isinstance(tree, list):
         return tree[0]
     else:
         return tree
@@ -154,13 +158,40 @@ def sentence_to_one_hots(sentence, terminals):
                       for word in sentence])
 
 
+def get_gru_sentence_embeddings(gru, sentences, compiled_grammar):
+    """Runs a single-layer nn.GRU over a batch of variable-length sentences
+    packed into one sequence.
+
+    Args:
+        gru: nn.GRU whose input size is the number of terminals
+        sentences: list of sentences each of which is a list of strings
+        compiled_grammar: CompiledGrammar object
+
+    Returns: tensor of shape [num_sentences, hidden_size] whose ith row is
+        the output of gru at the last word of sentences[i]
+    """
+
+    lengths = [len(sentence) for sentence in sentences]
+    # pack_padded_sequence expects sentences sorted by decreasing length
+    order = sorted(range(len(sentences)), key=lambda i: -lengths[i])
+    one_hots = torch.nn.utils.rnn.pad_sequence(
+        [compiled_grammar.sentence_to_one_hots(sentences[i]) for i in order])
+    packed = torch.nn.utils.rnn.pack_padded_sequence(
+        one_hots, [lengths[i] for i in order])
+    _, hidden = gru(packed)
+    return torch.zeros_like(hidden[-1]).index_copy(
+        0, torch.tensor(order, dtype=torch.long), hidden[-1])
+
+
 def get_leaves(tree):
     """Return leaves of a tree.
 
-    Args: list of lists or string
+    Args: list of lists or string or FlatTree
     Returns: list of strings
     """
-    if isinstance(tree, list):
+    if isinstance(tree, FlatTree):
+        return tree.get_leaves()
+    elif isinstance(tree, list):
         return list(itertools.chain.from_iterable(
             [get_leaves(subtree) for subtree in tree[1:]]))
     else:
@@ -184,6 +215,167 @@ def read_pcfg(pcfg_path):
     return grammar, true_production_probs
 
 
+class CompiledGrammar():
+    """Integer representation of a grammar returned by read_pcfg.
+
+    Symbols get dense ids (non-terminals first, then terminals, each in
+    sorted order so that they agree with get_sample_address_embedding and
+    word_to_index), productions are stored as padded tensors and all the
+    one-hot embeddings used by the models are precomputed so that per-node
+    lookups are O(1) instead of sorting the vocabulary.
+
+    Args:
+        grammar: dict returned by read_pcfg
+    """
+
+    def __init__(self, grammar):
+        self.name = grammar['name']
+        self.start_symbol = grammar['start_symbol']
+        self.non_terminals = sorted(grammar['non_terminals'])
+        self.terminals = sorted(grammar['terminals'])
+        self.symbols = self.non_terminals + self.terminals
+        self.num_non_terminals = len(self.non_terminals)
+        self.num_terminals = len(self.terminals)
+
+        self.symbol_to_id = {symbol: i for i, symbol in
+                             enumerate(self.symbols)}
+        self.non_terminal_to_index = {
+            non_terminal: i for i, non_terminal in
+            enumerate(self.non_terminals)}
+        self.terminal_to_index = {terminal: i for i, terminal in
+                                  enumerate(self.terminals)}
+
+        # productions[non_terminal] is the list of productions as in grammar;
+        # production_to_index maps (non_terminal, tuple(production)) to its
+        # index in that list
+        self.productions = grammar['productions']
+        self.production_to_index = {
+            (non_terminal, tuple(production)): i
+            for non_terminal, productions in self.productions.items()
+            for i, production in enumerate(productions)}
+        self.max_num_productions = max(
+            [len(v) for v in self.productions.values()])
+        self.max_production_length = max(
+            [len(production) for v in self.productions.values()
+             for production in v])
+
+        # production_table[i, j] are the symbol ids of the jth production of
+        # the ith non-terminal padded with -1
+        self.num_productions = torch.zeros(self.num_non_terminals,
+                                           dtype=torch.long)
+        self.production_lengths = torch.zeros(
+            (self.num_non_terminals, self.max_num_productions),
+            dtype=torch.long)
+        self.production_table = torch.full(
+            (self.num_non_terminals, self.max_num_productions,
+             self.max_production_length), -1, dtype=torch.long)
+        for i, non_terminal in enumerate(self.non_terminals):
+            productions = self.productions[non_terminal]
+            self.num_productions[i] = len(productions)
+            for j, production in enumerate(productions):
+                self.production_lengths[i, j] = len(production)
+                self.production_table[i, j, :len(production)] = \
+                    torch.tensor([self.symbol_to_id[symbol]
+                                  for symbol in production])
+
+        # productions of all non-terminals are also numbered globally:
+        # production_offsets[i] + j is the global id of the jth production of
+        # the ith non-terminal
+        self.production_offsets = torch.cumsum(
+            self.num_productions, dim=0) - self.num_productions
+        self.num_total_productions = int(torch.sum(self.num_productions))
+        self.production_to_id = {
+            (non_terminal, production): index + int(
+                self.production_offsets[
+                    self.non_terminal_to_index[non_terminal]])
+            for (non_terminal, production), index in
+            self.production_to_index.items()}
+
+        self.sample_address_embeddings = torch.eye(self.num_non_terminals)
+        self.sample_embeddings = torch.eye(self.max_num_productions)
+        # the last row is the all-zeros embedding of out-of-vocabulary words
+        self.word_one_hots = torch.cat([torch.eye(self.num_terminals),
+                                        torch.zeros(1, self.num_terminals)])
+
+    def is_terminal(self, symbol):
+        return symbol in self.terminal_to_index
+
+    def get_sample_address_embedding(self, non_terminal):
+        """Same as get_sample_address_embedding(non_terminal, non_terminals).
+        """
+        return self.sample_address_embeddings[
+            self.non_terminal_to_index[non_terminal]]
+
+    def get_sample_embedding(self, production_index):
+        """Returns: one-hot vector of shape [max_num_productions]"""
+        return self.sample_embeddings[production_index]
+
+    def get_production_index(self, non_terminal, production):
+        """Same as get_production_index(non_terminal, production,
+        productions)."""
+        return self.production_to_index[(non_terminal, tuple(production))]
+
+    def get_production_id(self, non_terminal, production):
+        """Returns: global id of the production; int in
+            [0, num_total_productions)"""
+        return self.production_to_id[(non_terminal, tuple(production))]
+
+    def get_tree_production_ids(self, tree):
+        """Args:
+            tree: list of lists or string or FlatTree
+
+        Returns: list of global production ids of the internal nodes of tree
+        """
+
+        if isinstance(tree, FlatTree):
+            return tree.production_ids[tree.production_ids >= 0].tolist()
+        result = []
+        stack = [tree]
+        while len(stack) > 0:
+            subtree = stack.pop()
+            if isinstance(subtree, list):
+                subtrees = subtree[1:]
+                result.append(self.get_production_id(
+                    subtree[0], [get_root(s) for s in subtrees]))
+                stack.extend(subtrees)
+        return result
+
+    def get_production_counts(self, trees):
+        """Production-count vectors of trees.
+
+        Args:
+            trees: list of N trees (list of lists or string or FlatTree)
+
+        Returns: tensor of shape [N, num_total_productions] where entry
+            [n, i] is the number of times production i is used in trees[n]
+        """
+
+        production_ids = [self.get_tree_production_ids(tree)
+                          for tree in trees]
+        tree_indices = torch.tensor(list(itertools.chain.from_iterable(
+            [[tree_idx] * len(ids) for tree_idx, ids in
+             enumerate(production_ids)])), dtype=torch.long)
+        production_ids = torch.tensor(list(itertools.chain.from_iterable(
+            production_ids)), dtype=torch.long)
+        counts = torch.zeros(len(trees), self.num_total_productions)
+        counts.index_put_((tree_indices, production_ids),
+                          torch.ones(len(production_ids)), accumulate=True)
+        return counts
+
+    def word_to_index(self, word):
+        """Same as word_to_index(word, terminals)."""
+        return self.terminal_to_index.get(word, -1)
+
+    def sentence_to_indices(self, sentence):
+        """Same as sentence_to_indices(sentence, terminals)."""
+        return [self.terminal_to_index.get(word, -1) for word in sentence]
+
+    def sentence_to_one_hots(self, sentence):
+        """Same as sentence_to_one_hots(sentence, terminals)."""
+        return self.word_one_hots[torch.tensor(
+            self.sentence_to_indices(sentence), dtype=torch.long)]
+
+
 def save_models(generative_model, inference_network, pcfg_path,
                 model_folder='.'):
     generative_model_path = os.path.join(model_folder, 'gen.pt')
@@ -202,8 +394,16 @@ def save_models(generative_model, inference_network, pcfg_path,
     print_with_time('Saved to {}'.format(pcfg_path_path))
 
 
-def load_models(model_folder='.'):
-    """Returns: generative_model, inference network
+def load_models(model_folder='.', ys_cache_max_bytes=2**24,
+                gray_cache_max_bytes=2**28, max_num_nodes=None,
+                max_levenshtein_distance=None):
+    """Args:
+        model_folder: string
+        ys_cache_max_bytes, gray_cache_max_bytes, max_num_nodes,
+            max_levenshtein_distance: see init_models; these aren't saved
+            with the models
+
+    Returns: generative_model, inference network
     """
     generative_model_path = os.path.join(model_folder, 'gen.pt')
     inference_network_path = os.path.join(model_folder, 'inf.pt')
@@ -212,8 +412,13 @@ def load_models(model_folder='.'):
     with open(pcfg_path_path) as f:
         pcfg_path = f.read()
     grammar, _ = read_pcfg(pcfg_path)
-    generative_model = models.GenerativeModel(grammar)
-    inference_network = models.InferenceNetwork(grammar)
+    generative_model = models.GenerativeModel(
+        grammar, ys_cache_max_bytes=ys_cache_max_bytes,
+        max_num_nodes=max_num_nodes)
+    inference_network = models.InferenceNetwork(
+        grammar, gray_cache_max_bytes=gray_cache_max_bytes,
+        max_num_nodes=max_num_nodes,
+        max_levenshtein_distance=max_levenshtein_distance)
     generative_model.load_state_dict(torch.load(generative_model_path))
     print_with_time('Loaded from {}'.format(generative_model_path))
     inference_network.load_state_dict(torch.load(inference_network_path))
@@ -272,14 +477,72 @@ def get_levenshtein_distance(sentence_1, sentence_2, terminals):
                                 _sentence_to_string(sentence_2, terminals))
 
 
-def init_models(pcfg_path):
+def get_levenshtein_distances(indices_list, target_indices, prefix=False):
+    """Levenshtein distances between many sentences and one target sentence,
+    all given as word indices. Identical sentences are only computed once.
+
+    The dynamic program runs over the padded sentences one word at a time
+    for all sentences at once. Within a row, the insertion chain
+    D[i, j] = min_k (E[i, k] + j - k) is resolved with a cumulative minimum.
+
+    Args:
+        indices_list: list of N lists of ints
+        target_indices: list of ints
+        prefix: if True, sentences are prefixes of unfinished sentences and
+            the result is the lower bound min_j D[len(sentence), j] on the
+            distance of any sentence that starts with them
+
+    Returns: numpy int array of shape [N]"""
+
+    unique_indices = dict()
+    inverse = np.array([unique_indices.setdefault(tuple(indices),
+                                                  len(unique_indices))
+                        for indices in indices_list], dtype=np.int64)
+    unique_indices = list(unique_indices.keys())
+
+    num_sentences = len(unique_indices)
+    target = np.array(target_indices, dtype=np.int64)
+    target_length = len(target)
+    lengths = np.array([len(indices) for indices in unique_indices],
+                       dtype=np.int64)
+    max_length = int(np.max(lengths)) if num_sentences > 0 else 0
+    padded = np.full((num_sentences, max_length), -2, dtype=np.int64)
+    for sentence_idx, indices in enumerate(unique_indices):
+        padded[sentence_idx, :len(indices)] = indices
+
+    columns = np.arange(target_length + 1)
+    row = np.tile(columns, (num_sentences, 1))
+    distances = np.full(num_sentences, 0 if prefix else target_length,
+                        dtype=np.int64)
+    for i in range(1, max_length + 1):
+        cost = (padded[:, i - 1:i] != target[None, :]).astype(np.int64)
+        row_ = np.empty_like(row)
+        row_[:, 0] = i
+        row_[:, 1:] = np.minimum(row[:, 1:] + 1, row[:, :-1] + cost)
+        row = np.minimum.accumulate(row_ - columns, axis=1) + columns
+        done = lengths == i
+        if prefix:
+            distances[done] = np.min(row[done], axis=1)
+        else:
+            distances[done] = row[done, target_length]
+    return distances[inverse]
+
+
+def init_models(pcfg_path, ys_cache_max_bytes=2**24,
+                gray_cache_max_bytes=2**28, max_num_nodes=None,
+                max_levenshtein_distance=None):
     """Returns: generative_model, inference_network, true_generative_model"""
 
     grammar, true_production_probs = read_pcfg(pcfg_path)
-    generative_model = models.GenerativeModel(grammar)
-    inference_network = models.InferenceNetwork(grammar)
+    generative_model = models.GenerativeModel(
+        grammar, ys_cache_max_bytes=ys_cache_max_bytes,
+        max_num_nodes=max_num_nodes)
+    inference_network = models.InferenceNetwork(
+        grammar, gray_cache_max_bytes=gray_cache_max_bytes,
+        max_num_nodes=max_num_nodes,
+        max_levenshtein_distance=max_levenshtein_distance)
     true_generative_model = models.GenerativeModel(
-        grammar, true_production_probs)
+        grammar, true_production_probs, ys_cache_max_bytes=ys_cache_max_bytes)
 
     return generative_model, inference_network, true_generative_model
 
@@ -331,6 +594,62 @@ def get_q_error(generative_model, inference_network, num_samples=100):
                                  num_samples).detach()
 
 
+def get_test_sentences(true_generative_model):
+    """Returns: fixed sentences (inside.get_test_sentences) that log_errors
+        evaluates the exact q error on or None for grammars whose obs aren't
+        sentences"""
+
+    if true_generative_model.grammar['name'] == 'astronomers':
+        return inside.get_test_sentences(true_generative_model)
+    else:
+        return None
+
+
+def log_errors(iteration, callback, generative_model, inference_network):
+    """Appends the p and q errors to the histories of a train callback and
+    prints them. For sentence grammars (callback.test_sentences is not None),
+    the q errors are the exact inside.get_q_error on the test sentences;
+    otherwise they are the Monte Carlo get_q_error.
+
+    Args:
+        iteration: int
+        callback: train callback with attributes true_generative_model,
+            test_sentences (from get_test_sentences), p_error_history,
+            q_error_to_true_history, q_error_to_model_history,
+            q_kl_to_true_history and q_kl_to_model_history
+        generative_model: models.GenerativeModel object
+        inference_network: models.InferenceNetwork object
+    """
+
+    callback.p_error_history.append(get_p_error(
+        callback.true_generative_model, generative_model))
+    if callback.test_sentences is None:
+        callback.q_error_to_true_history.append(get_q_error(
+            callback.true_generative_model, inference_network))
+        callback.q_error_to_model_history.append(get_q_error(
+            generative_model, inference_network))
+        print_with_time(
+            'Iteration {} p_error = {:.3f}, q_error_to_true = {:.3f}, '
+            'q_error_to_model = {:.3f}'.format(
+                iteration, callback.p_error_history[-1],
+                callback.q_error_to_true_history[-1],
+                callback.q_error_to_model_history[-1]))
+    else:
+        # nan (with a warning) rather than an error if no test sentence has a
+        # parse so that an unlucky eval doesn't stop training
+        callback.q_kl_to_true_history.append(inside.get_q_error(
+            callback.true_generative_model, inference_network,
+            callback.test_sentences))
+        callback.q_kl_to_model_history.append(inside.get_q_error(
+            generative_model, inference_network, callback.test_sentences))
+        print_with_time(
+            'Iteration {} p_error = {:.3f}, q_kl_to_true = {:.3f}, '
+            'q_kl_to_model = {:.3f}'.format(
+                iteration, callback.p_error_history[-1],
+                callback.q_kl_to_true_history[-1],
+                callback.q_kl_to_model_history[-1]))
+
+
 def get_p_error(true_generative_model, generative_model):
     """Average KL between true and learned productions probs."""
 
@@ -438,6 +757,8 @@ def set_seed(seed):
 
 
 def tree_to_string(tree):
+    if isinstance(tree, FlatTree):
+        tree = tree.to_tree()
     return str(tree).replace('\'', '')\
                     .replace(',', '')\
                     .replace('[', '(')\
@@ -448,6 +769,277 @@ def tree_to_nltk_tree(tree):
     return nltk.Tree.fromstring(tree_to_string(tree))
 
 
+def nltk_tree_to_tree(nltk_tree):
+    """Inverse of tree_to_nltk_tree.
+
+    Args: nltk.Tree or string
+    Returns: list of lists or string
+    """
+    if isinstance(nltk_tree, nltk.Tree):
+        return [nltk_tree.label()] + [nltk_tree_to_tree(subtree)
+                                      for subtree in nltk_tree]
+    else:
+        return nltk_tree
+
+
+class FlatTree():
+    """Array-backed tree. Nodes are stored in preorder so that node 0 is the
+    root and the leaves appear in left-to-right order.
+
+    Attributes:
+        symbol_ids: long tensor [num_nodes] of CompiledGrammar symbol ids
+        production_ids: long tensor [num_nodes] of global production ids of
+            the productions expanded at each node; -1 for leaves (terminals
+            or non-terminals cut off at max_depth)
+        parents: long tensor [num_nodes]; -1 for the root
+        child_offsets: long tensor [num_nodes + 1]; the children of node i
+            are child_indices[child_offsets[i]:child_offsets[i + 1]]
+        child_indices: long tensor [num_nodes - 1]
+        depths: long tensor [num_nodes]
+        aux: tensor [num_nodes, max_num_productions] or None; row i is the
+            (zero-padded) tree_aux entry of node i and zeros for leaves
+    """
+
+    def __init__(self, compiled_grammar, symbol_ids, production_ids, parents,
+                 depths, aux=None):
+        self.compiled_grammar = compiled_grammar
+        self.symbol_ids = symbol_ids
+        self.production_ids = production_ids
+        self.parents = parents
+        self.depths = depths
+        self.aux = aux
+
+        num_children = torch.zeros(len(parents), dtype=torch.long)
+        num_children.index_add_(0, parents[1:],
+                                torch.ones(len(parents) - 1, dtype=torch.long))
+        self.child_offsets = torch.cat([torch.zeros(1, dtype=torch.long),
+                                        torch.cumsum(num_children, dim=0)])
+        # children of a node appear in increasing preorder index so a stable
+        # sort of the non-root nodes by parent keeps them in order
+        _, child_indices = torch.sort(parents[1:] * len(parents) +
+                                      torch.arange(1, len(parents)))
+        self.child_indices = child_indices + 1
+
+    @classmethod
+    def from_tree(cls, tree, compiled_grammar, tree_aux=None):
+        """Args:
+            tree: list of lists or string
+            compiled_grammar: CompiledGrammar object
+            tree_aux: tree_aux of the tree (see flatten_tree_aux) or None
+
+        Returns: FlatTree
+        """
+
+        symbol_ids, production_ids, parents, depths = [], [], [], []
+        stack = [(tree, -1, 0)]
+        while len(stack) > 0:
+            subtree, parent, depth = stack.pop()
+            node_idx = len(symbol_ids)
+            parents.append(parent)
+            depths.append(depth)
+            if isinstance(subtree, list):
+                non_terminal = subtree[0]
+                subtrees = subtree[1:]
+                symbol_ids.append(compiled_grammar.symbol_to_id[non_terminal])
+                production_ids.append(compiled_grammar.get_production_id(
+                    non_terminal, [get_root(s) for s in subtrees]))
+                for child in reversed(subtrees):
+                    stack.append((child, node_idx, depth + 1))
+            else:
+                symbol_ids.append(compiled_grammar.symbol_to_id[subtree])
+                production_ids.append(-1)
+
+        return cls(compiled_grammar,
+                   torch.tensor(symbol_ids, dtype=torch.long),
+                   torch.tensor(production_ids, dtype=torch.long),
+                   torch.tensor(parents, dtype=torch.long),
+                   torch.tensor(depths, dtype=torch.long),
+                   None if tree_aux is None else flatten_tree_aux(
+                       tree_aux, compiled_grammar.max_num_productions))
+
+    @classmethod
+    def from_nltk_tree(cls, nltk_tree, compiled_grammar):
+        return cls.from_tree(nltk_tree_to_tree(nltk_tree), compiled_grammar)
+
+    def __len__(self):
+        return len(self.symbol_ids)
+
+    def get_root(self):
+        return self.compiled_grammar.symbols[self.symbol_ids[0]]
+
+    def get_leaves(self):
+        symbols = self.compiled_grammar.symbols
+        return [symbols[symbol_id] for symbol_id in
+                self.symbol_ids[self.production_ids < 0].tolist()]
+
+    def get_children(self, node_idx):
+        return self.child_indices[self.child_offsets[node_idx]:
+                                  self.child_offsets[node_idx + 1]]
+
+    def to_tree(self):
+        """Returns: list of lists or string"""
+
+        symbols = self.compiled_grammar.symbols
+        nodes = [[symbols[symbol_id]] if production_id >= 0
+                 else symbols[symbol_id]
+                 for symbol_id, production_id in zip(
+                     self.symbol_ids.tolist(), self.production_ids.tolist())]
+        # in preorder, children are visited after their parents and in order
+        for node_idx, parent in enumerate(self.parents.tolist()):
+            if parent >= 0:
+                nodes[parent].append(nodes[node_idx])
+        return nodes[0]
+
+    def to_tree_aux(self):
+        """Returns: tree_aux in the nested format of flatten_tree_aux"""
+
+        if self.aux is None:
+            raise ValueError('FlatTree has no aux')
+        num_productions = self.compiled_grammar.num_productions[
+            self.symbol_ids.clamp(
+                max=self.compiled_grammar.num_non_terminals - 1)].tolist()
+        nodes = [[self.aux[node_idx, :num_productions[node_idx]]]
+                 if production_id >= 0 else None
+                 for node_idx, production_id in enumerate(
+                     self.production_ids.tolist())]
+        for node_idx, parent in enumerate(self.parents.tolist()):
+            if parent >= 0:
+                nodes[parent].append(nodes[node_idx])
+        return nodes[0]
+
+    def to_nltk_tree(self):
+        return tree_to_nltk_tree(self.to_tree())
+
+
+class Forest():
+    """Expanded (non-leaf) nodes of many trees, in any order. This is all the
+    structure the bottom-up ControlVariate encoder needs since leaves
+    contribute nothing to it.
+
+    Attributes:
+        num_trees: int
+        tree_indices: long tensor [num_nodes] of the tree each node is in
+        parents: long tensor [num_nodes] of the indices of the parent nodes;
+            -1 for roots
+        depths: long tensor [num_nodes]
+        symbol_ids: long tensor [num_nodes] of CompiledGrammar symbol ids
+    """
+
+    def __init__(self, num_trees, tree_indices, parents, depths, symbol_ids):
+        self.num_trees = num_trees
+        self.tree_indices = tree_indices
+        self.parents = parents
+        self.depths = depths
+        self.symbol_ids = symbol_ids
+
+    def __len__(self):
+        return len(self.tree_indices)
+
+    @classmethod
+    def from_flat_trees(cls, flat_trees):
+        """Args:
+            flat_trees: list of FlatTree objects
+
+        Returns:
+            forest: Forest whose nodes are the expanded nodes of flat_trees
+                in the order of their concatenated node orders
+            is_expanded: bool tensor [total number of nodes of flat_trees]
+                that selects them
+        """
+
+        num_nodes = [len(flat_tree) for flat_tree in flat_trees]
+        offsets = torch.tensor([0] + num_nodes[:-1],
+                               dtype=torch.long).cumsum(dim=0)
+        tree_indices = torch.arange(len(flat_trees)).repeat_interleave(
+            torch.tensor(num_nodes))
+        is_expanded = torch.cat([flat_tree.production_ids
+                                 for flat_tree in flat_trees]) >= 0
+        # parents of expanded nodes are expanded so renumbering the expanded
+        # nodes keeps parents consistent
+        new_indices = torch.cumsum(is_expanded.long(), dim=0) - 1
+        parents = torch.cat([flat_tree.parents for flat_tree in flat_trees])
+        parents = torch.where(parents >= 0,
+                              new_indices[parents + offsets[tree_indices]],
+                              parents)
+        return cls(len(flat_trees), tree_indices[is_expanded],
+                   parents[is_expanded],
+                   torch.cat([flat_tree.depths
+                              for flat_tree in flat_trees])[is_expanded],
+                   torch.cat([flat_tree.symbol_ids
+                              for flat_tree in flat_trees])[is_expanded]), \
+            is_expanded
+
+
+class TreeInterner():
+    """Hash-consing table of trees. Every distinct subtree is stored once and
+    identified by an int id; a subtree's key is its root symbol and the ids of
+    its children, so structurally identical trees get the same id in time
+    linear in their size.
+
+    Attributes:
+        ids: dict where key is a leaf string or a (symbol, child ids) tuple
+            and value is an id
+        trees: list where trees[id] is the canonical tree (list of lists or
+            string) whose subtrees are shared with other canonical trees
+    """
+
+    def __init__(self):
+        self.ids = dict()
+        self.trees = []
+
+    def __len__(self):
+        return len(self.trees)
+
+    def _get_id(self, key, make_tree):
+        if key not in self.ids:
+            self.ids[key] = len(self.trees)
+            self.trees.append(make_tree())
+        return self.ids[key]
+
+    def intern(self, tree):
+        """Args:
+            tree: list of lists or string
+
+        Returns: int id of tree
+        """
+
+        stack = [(tree, False)]
+        ids = []
+        while len(stack) > 0:
+            subtree, children_done = stack.pop()
+            if not isinstance(subtree, list):
+                ids.append(self._get_id(subtree, lambda: subtree))
+            elif not children_done:
+                stack.append((subtree, True))
+                stack.extend((child, False) for child in reversed(subtree[1:]))
+            else:
+                num_children = len(subtree) - 1
+                child_ids = tuple(ids[len(ids) - num_children:])
+                del ids[len(ids) - num_children:]
+                ids.append(self._get_id(
+                    (subtree[0], child_ids),
+                    lambda: [subtree[0]] + [self.trees[child_id]
+                                            for child_id in child_ids]))
+        return ids[0]
+
+    def unique(self, trees):
+        """Interns trees and deduplicates them.
+
+        Args:
+            trees: list of N trees (list of lists or string)
+
+        Returns:
+            tree_ids: list of the unique tree ids in order of first appearance
+            inverse: long tensor of shape [N] such that trees[n] is
+                self.trees[tree_ids[inverse[n]]]
+        """
+
+        positions = dict()
+        inverse = [positions.setdefault(self.intern(tree), len(positions))
+                   for tree in trees]
+        return list(positions.keys()), torch.tensor(inverse, dtype=torch.long)
+
+
 def logaddexp(a, b):
     """Returns log(exp(a) + exp(b))."""
 
@@ -460,23 +1052,12 @@ def get_posterior(generative_model, inference_network, obs, num_particles=100):
     of a tree.
     """
 
-    trees = [inference_network.sample_tree(obs=obs)
-             for _ in range(num_particles)]
-    log_weights = [(generative_model.get_log_prob(tree, obs) -
-                    inference_network.get_tree_log_prob(
-                        tree, obs=obs)).detach()
-                   for tree in trees]
-    tree_log_weight_dict = dict()
-    for tree, log_weight in zip(trees, log_weights):
-        string_tree = tree_to_string(tree)
-        if string_tree in tree_log_weight_dict:
-            tree_log_weight_dict[string_tree] = torch.logsumexp(
-                torch.cat([tree_log_weight_dict[string_tree].unsqueeze(0),
-                           log_weight.unsqueeze(0)]), dim=0)
-        else:
-            tree_log_weight_dict[string_tree] = log_weight
-    return sorted(list(tree_log_weight_dict.items()),
-                  key=lambda x: x[1], reverse=True)
+    trees, log_q, tree_log_p = inference_network.sample_trees_and_log_probs(
+        [obs], num_particles, generative_model)
+    trees = trees[0]
+    log_weights = (generative_model.get_log_probs(
+        trees, obs, tree_log_probs=tree_log_p[0]) - log_q[0]).detach()
+    return get_sorted_tree_log_weights(trees, log_weights)
 
 
 def get_inference_network_distribution(inference_network, obs,
@@ -484,22 +1065,27 @@ def get_inference_network_distribution(inference_network, obs,
     """Returns a sequence of (tree, log_weight) tuples sorted by weight in a
     descending order. tree is a string representation.
     """
-    trees = [inference_network.sample_tree(obs=obs)
-             for _ in range(num_samples)]
-    log_weights = [-torch.log(torch.tensor(num_samples, dtype=torch.float))
-                   for _ in trees]
-
-    # refactor (this is just copying the code snippet from get_posterior)
-    tree_log_weight_dict = dict()
-    for tree, log_weight in zip(trees, log_weights):
-        string_tree = tree_to_string(tree)
-        if string_tree in tree_log_weight_dict:
-            tree_log_weight_dict[string_tree] = torch.logsumexp(
-                torch.cat([tree_log_weight_dict[string_tree].unsqueeze(0),
-                           log_weight.unsqueeze(0)]), dim=0)
-        else:
-            tree_log_weight_dict[string_tree] = log_weight
-    return sorted(list(tree_log_weight_dict.items()),
+    trees = inference_network.sample_trees([obs], num_samples)[0]
+    log_weights = torch.full((len(trees),), -np.log(num_samples))
+    return get_sorted_tree_log_weights(trees, log_weights)
+
+
+def get_sorted_tree_log_weights(trees, log_weights):
+    """Merges the log weights of identical trees.
+
+    Args:
+        trees: list of N trees (list of lists or string)
+        log_weights: tensor of shape [N]
+
+    Returns: sequence of (tree, log_weight) tuples sorted by weight in a
+        descending order. tree is a string representation of a tree.
+    """
+
+    _, inverse = TreeInterner().unique(trees)
+    groups = group_indices(inverse.tolist())
+    return sorted([(tree_to_string(trees[group[0]]),
+                    torch.logsumexp(log_weights[group], dim=0))
+                   for group in groups.values()],
                   key=lambda x: x[1], reverse=True)
 
 
@@ -510,57 +1096,284 @@ def empty_list_of_size(*sizes):
         return [empty_list_of_size(*sizes[1:]) for _ in range(sizes[0])]
 
 
+def get_leaf_prefix(tree):
+    """Leaves of a partially sampled tree up to its first open node. Open
+    nodes are the [non_terminal] lists of a sampling frontier that haven't
+    been expanded yet, so the prefix is final.
+
+    Args: list of lists or string
+    Returns: list of strings
+    """
+    prefix = []
+    stack = [tree]
+    while len(stack) > 0:
+        subtree = stack.pop()
+        if isinstance(subtree, list):
+            if len(subtree) == 1:
+                break
+            stack.extend(reversed(subtree[1:]))
+        else:
+            prefix.append(subtree)
+    return prefix
+
+
+def expand_frontier(compiled_grammar, nodes, production_indices,
+                    tree_indices, depth, max_depth, num_nodes=None,
+                    max_num_nodes=None):
+    """Appends the children of the sampled productions to the open nodes of a
+    sampling frontier. A child non-terminal is left unexpanded (as a string)
+    if it would be deeper than max_depth or if its tree already has
+    max_num_nodes expanded or open non-terminals; scoring treats such leaves
+    like any other leaf so sampling and scoring agree on truncated trees.
+
+    Args:
+        compiled_grammar: CompiledGrammar object
+        nodes: list of open nodes ([non_terminal] lists)
+        production_indices: list of ints; production of each node
+        tree_indices: list of ints; tree of each node
+        depth: int; depth of nodes
+        max_depth: int
+        num_nodes: list of ints where num_nodes[tree_idx] is the number of
+            expanded or open non-terminals of a tree; updated in place (only
+            needed with max_num_nodes)
+        max_num_nodes: int or None
+
+    Returns:
+        child_nodes: list of open child nodes
+        parent_indices: list of ints; position in nodes of the parent of
+            each child node
+        truncated: dict where key is 'max_depth' or 'max_num_nodes' and value
+            is the set of tree indices truncated because of it
+    """
+
+    child_nodes, parent_indices = [], []
+    truncated = {'max_depth': set(), 'max_num_nodes': set()}
+    for node_idx, (node, production_index, tree_idx) in enumerate(
+            zip(nodes, production_indices, tree_indices)):
+        for s in compiled_grammar.productions[node[0]][production_index]:
+            if compiled_grammar.is_terminal(s):
+                node.append(s)
+            elif depth + 1 > max_depth:
+                node.append(s)
+                truncated['max_depth'].add(tree_idx)
+            elif max_num_nodes is not None and \
+                    num_nodes[tree_idx] >= max_num_nodes:
+                node.append(s)
+                truncated['max_num_nodes'].add(tree_idx)
+            else:
+                child_node = [s]
+                node.append(child_node)
+                child_nodes.append(child_node)
+                parent_indices.append(node_idx)
+                if max_num_nodes is not None:
+                    num_nodes[tree_idx] += 1
+    return child_nodes, parent_indices, truncated
+
+
+def init_truncation_counts():
+    """Returns: dict of the counters updated by update_truncation_counts"""
+
+    return {'particles': 0, 'truncated': 0, 'max_depth': 0,
+            'max_num_nodes': 0, 'levenshtein': 0}
+
+
+def update_truncation_counts(truncation_counts, num_trees, truncated):
+    """Args:
+        truncation_counts: dict from init_truncation_counts; updated in place
+        num_trees: int; number of trees sampled
+        truncated: dict where key is a truncation reason and value is the set
+            of indices of the trees truncated because of it
+    """
+
+    truncation_counts['particles'] += num_trees
+    truncation_counts['truncated'] += len(set().union(*truncated.values()))
+    for reason, tree_indices in truncated.items():
+        truncation_counts[reason] += len(tree_indices)
+
+
+def get_truncation_counts(generative_model, inference_network):
+    """Returns: dict where key is a model name and value is a copy of its
+        truncation_counts
+    """
+
+    return {'generative_model': dict(generative_model.truncation_counts),
+            'inference_network': dict(inference_network.truncation_counts)}
+
+
+def truncation_counts_to_string(truncation_counts):
+    return ', '.join(
+        '{}: truncated {} of {} particles (depth {}, nodes {}, levenshtein '
+        '{})'.format(name, counts['truncated'], counts['particles'],
+                     counts['max_depth'], counts['max_num_nodes'],
+                     counts['levenshtein'])
+        for name, counts in sorted(truncation_counts.items()))
+
+
+def group_indices(keys):
+    """Groups positions of a list by their value.
+
+    Args:
+        keys: list of hashables
+
+    Returns: dict where key is a value in keys and value is the increasing
+        list of positions at which it appears
+    """
+
+    result = dict()
+    for idx, key in enumerate(keys):
+        result.setdefault(key, []).append(idx)
+    return result
+
+
 def eval_quadratic(tree, x):
-    if isinstance(tree, list):
-        root = tree[0]
-        subtrees = tree[1:]
-        if root == 'Q' or root == 'L':
+    return eval_polynomials([tree], x)[0]
+
+
+def eval_polynomial(tree, x):
+    return eval_polynomials([tree], x)[0]
+
+
+def polynomial_tree_to_program(tree):
+    """Compiles an expression tree of the polynomial or quadratic grammar
+    into a postfix stack program.
+
+    Args:
+        tree: list of lists or string
+
+    Returns: list of tokens each of which is 'x', 'x**2', an int constant or
+        one of the operators '+', '-', '*'
+    """
+
+    program = []
+    stack = [tree]
+    while len(stack) > 0:
+        subtree = stack.pop()
+        if isinstance(subtree, tuple):
+            # operator whose operands have already been emitted
+            program.append(subtree[0])
+        elif isinstance(subtree, list):
+            subtrees = subtree[1:]
             if len(subtrees) == 3:
                 a, op, b = subtrees
-                if op == '+':
-                    return eval_quadratic(a, x) + eval_quadratic(b, x)
-                elif op == '-':
-                    return eval_quadratic(a, x) - eval_quadratic(b, x)
-                elif op == '*':
-                    return eval_quadratic(a, x) * eval_quadratic(b, x)
-                else:
+                if op not in ('+', '-', '*'):
                     raise ArithmeticError
-            elif len(subtrees) == 1:
-                return eval_quadratic(subtrees[0], x)
-        elif root == 'N':
-            return eval_quadratic(subtrees[0], x)
-    else:
-        root = tree
-        if root == 'x':
-            return x
-        elif root == 'x**2':
-            return x**2
-        elif int(root) in range(1, 21):
-            return torch.full_like(x, int(root), dtype=torch.float)
+                stack.extend([(op,), b, a])
+            else:
+                stack.append(subtrees[0])
+        elif subtree == 'x' or subtree == 'x**2':
+            program.append(subtree)
+        elif subtree.isdigit():
+            program.append(int(subtree))
+        else:
+            # non-terminal cut off by max_depth or max_num_nodes
+            program.append(0)
+    return program
 
 
-def eval_polynomial(tree, x):
-    if isinstance(tree, list):
-        root = tree[0]
-        subtrees = tree[1:]
-        if root == 'E':
-            a, op, b = subtrees
-            if op == '+':
-                return eval_polynomial(a, x) + eval_polynomial(b, x)
-            elif op == '-':
-                return eval_polynomial(a, x) - eval_polynomial(b, x)
-            elif op == '*':
-                return eval_polynomial(a, x) * eval_polynomial(b, x)
+def program_to_coefficients(program, max_degree):
+    """Collapses a postfix program into the exact integer coefficients of
+    the polynomial it computes.
+
+    Args:
+        program: list of tokens (see polynomial_tree_to_program)
+        max_degree: int
+
+    Returns: list of ints of length max_degree + 1 whose ith element is the
+        coefficient of x**i or None if the degree exceeds max_degree
+    """
+
+    stack = []
+    for token in program:
+        if token == 'x':
+            stack.append([0, 1])
+        elif token == 'x**2':
+            stack.append([0, 0, 1])
+        elif isinstance(token, int):
+            stack.append([token])
+        else:
+            b = stack.pop()
+            a = stack.pop()
+            if token == '*':
+                if len(a) + len(b) - 2 > max_degree:
+                    return None
+                c = [0] * (len(a) + len(b) - 1)
+                for i, a_i in enumerate(a):
+                    for j, b_j in enumerate(b):
+                        c[i + j] += a_i * b_j
             else:
-                raise ArithmeticError
-        elif root == 'E1' or root == 'N':
-            return eval_polynomial(subtrees[0], x)
-    else:
-        root = tree
-        if root == 'x':
-            return x
-        elif int(root) in range(1, 4):
-            return torch.full_like(x, int(root), dtype=torch.float)
+                sign = 1 if token == '+' else -1
+                c = [0] * max(len(a), len(b))
+                for i, a_i in enumerate(a):
+                    c[i] += a_i
+                for i, b_i in enumerate(b):
+                    c[i] += sign * b_i
+            stack.append(c)
+    coefficients = stack.pop()
+    if len(coefficients) > max_degree + 1:
+        return None
+    return coefficients + [0] * (max_degree + 1 - len(coefficients))
+
+
+def eval_program(program, x):
+    """Runs a postfix program (see polynomial_tree_to_program) on x.
+
+    Args:
+        program: list of tokens
+        x: tensor
+
+    Returns: tensor of the same shape as x
+    """
+
+    stack = []
+    for token in program:
+        if token == 'x':
+            stack.append(x)
+        elif token == 'x**2':
+            stack.append(x**2)
+        elif isinstance(token, int):
+            stack.append(torch.full_like(x, token, dtype=torch.float))
+        else:
+            b = stack.pop()
+            a = stack.pop()
+            if token == '+':
+                stack.append(a + b)
+            elif token == '-':
+                stack.append(a - b)
+            else:
+                stack.append(a * b)
+    return stack.pop()
+
+
+def eval_polynomials(trees, x, max_degree=16):
+    """Evaluates many expression trees of the polynomial or quadratic grammar
+    at once. Trees are compiled to coefficient vectors which are evaluated
+    with a single matmul against the powers of x; the rare trees of degree
+    above max_degree are run as postfix programs instead.
+
+    Args:
+        trees: list of N trees (list of lists or string)
+        x: tensor of shape [num_xs]
+        max_degree: int
+
+    Returns: tensor of shape [N, num_xs]
+    """
+
+    programs = [polynomial_tree_to_program(tree) for tree in trees]
+    coefficients = [program_to_coefficients(program, max_degree)
+                    for program in programs]
+    collapsed = [i for i, c in enumerate(coefficients) if c is not None]
+
+    result = torch.zeros((len(trees), len(x)), dtype=torch.float)
+    if len(collapsed) > 0:
+        powers = x.double().unsqueeze(0)**torch.arange(
+            max_degree + 1, dtype=torch.double).unsqueeze(1)
+        result[collapsed] = torch.mm(
+            torch.tensor([coefficients[i] for i in collapsed],
+                         dtype=torch.double), powers).float()
+    for i, c in enumerate(coefficients):
+        if c is None:
+            result[i] = eval_program(programs[i], x)
+    return result
 
 
 def mse(ys1, ys2):
@@ -593,8 +1406,7 @@ def rgba2gray(rgba):
     return np.dot(rgba[..., :3], [0.299, 0.587, 0.114])
 
 
-# This function needs to be optimized
-def xsys2gray(xs, ys):
+def xsys2gray_matplotlib(xs, ys):
     """Args:
         xs: tensor of shape [100]
         ys: tensor of shape [100]
@@ -615,6 +1427,80 @@ def xsys2gray(xs, ys):
                         dtype=torch.float)
 
 
+def xsys2gray(xs, ys, image_size=100, xlim=(-10, 10), ylim=(-100, 100),
+              line_width=1.5 * 100 / 72):
+    """Rasterizes the polyline through (xs, ys) without matplotlib. Renders
+    the same picture as xsys2gray_matplotlib (same axis limits, matplotlib's
+    default 1.5pt line at 100 dpi) up to antialiasing: a pixel is darkened by
+    how much of it the thick line covers, approximated from the distance of
+    the pixel center to the nearest segment.
+
+    Args:
+        xs: tensor of shape [num_points]
+        ys: tensor of shape [num_points] or [N, num_points]
+        image_size: int; width and height in pixels
+        xlim: (x_min, x_max)
+        ylim: (y_min, y_max)
+        line_width: float; in pixels
+
+    Returns: grayscale image repr. by tensor of shape
+        [100, 100] (or [N, 100, 100] if ys is a batch) where 1 is white and 0
+        is black"""
+
+    batched = ys.dim() == 2
+    ys = ys.detach().float().view(-1, ys.shape[-1])
+    radius = line_width / 2
+
+    # pixel coordinates; pixel (row, column) is the unit square whose top
+    # left corner is (column, row)
+    x_min, x_max = xlim
+    y_min, y_max = ylim
+    pxs = (xs.detach().float() - x_min) / (x_max - x_min) * image_size
+    pys = (y_max - ys) / (y_max - y_min) * image_size
+    valid = torch.isfinite(pys)
+    # nan would survive the masking by segment_valid below (nan * 0 = nan)
+    pys = torch.where(valid,
+                      torch.clamp(pys, -100 * image_size, 101 * image_size),
+                      torch.zeros_like(pys))
+
+    # segments whose extent (thickened by the line) overlaps each column
+    segment_lo = torch.min(pxs[:-1], pxs[1:]) - radius - 1
+    segment_hi = torch.max(pxs[:-1], pxs[1:]) + radius + 1
+    columns = torch.arange(image_size, dtype=torch.float)
+    overlaps = (segment_lo.unsqueeze(0) <= columns.unsqueeze(1) + 1) & \
+        (segment_hi.unsqueeze(0) >= columns.unsqueeze(1))
+    num_candidates = max(int(torch.max(torch.sum(overlaps.long(), dim=1))),
+                         1)
+    is_candidate, candidates = torch.sort(overlaps.long(), dim=1,
+                                          descending=True)
+    is_candidate = is_candidate[:, :num_candidates].float()
+    candidates = candidates[:, :num_candidates]  # [image_size, S]
+
+    # distance of every pixel center to every candidate segment of its
+    # column; tensors below have shape [N, image_size (rows),
+    # image_size (columns), S]
+    x0, x1 = pxs[candidates], pxs[candidates + 1]
+    y0 = pys[:, candidates].unsqueeze(1)
+    y1 = pys[:, candidates + 1].unsqueeze(1)
+    segment_valid = (valid[:, candidates] &
+                     valid[:, candidates + 1]).float().unsqueeze(1)
+    centers_x = (columns + 0.5).view(-1, 1)
+    centers_y = (columns + 0.5).view(1, -1, 1, 1)
+    dx, dy = x1 - x0, y1 - y0
+    t = torch.clamp(((centers_x - x0) * dx + (centers_y - y0) * dy) /
+                    torch.clamp(dx**2 + dy**2, min=1e-12), 0, 1)
+    distances = torch.sqrt((centers_x - x0 - t * dx)**2 +
+                           (centers_y - y0 - t * dy)**2)
+    coverage = torch.clamp(radius + 0.5 - distances, 0, 1) * \
+        is_candidate * segment_valid
+    gray = 1 - torch.max(coverage, dim=-1)[0]
+
+    if batched:
+        return gray
+    else:
+        return gray[0]
+
+
 def get_most_recent_model_folder_args_match(**kwargs):
     model_folders = list_model_folders_args_match(**kwargs)
     if len(model_folders) > 0:
@@ -622,37 +1508,49 @@ def get_most_recent_model_folder_args_match(**kwargs):
             [os.stat(x).st_mtime for x in model_folders])]
 
 
-def sample_relax(logits, epsilon=1e-6):
-    """This implements Appendix C in the REBAR paper.
+def sample_relax_batch(logits, mask, epsilon=1e-6):
+    """This implements Appendix C in the REBAR paper for a batch of rows with
+    different numbers of categories. Row i has mask[i].sum() categories which
+    come first and the remaining (padding) entries of logits are ignored.
 
     Args:
-        logits: tensor of shape [num_categories]
+        logits: tensor of shape [batch_size, max_num_categories]
+        mask: bool tensor of shape [batch_size, max_num_categories]; True for
+            the entries that are categories
+        epsilon: float
 
     Returns:
-        latent, latent_aux, latent_aux_tilde: tensors of shape [num_categories]
+        latent: one-hot tensor of shape [batch_size, max_num_categories]
+        latent_aux, latent_aux_tilde: tensors of shape
+            [batch_size, max_num_categories] which are zero at padding
     """
-    num_categories = len(logits)
-    probs = exponentiate_and_normalize(logits)
+    masked_logits = torch.where(mask, logits,
+                                torch.full_like(logits, -float('inf')))
+    probs = exponentiate_and_normalize(masked_logits, dim=1)
+    # padding gets probability one so that nothing below is nan or inf there
+    safe_probs = torch.where(mask, probs, torch.ones_like(probs))
+    u, v = torch.rand((2,) + logits.shape) * (1 - 2 * epsilon) + epsilon
 
     # latent_aux
-    u = torch.distributions.Uniform(0 + epsilon, 1 - epsilon).sample(
-        sample_shape=(num_categories,))
-    latent_aux = torch.log(probs) - torch.log(-torch.log(u))
+    latent_aux = torch.log(safe_probs) - torch.log(-torch.log(u))
+    latent_index = torch.argmax(
+        torch.where(mask, latent_aux,
+                    torch.full_like(latent_aux, -float('inf'))),
+        dim=1, keepdim=True)
 
     # latent
-    latent = torch.zeros(num_categories)
-    latent[torch.argmax(latent_aux)] = 1
-    latent_byte = latent.byte()
+    latent = torch.zeros_like(logits).scatter_(1, latent_index, 1)
+    is_latent = latent.bool()
 
     # latent_aux_tilde
-    v = torch.distributions.Uniform(0 + epsilon, 1 - epsilon).sample(
-        sample_shape=(num_categories,))
-    latent_aux_tilde = torch.zeros(num_categories)
-    latent_aux_tilde[latent_byte] = -torch.log(-torch.log(v[latent_byte]))
-    latent_aux_tilde[1 - latent_byte] = -torch.log(
-        -torch.log(v[1 - latent_byte]) / probs[1 - latent_byte] -
-        torch.log(v[latent_byte]))
-    return latent, latent_aux, latent_aux_tilde
+    log_v_latent = torch.log(torch.gather(v, 1, latent_index))
+    latent_aux_tilde = torch.where(
+        is_latent, -torch.log(-log_v_latent.expand_as(v)),
+        -torch.log(-torch.log(v) / safe_probs - log_v_latent))
+
+    zeros = torch.zeros_like(logits)
+    return latent, torch.where(mask, latent_aux, zeros), \
+        torch.where(mask, latent_aux_tilde, zeros)
 
 
 def pad_zeros(x, new_length):
@@ -699,23 +1597,32 @@ def load_control_variate(model_folder='.', iteration=None):
     print_with_time('Loaded from {}'.format(path))
 
 
-def detach_tree_aux(tree_aux):
-    """Args:
+def flatten_tree_aux(tree_aux, num_columns):
+    """Stacks the entries of a tree_aux in preorder (the node order of
+    FlatTree.from_tree).
+
+    Args:
         tree_aux: e.g.
             [[0.5], [[.9, 1., .2, .1, -.1, .1], None],
                     [[-0.3 0.8], [[0.3], None]
                                  [[.9, -.1, .2, .1, 1., .1], None]]]
             or None
+        num_columns: int; entries are zero-padded to this length
 
-    Returns: tree_aux detached
+    Returns: tensor of shape [num_nodes, num_columns] whose rows are zeros
+        for leaves
     """
 
-    tree_aux_detached = []
-    if isinstance(tree_aux, list):
-        return [tree_aux[0].detach()] + [detach_tree_aux(subtree_aux)
-                                         for subtree_aux in tree_aux[1:]]
-    else:
-        return tree_aux
+    rows = []
+    stack = [tree_aux]
+    while len(stack) > 0:
+        subtree_aux = stack.pop()
+        if isinstance(subtree_aux, list):
+            rows.append(pad_zeros(subtree_aux[0], num_columns))
+            stack.extend(reversed(subtree_aux[1:]))
+        else:
+            rows.append(torch.zeros((num_columns,)))
+    return torch.stack(rows)
 
 
 class OnlineMeanStd():
@@ -756,3 +1663,244 @@ class OnlineMeanStd():
         num_parameters = np.sum([len(p) for p in means])
         return (np.sum([torch.sum(p) for p in means]) / num_parameters,
                 np.sum([torch.sum(p) for p in stds]) / num_parameters)
+
+
+def get_tree_key(tree):
+    """Canonical hashable key of a tree; structurally identical trees have
+    equal keys.
+
+    Args: list of lists or string or FlatTree
+    Returns: nested tuple or string
+    """
+    if isinstance(tree, FlatTree):
+        tree = tree.to_tree()
+    if isinstance(tree, list):
+        return (tree[0],) + tuple(get_tree_key(subtree)
+                                  for subtree in tree[1:])
+    else:
+        return tree
+
+
+def get_tensor_key(x):
+    """Hashable key of a tensor's values."""
+
+    return x.detach().cpu().numpy().tobytes()
+
+
+class LRUCache():
+    """Least recently used cache of tensors bounded by the total number of
+    bytes of the cached tensors. Only for values that don't depend on learned
+    parameters. Entries are not pickled (only the configuration and the
+    counters), so that objects holding a cache can be saved with save_object.
+
+    Args:
+        max_bytes: int; memory limit of the cached values
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.num_bytes = 0
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['entries'] = collections.OrderedDict()
+        state['num_bytes'] = 0
+        return state
+
+    def get(self, key):
+        """Returns: cached value or None"""
+
+        if key in self.entries:
+            self.num_hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        else:
+            self.num_misses += 1
+            return None
+
+    def put(self, key, value):
+        value_bytes = self._get_num_bytes(value)
+        if value_bytes > self.max_bytes:
+            return
+        if key in self.entries:
+            self.num_bytes -= self._get_num_bytes(self.entries.pop(key))
+        self.entries[key] = value
+        self.num_bytes += value_bytes
+        while self.num_bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.num_bytes -= self._get_num_bytes(evicted)
+            self.num_evictions += 1
+
+    def _get_num_bytes(self, value):
+        return value.element_size() * value.nelement()
+
+    def get_many(self, keys, compute):
+        """Looks up many keys and computes the missing values in one call.
+
+        Args:
+            keys: list of N hashables
+            compute: function that takes the list of positions (into keys) of
+                the distinct missing keys and returns a tensor whose ith
+                element is the value of keys[positions[i]]
+
+        Returns: list of N tensors
+        """
+
+        values = [self.get(key) for key in keys]
+        missing = dict()
+        for position, (key, value) in enumerate(zip(keys, values)):
+            if value is None:
+                missing.setdefault(key, []).append(position)
+        if len(missing) > 0:
+            computed = compute([positions[0]
+                                for positions in missing.values()])
+            for (key, positions), value in zip(missing.items(), computed):
+                self.put(key, value)
+                for position in positions:
+                    values[position] = value
+        return values
+
+    def get_stats(self):
+        """Returns: dict of hit/miss counters and memory usage"""
+
+        num_lookups = self.num_hits + self.num_misses
+        return {'hits': self.num_hits,
+                'misses': self.num_misses,
+                'evictions': self.num_evictions,
+                'hit_rate': self.num_hits / num_lookups
+                if num_lookups > 0 else float('nan'),
+                'entries': len(self.entries),
+                'bytes': self.num_bytes}
+
+
+def get_cache_stats(generative_model, inference_network):
+    """Returns: dict where key is a cache name and value is the result of its
+        LRUCache.get_stats; empty for grammars that don't cache anything
+    """
+
+    stats = dict()
+    if getattr(generative_model, 'ys_cache', None) is not None:
+        stats['ys'] = generative_model.ys_cache.get_stats()
+    if getattr(inference_network, 'gray_cache', None) is not None:
+        stats['gray'] = inference_network.gray_cache.get_stats()
+    return stats
+
+
+def cache_stats_to_string(cache_stats):
+    return ', '.join(
+        '{} cache: hit rate = {:.3f} ({} entries, {:.1f} MB)'.format(
+            name, stats['hit_rate'], stats['entries'], stats['bytes'] / 2**20)
+        for name, stats in sorted(cache_stats.items()))
+
+
+def log_cache_stats_and_truncation_counts(
+        iteration, generative_model, inference_network, cache_stats_history,
+        truncation_counts_history):
+    """Appends get_cache_stats and get_truncation_counts to the histories of a
+    train callback and prints them.
+
+    Args:
+        iteration: int
+        generative_model: models.GenerativeModel object
+        inference_network: models.InferenceNetwork object
+        cache_stats_history: list; appended to in place
+        truncation_counts_history: list; appended to in place
+    """
+
+    cache_stats_history.append(get_cache_stats(generative_model,
+                                               inference_network))
+    if len(cache_stats_history[-1]) > 0:
+        print_with_time('Iteration {} {}'.format(
+            iteration, cache_stats_to_string(cache_stats_history[-1])))
+    truncation_counts_history.append(
+        get_truncation_counts(generative_model, inference_network))
+    print_with_time('Iteration {} {}'.format(
+        iteration, truncation_counts_to_string(
+            truncation_counts_history[-1])))
+
+
+class SleepReplayBuffer():
+    """Ring buffer of (tree, obs) samples from the generative model for the
+    sleep phase. Every call to refill replaces the oldest samples, so that a
+    sample (and its render) is generated once and used in several steps.
+    Since production_logits change between steps, samples are
+    importance-weighted by p_current(tree) / p_when_sampled(tree).
+
+    Args:
+        capacity: int; number of samples kept
+        refill_fraction: float in (0, 1]; fraction of capacity that is
+            resampled on each refill
+    """
+
+    def __init__(self, capacity, refill_fraction=0.1):
+        self.capacity = capacity
+        self.refill_fraction = refill_fraction
+        self.trees = []
+        self.obss = []
+        # log p(tree) under the production_logits the tree was sampled with
+        self.log_priors = torch.zeros(capacity)
+        # renders of the obs for the polynomial grammar
+        self.grays = None
+        self.next_idx = 0
+
+    def __len__(self):
+        return len(self.trees)
+
+    def refill(self, generative_model):
+        """Fills the buffer if it isn't full yet, otherwise replaces
+        ceil(refill_fraction * capacity) of the oldest samples."""
+
+        if len(self) < self.capacity:
+            num_new = self.capacity - len(self)
+        else:
+            num_new = int(np.ceil(self.refill_fraction * self.capacity))
+        trees, obss = generative_model.sample_trees_and_obss(num_new)
+        idxs = [(self.next_idx + i) % self.capacity for i in range(num_new)]
+        self.next_idx = (self.next_idx + num_new) % self.capacity
+
+        with torch.no_grad():
+            self.log_priors[idxs] = generative_model.get_trees_log_prob(trees)
+        if generative_model.grammar['name'] == 'polynomial':
+            if self.grays is None:
+                self.grays = torch.zeros(self.capacity, 100, 100)
+            self.grays[idxs] = xsys2gray(generative_model.xs,
+                                         torch.stack(obss))
+        for idx, tree, obs in zip(idxs, trees, obss):
+            if idx < len(self):
+                self.trees[idx], self.obss[idx] = tree, obs
+            else:
+                self.trees.append(tree)
+                self.obss.append(obs)
+
+    def sample(self, generative_model, num_samples):
+        """Draws samples uniformly (with replacement) from the buffer.
+
+        Args:
+            generative_model: models.GenerativeModel object whose current
+                prior the samples are weighted against
+            num_samples: int
+
+        Returns:
+            trees: list of num_samples trees
+            obss: list of num_samples obs
+            grays: tensor of shape [num_samples, 100, 100] of the renders of
+                obss for the polynomial grammar; None otherwise
+            log_weights: tensor of shape [num_samples] of unnormalized log
+                importance weights
+        """
+
+        idxs = torch.randint(len(self), (num_samples,))
+        trees = [self.trees[idx] for idx in idxs.tolist()]
+        obss = [self.obss[idx] for idx in idxs.tolist()]
+        grays = None if self.grays is None else self.grays[idxs]
+        with torch.no_grad():
+            log_weights = generative_model.get_trees_log_prob(trees) - \
+                self.log_priors[idxs]
+        return trees, obss, grays, log_weights
@@ -0,0 +1,50 @@
+import torch
+import util
+
+# checks util.xsys2gray on curves whose render is known exactly and compares
+# it against the matplotlib render it replaces (headless, agg backend) on a
+# few random polynomials of degree up to 3. Runs on the CPU in a few seconds:
+# cd pcfg && python xsys2gray_check.py
+
+util.set_seed(1)
+xs = torch.linspace(-10, 10, 100)
+
+# y = 0 is the horizontal line between rows 49 and 50; the 1.5pt line is
+# about two pixels wide, so those two rows are black, the ones next to them
+# are barely touched and everything else is white
+gray = util.xsys2gray(xs, torch.zeros(100))
+assert gray.shape == (100, 100)
+assert torch.all(gray[49:51] == 0)
+assert torch.all(gray[48] > 0.9) and torch.all(gray[51] > 0.9)
+assert torch.all(gray[:48] == 1) and torch.all(gray[52:] == 1)
+
+# curves above the plot and curves with no finite points render nothing
+assert torch.all(util.xsys2gray(xs, torch.full((100,), 1000.)) == 1)
+assert torch.all(util.xsys2gray(xs, torch.full((100,), float('nan'))) == 1)
+
+# random polynomials; a batch renders the same as its rows one at a time
+num_curves = 5
+coefs = torch.randn(num_curves, 4) * torch.tensor([10, 5, 1, 0.1])
+yss = torch.sum(coefs.unsqueeze(-1) *
+                xs**torch.arange(4, dtype=torch.float).unsqueeze(-1), dim=1)
+grays = util.xsys2gray(xs, yss)
+assert grays.shape == (num_curves, 100, 100)
+assert torch.all((grays >= 0) & (grays <= 1))
+assert torch.allclose(grays, torch.stack([util.xsys2gray(xs, ys)
+                                          for ys in yss]))
+
+grays_matplotlib = torch.stack([util.xsys2gray_matplotlib(xs, ys)
+                                for ys in yss])
+# per-image mean absolute difference
+errors = torch.mean(torch.abs(grays - grays_matplotlib), dim=-1).mean(dim=-1)
+# intersection over union of the (mostly) black pixels
+black = grays < 0.5
+black_matplotlib = grays_matplotlib < 0.5
+iou = float(torch.sum((black & black_matplotlib).float())) / \
+    float(torch.sum((black | black_matplotlib).float()))
+util.print_with_time('max mean abs. error = {:.4f}, iou = {:.3f}'.format(
+    errors.max().item(), iou))
+
+assert errors.max().item() < 0.01
+assert iou > 0.9
+util.print_with_time('ok')
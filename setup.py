@@ -0,0 +1,10 @@
+from setuptools import setup
+
+setup(
+    name='rwspp-estimators',
+    version='0.1.0',
+    description='Gradient estimators shared by the gmm, pcfg and '
+                'discrete-vae experiments',
+    py_modules=['estimators'],
+    install_requires=['torch', 'numpy'],
+)
@@ -0,0 +1,76 @@
+import torch
+import numpy as np
+import estimators
+
+# compares estimators.get_vimco_control_variate (and the gradients of
+# estimators.get_vimco_loss) against the loop over left-out particles it
+# replaced
+
+
+def get_control_variate_loop(log_weight):
+    _, num_particles = log_weight.shape
+    control_variate = []
+    for i in range(num_particles):
+        log_weight_ = log_weight[:, [j for j in range(num_particles)
+                                     if j != i]]
+        control_variate.append(torch.logsumexp(
+            torch.cat([log_weight_,
+                       torch.mean(log_weight_, dim=1, keepdim=True)], dim=1),
+            dim=1) - np.log(num_particles))
+    return torch.stack(control_variate, dim=1)
+
+
+def get_vimco_loss_loop(log_p, log_q):
+    _, num_particles = log_p.shape
+    log_weight = log_p - log_q
+    log_evidence = torch.logsumexp(log_weight, dim=1) - np.log(num_particles)
+    control_variate = get_control_variate_loop(log_weight.detach())
+    reinforce_correction = torch.sum(
+        (log_evidence.detach().unsqueeze(-1) - control_variate) * log_q,
+        dim=1)
+    elbo = torch.mean(log_evidence)
+    loss = -elbo - torch.mean(reinforce_correction)
+    return loss, elbo
+
+
+torch.manual_seed(1)
+batch_size = 4
+
+for num_particles in [2, 5, 20, 100]:
+    log_p = torch.randn(batch_size, num_particles, dtype=torch.double,
+                        requires_grad=True)
+    log_q = torch.randn(batch_size, num_particles, dtype=torch.double,
+                        requires_grad=True)
+    values, grads = [], []
+    for get_loss in [get_vimco_loss_loop, estimators.get_vimco_loss]:
+        loss, elbo = get_loss(log_p, log_q)
+        values.append(torch.stack([loss, elbo]).detach())
+        grads.append(torch.autograd.grad(loss, [log_p, log_q]))
+    values_ok = torch.allclose(values[0], values[1])
+    grads_ok = all(torch.allclose(x, y) for x, y in zip(*grads))
+    print('K = {}: loss and elbo ok: {}, grads ok: {}'.format(
+        num_particles, values_ok, grads_ok))
+    assert values_ok and grads_ok
+
+# badly scaled log weights, a dominating particle, ties and zero weights
+# (one, several and all but one per row)
+for scale in [1, 100, 1e4]:
+    log_weight = torch.randn(6, 50) * scale
+    log_weight[0, 3] = log_weight[0].max() + 50 * scale
+    log_weight[1, 5] = log_weight[1, 7] = log_weight[1].max()
+    log_weight[2, 4] = -float('inf')
+    log_weight[3, :10] = -float('inf')
+    log_weight[4, 1:] = -float('inf')
+    log_weight[5, :] = -float('inf')
+    log_weight[5, 0] = log_weight[5, 1] = 0
+    control_variate = estimators.get_vimco_control_variate(log_weight)
+    control_variate_loop = get_control_variate_loop(log_weight.double())
+    finite = torch.isfinite(control_variate_loop)
+    error = torch.max(torch.abs(control_variate.double() -
+                                control_variate_loop)[finite] /
+                      (1 + torch.abs(control_variate_loop[finite]))).item()
+    print('scale = {}: max rel. error = {:.2e}'.format(scale, error))
+    assert torch.equal(torch.isfinite(control_variate), finite)
+    assert torch.equal(control_variate[~finite],
+                       control_variate_loop[~finite].float())
+    assert error < 1e-5